@@ -5,6 +5,9 @@
 from os import environ
 
 from celery import Celery
+from celery.signals import worker_process_init, worker_process_shutdown
+
+from db_settings import init_neo_driver, close_neo_driver, write_behind, write_behind_flush_interval
 
 # Rigmarole if you want proper docstrings for tasks.
 # https://github.com/celery/celery/issues/1636
@@ -54,5 +57,19 @@ app.conf.update(
     CELERYD_CONCURRENCY = 4
 )
 
+if write_behind:
+    app.conf.update(
+        CELERYBEAT_SCHEDULE = {
+            'flush-neo-write-buffer': {
+                'task': 'twitter_tasks.flushWriteBuffer',
+                'schedule': write_behind_flush_interval
+            }
+        }
+    )
+
+# Each worker process keeps one pooled Neo4j driver for all its tasks.
+worker_process_init.connect(init_neo_driver)
+worker_process_shutdown.connect(close_neo_driver)
+
 if __name__ == '__main__':
     app.start()
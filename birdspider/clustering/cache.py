@@ -0,0 +1,112 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""
+Cached clusterings, so a seed's neighbourhood is only clustered again when FOLLOWS relationships have changed.
+
+Each clustering is kept on disk in a compressed NumPy archive: the labels and adjacency matrix of the neighbourhood,
+the clusters found, MCL's converged matrix if there is one, and the count of FOLLOWS writes when it was made. If the
+count hasn't moved since, the clusters still stand. If it has, the query is run again, and if the neighbourhood's
+links are the same, the clusters still stand too. Otherwise, MCL starts from the converged matrix for every user
+whose links haven't changed.
+"""
+
+import logging
+import os
+import re
+
+import numpy as np
+from scipy import sparse
+
+
+def cache_path(directory, *keys):
+    """The file for the clustering identified by <keys>, such as the seed, the query and the engine."""
+    return os.path.join(directory, '_'.join(re.sub(r'[^\w.-]', '-', str(key)) for key in keys) + '.npz')
+
+
+def pack_matrix(name, matrix, arrays):
+    matrix = sparse.csr_matrix(matrix)
+    arrays.update({name + '_data': matrix.data, name + '_indices': matrix.indices, name + '_indptr': matrix.indptr,
+        name + '_shape': np.array(matrix.shape)})
+
+
+def unpack_matrix(name, archive):
+    if name + '_data' not in archive.files:
+        return None
+    return sparse.csr_matrix((archive[name + '_data'], archive[name + '_indices'], archive[name + '_indptr']),
+        shape=tuple(archive[name + '_shape']))
+
+
+def save_clustering(path, version, labels, adjacency, cluster_lists, converged=None):
+    """Store a clustering.
+
+    Positional arguments:
+    version -- the count of FOLLOWS writes before the neighbourhood was queried
+    labels -- the screen_names of the rows of the adjacency matrix
+    cluster_lists -- lists of the indices of the users in each cluster
+    """
+    arrays = {'version': np.array(version), 'labels': np.array(labels, dtype=str),
+        'members': np.array([j for clust in cluster_lists for j in clust], dtype=int),
+        'offsets': np.cumsum([0] + [len(clust) for clust in cluster_lists])}
+    pack_matrix('adjacency', adjacency, arrays)
+    if converged is not None:
+        pack_matrix('converged', converged, arrays)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write to one side and move it into place, so nobody reads half an archive.
+    partial = path[:-len('.npz')] + '_partial.npz'
+    np.savez_compressed(partial, **arrays)
+    os.replace(partial, path)
+
+
+def load_clustering(path):
+    """A dictionary of the 'version', 'labels', 'adjacency', 'clusters' and 'converged' of a stored clustering,
+    or None if there isn't one.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as archive:
+            members, offsets = archive['members'], archive['offsets']
+            return {'version': int(archive['version']), 'labels': archive['labels'].tolist(),
+                'adjacency': unpack_matrix('adjacency', archive), 'converged': unpack_matrix('converged', archive),
+                'clusters': [members[offsets[i]:offsets[i + 1]].tolist() for i in range(len(offsets) - 1)]}
+    except (IOError, KeyError, ValueError):
+        logging.warning('*** COULD NOT READ CACHED CLUSTERING %s ***' % path, exc_info=True)
+        return None
+
+
+def remap(matrix, old_labels, new_labels):
+    """Move the rows and columns of a matrix from where they are in <old_labels> to where the same labels are in
+    <new_labels>, dropping those that aren't there any more.
+    """
+    index = {label: i for i, label in enumerate(new_labels)}
+    moved = np.array([index.get(label, -1) for label in old_labels], dtype=int)
+    coo = sparse.coo_matrix(matrix)
+    rows, cols = moved[coo.row], moved[coo.col]
+    kept = (rows >= 0) & (cols >= 0)
+    dim = len(new_labels)
+    return sparse.csr_matrix((coo.data[kept], (rows[kept], cols[kept])), shape=(dim, dim))
+
+
+def changed_users(cached, labels, adjacency):
+    """The indices in <labels> of the users who are new since the cached clustering, or whose links have changed."""
+    diff = abs(sparse.csr_matrix(adjacency, dtype=float) - remap(cached['adjacency'], cached['labels'], labels))
+    diff.eliminate_zeros()
+    rows, cols = diff.nonzero()
+    known = set(cached['labels'])
+    return set(rows.tolist()) | set(cols.tolist()) | set(i for i, label in enumerate(labels) if label not in known)
+
+
+def unchanged(cached, labels, adjacency):
+    """Whether the neighbourhood has the same users, linked in the same way, as the cached clustering."""
+    return set(labels) == set(cached['labels']) and not changed_users(cached, labels, adjacency)
+
+
+def warm_start(cached, labels, adjacency):
+    """The cached converged matrix, moved to the new labels, without the columns of users who are new or whose links
+    have changed. None if there isn't one.
+    """
+    if cached is None or cached['converged'] is None:
+        return None
+    keep = np.ones(len(labels))
+    keep[sorted(changed_users(cached, labels, adjacency))] = 0.0
+    return remap(cached['converged'], cached['labels'], labels).tocsc().dot(sparse.diags(keep))
@@ -2,24 +2,40 @@
 # Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
 
 
+from contextlib import contextmanager
 from datetime import datetime
+import multiprocessing
+from os import environ
+import resource
+import time
 
 import logging
 import networkx as nx
 import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 
 __vsmall__ = 0.0001
 __nearly1__ = 0.95
 
+# Sparse MCL drops entries smaller than this after each iteration, two orders of magnitude below what counts as being
+# in a cluster. Any closer, (at 0.00001) and pruning can tip a close contest between two attractors, splitting a
+# cluster that dense MCL finds whole.
+__prune__ = 0.000001
 
-def clusterize(matrix, inflate=1.5):
+# Environment variables that limit the threads of the various BLAS libraries NumPy might be using.
+blas_thread_vars = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+    'NUMEXPR_NUM_THREADS']
+
+
+def clusterize(matrix, inflate=1.5, stats=None):
     """Cluster an adjacency matrix by MCL: http://www.micans.org/mcl/"""
     start = datetime.now()
     
-    mat = np.array(matrix)
+    mat = matrix.toarray() if sparse.issparse(matrix) else np.array(matrix, dtype=float)
     np.fill_diagonal(mat, 1.0)
     mat = np.nan_to_num(mat / np.sum(mat, 0))
-    dim = len(matrix)
+    dim = mat.shape[0]
 
     iterations = 1
     converged = False
@@ -50,10 +66,388 @@ def clusterize(matrix, inflate=1.5):
         this_cluster = i+1
         for j in clust:
             cluster_ref[j] = this_cluster
-            
+
+    if stats is not None:
+        stats['iterations'] = iterations
+    return cluster_lists, cluster_ref
+
+
+def normalize_columns(mat):
+    """Scale each column of a sparse matrix to sum to 1, leaving empty columns empty."""
+    sums = np.asarray(mat.sum(0)).ravel()
+    sums[sums == 0] = 1.0
+    return sparse.csc_matrix(mat.dot(sparse.diags(1.0 / sums)))
+
+
+def prune_columns(mat, threshold=__prune__, top_k=100):
+    """Drop the entries of a CSC matrix below <threshold>, then all but the <top_k> largest in each column."""
+    mat.data[mat.data < threshold] = 0.0
+    mat.eliminate_zeros()
+    if top_k:
+        counts = np.diff(mat.indptr)
+        for col in np.flatnonzero(counts > top_k):
+            column = mat.data[mat.indptr[col]:mat.indptr[col + 1]]
+            column[np.argsort(column)[:-top_k]] = 0.0
+        mat.eliminate_zeros()
+    return mat
+
+
+def sparse_deviation(mat, new_mat):
+    """The standard deviation of every entry of the difference between two sparse matrices, zeros included."""
+    diff = abs(mat - new_mat)
+    size = float(diff.shape[0] * diff.shape[1])
+    mean = diff.sum() / size
+    return np.sqrt(max(diff.multiply(diff).sum() / size - mean ** 2, 0.0))
+
+
+def sparse_clusterize(matrix, inflate=1.5, threshold=__prune__, top_k=100, max_iterations=100, warm_start=None,
+    stats=None):
+    """Cluster an adjacency matrix by MCL, keeping it sparse throughout.
+
+    Gives the same clusters as clusterize() for the same matrix, as long as no column has more than <top_k> entries
+    worth keeping. The exception is a user still shared between clusters when the iterations stop, whose share of one
+    of them is draining away. It can be either side of __vsmall__, so either engine might count it in that cluster.
+
+    Positional arguments:
+    matrix -- a SciPy sparse matrix, or anything that can become one, such as a list of lists
+
+    Keyword arguments:
+    threshold -- entries smaller than this are pruned after each iteration
+    top_k -- the most entries kept in each column, or 0 to keep them all
+    max_iterations -- give up on converging after this many iterations
+    warm_start -- a matrix to start from, such as the converged matrix of an earlier run, its columns with any
+    entries replace those of the adjacency matrix
+    stats -- a dictionary to record the number of iterations, and the converged matrix, in
+    """
+    start = datetime.now()
+
+    mat = sparse.csc_matrix(matrix, dtype=float)
+    mat = mat.tolil()
+    mat.setdiag(1.0)
+    mat = normalize_columns(mat)
+    if warm_start is not None:
+        warm_start = sparse.csc_matrix(warm_start, dtype=float)
+        warm = (np.diff(warm_start.indptr) > 0).astype(float)
+        mat = normalize_columns(mat.dot(sparse.diags(1.0 - warm)) + warm_start.dot(sparse.diags(warm)))
+
+    iterations = 1
+    converged = False
+
+    while not converged:
+
+        new_mat = mat.dot(mat).power(inflate).tocsc()
+        new_mat = normalize_columns(prune_columns(new_mat, threshold, top_k))
+        dev = sparse_deviation(mat, new_mat)
+
+        output = 'Iteration: '+str(iterations)
+        if dev > __vsmall__ and iterations < max_iterations:
+            output += " No convergence. Deviation: "+str(dev)
+            mat = new_mat
+            iterations += 1
+        else:
+            output += ' Converged in ' + str((datetime.now()-start).seconds) + ' seconds.'
+            output += ' Non-zeros: ' + str(new_mat.nnz)
+            converged = True
+        logging.info(output)
+
+    # The attractors are the rows that still have entries, each holds the members of its cluster.
+    attractors = new_mat.tocsr()
+    cluster_lists = []
+    for i in np.flatnonzero(np.diff(attractors.indptr)):
+        row = attractors.getrow(i)
+        members = sorted(row.indices[row.data > __vsmall__])
+        if len(members) > 2:
+            cluster_lists.append([int(j) for j in members])
+
+    cluster_ref = {}
+    for i, clust in enumerate(cluster_lists):
+        this_cluster = i+1
+        for j in clust:
+            cluster_ref[j] = this_cluster
+
+    if stats is not None:
+        stats['iterations'] = iterations
+        stats['converged'] = new_mat
+    return cluster_lists, cluster_ref
+
+
+def symmetric_adjacency(matrix):
+    """An undirected, weighted CSR adjacency matrix without self-links, from a directed one."""
+    mat = sparse.csr_matrix(matrix, dtype=float)
+    mat = (mat + mat.T).tolil()
+    mat.setdiag(0.0)
+    mat = mat.tocsr()
+    mat.eliminate_zeros()
+    return mat
+
+
+def label_clusters(labels):
+    """Clusters of more than two members from the community label of each index, like those found by MCL."""
+    cluster_lists = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        if len(members) > 2:
+            cluster_lists.append([int(j) for j in members])
+    cluster_lists.sort()
+
+    cluster_ref = {}
+    for i, clust in enumerate(cluster_lists):
+        for j in clust:
+            cluster_ref[j] = i+1
     return cluster_lists, cluster_ref
 
 
+def label_propagation(matrix, max_iterations=100, seed=0, stats=None):
+    """Cluster an adjacency matrix by label propagation, each user taking the label most of its links have.
+
+    Each iteration takes time in proportion to the number of links. A random half of the users change their label
+    each time, so that neighbours don't keep swapping labels with each other.
+
+    Keyword arguments:
+    max_iterations -- stop after this many iterations, if the labels haven't settled
+    seed -- for the random choice of users to update, so results can be repeated
+    stats -- a dictionary to record the number of iterations in
+    """
+    # Each user counts as one of its own links, so it keeps its label unless its neighbours outweigh it.
+    adj = symmetric_adjacency(matrix)
+    dim = adj.shape[0]
+    adj = (adj + sparse.identity(dim, format='csr')).tocoo()
+    labels = np.arange(dim)
+    random = np.random.RandomState(seed)
+
+    iterations = 0
+    while iterations < max_iterations:
+        iterations += 1
+        votes = sparse.coo_matrix((adj.data, (adj.row, labels[adj.col])), shape=(dim, dim)).tocsr()
+        best = np.asarray(votes.argmax(axis=1)).ravel()
+        changing = best != labels
+        if not changing.any():
+            break
+        changing &= random.rand(dim) < 0.5
+        labels[changing] = best[changing]
+        logging.info('Iteration: %d Labels changed: %d' % (iterations, np.count_nonzero(changing)))
+
+    if stats is not None:
+        stats['iterations'] = iterations
+    return label_clusters(labels)
+
+
+def louvain_level(graph, resolution=1.0, max_sweeps=20):
+    """Move each node to the neighbouring community that most improves the modularity, until none move.
+
+    Returns whether any node moved, the community of each node numbered from 0, and the number of sweeps.
+    """
+    dim = graph.shape[0]
+    indptr, indices, data = graph.indptr.tolist(), graph.indices.tolist(), graph.data.tolist()
+    degrees = np.asarray(graph.sum(1)).ravel().tolist()
+    total = sum(degrees)
+    community = list(range(dim))
+    community_degrees = list(degrees)
+
+    moved = False
+    sweeps = 0
+    while total and sweeps < max_sweeps:
+        sweeps += 1
+        moves = 0
+        for i in range(dim):
+            current = community[i]
+            links = {}
+            for p in range(indptr[i], indptr[i + 1]):
+                j = indices[p]
+                if j != i:
+                    links[community[j]] = links.get(community[j], 0.0) + data[p]
+
+            community_degrees[current] -= degrees[i]
+            scale = resolution * degrees[i] / total
+            best = current
+            best_gain = links.get(current, 0.0) - scale * community_degrees[current]
+            for candidate, weight in links.items():
+                gain = weight - scale * community_degrees[candidate]
+                if gain > best_gain:
+                    best, best_gain = candidate, gain
+            community_degrees[best] += degrees[i]
+
+            if best != current:
+                community[i] = best
+                moves += 1
+        if not moves:
+            break
+        moved = True
+
+    return moved, np.unique(community, return_inverse=True)[1], sweeps
+
+
+def louvain(matrix, resolution=1.0, max_levels=10, max_sweeps=20, stats=None):
+    """Cluster an adjacency matrix by the Louvain method of modularity optimisation: https://arxiv.org/abs/0803.0476
+
+    Users are moved between neighbouring communities while that improves the modularity, then each community becomes
+    a node of a smaller graph, and so on until nothing moves. Each sweep over the users takes time in proportion to
+    the number of links.
+
+    Keyword arguments:
+    resolution -- more than 1 for smaller communities, less for bigger ones
+    max_levels -- the most times communities are merged into nodes
+    max_sweeps -- the most sweeps over the nodes at each level
+    stats -- a dictionary to record the total number of sweeps in
+    """
+    graph = symmetric_adjacency(matrix)
+    labels = np.arange(graph.shape[0])
+    iterations = 0
+
+    for level in range(max_levels):
+        moved, community, sweeps = louvain_level(graph, resolution, max_sweeps)
+        iterations += sweeps
+        logging.info('Level: %d Sweeps: %d Communities: %d' % (level + 1, sweeps, len(set(community))))
+        if not moved:
+            break
+        labels = community[labels]
+        members = sparse.csr_matrix((np.ones(len(community)), (np.arange(len(community)), community)))
+        graph = (members.T.dot(graph).dot(members)).tocsr()
+
+    if stats is not None:
+        stats['iterations'] = iterations
+    return label_clusters(labels)
+
+
+def measured(run, matrix, **kwargs):
+    """Run a clustering engine, return its clusters and references, and a dictionary of stats.
+
+    The stats are the seconds it took and its iterations. "memory_growth" is how far it raised the peak resident memory
+    of the process that ran it, and "process_peak_memory" is that peak over the life of the process, both in
+    kilobytes. A long-lived worker that's already run something bigger shows no growth.
+
+    Positional arguments:
+    run -- the engine, or component_clusterize, which takes the engine to run on each component as "engine"
+    """
+    stats = {}
+    start = time.time()
+    peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cluster_lists, cluster_ref = run(matrix, stats=stats, **kwargs)
+    stats['seconds'] = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Components clustered in other processes report their own.
+    stats['memory_growth'] = max(stats.get('memory_growth', 0), peak - peak_before)
+    stats['process_peak_memory'] = max(stats.get('process_peak_memory', 0), peak)
+    stats.setdefault('iterations', 0)
+    return cluster_lists, cluster_ref, stats
+
+
+def components(matrix):
+    """Split an adjacency matrix into its weakly connected components. Returns an array of the indices in each."""
+    count, labels = connected_components(sparse.csr_matrix(matrix), directed=True, connection='weak')
+    order = np.argsort(labels, kind='stable')
+    return np.split(order, np.cumsum(np.bincount(labels, minlength=count))[:-1])
+
+
+def cluster_component(engine, matrix, **kwargs):
+    """Run a clustering engine over one component, return its cluster lists and stats."""
+    cluster_lists, cluster_ref, stats = measured(engine, matrix, **kwargs)
+    return cluster_lists, stats
+
+
+@contextmanager
+def limited_blas(threads):
+    """Limit the BLAS threads of any process started inside the block."""
+    saved = {var: environ.get(var) for var in blas_thread_vars}
+    environ.update({var: str(threads) for var in blas_thread_vars})
+    try:
+        yield
+    finally:
+        for var, value in saved.items():
+            if value is None:
+                environ.pop(var, None)
+            else:
+                environ[var] = value
+
+
+def component_clusterize(matrix, engine=sparse_clusterize, min_size=4, parallel_size=500, processes=0,
+    blas_threads=1, warm_start=None, stats=None, **kwargs):
+    """Cluster each connected component of an adjacency matrix on its own.
+
+    Returns a list of clusters and a dictionary of the cluster of each index, like clusterize(), with the indices of
+    the whole matrix.
+
+    Keyword arguments:
+    engine -- the function that clusters a component, such as clusterize or sparse_clusterize
+    min_size -- components smaller than this are skipped, since they can't give a cluster that labelClusters keeps
+    parallel_size -- components at least this big are clustered in a pool of <processes> processes, if there is one
+    blas_threads -- the BLAS threads each of the pool's processes may use
+    warm_start -- a matrix for sparse_clusterize to start from, split up along with the components
+    stats -- a dictionary to record the number of components, their total iterations, the most that clustering any
+    of them raised its process's peak memory, the highest of those peaks, and the converged matrix, if the engine has
+    one
+    """
+    start = datetime.now()
+    mat = sparse.csr_matrix(matrix, dtype=float)
+    parts = [members for members in components(mat) if len(members) >= min_size]
+    logging.info('*** CLUSTERING %d COMPONENTS OF %d NODES ***' % (len(parts), mat.shape[0]))
+
+    if warm_start is not None:
+        warm_start = sparse.csr_matrix(warm_start, dtype=float)
+
+    found = {}
+    component_stats = {}
+    pending = []
+    for n, members in enumerate(parts):
+        size = len(members)
+        sub = mat[members][:, members]
+        sub_kwargs = kwargs if warm_start is None else dict(kwargs, warm_start=warm_start[members][:, members])
+        if size > 2 and sub.nnz - np.count_nonzero(sub.diagonal()) == size * (size - 1):
+            # Everyone is linked to everyone else, so the component is a cluster already.
+            found[n] = [list(range(size))]
+            component_stats[n] = {'iterations': 0}
+        elif processes and size >= parallel_size:
+            pending.append((n, sub, sub_kwargs))
+        else:
+            found[n], component_stats[n] = cluster_component(engine, sub, **sub_kwargs)
+
+    if pending:
+        try:
+            # Spawned processes start with the limited BLAS threads, forked ones would inherit ours.
+            with limited_blas(blas_threads):
+                with multiprocessing.get_context('spawn').Pool(processes) as pool:
+                    results = [(n, pool.apply_async(cluster_component, (engine, sub), sub_kwargs))
+                        for n, sub, sub_kwargs in pending]
+                    for n, result in results:
+                        found[n], component_stats[n] = result.get()
+        except Exception:
+            # Such as when a daemonic worker process isn't allowed children, or a worker couldn't be started.
+            logging.warning('*** COULD NOT CLUSTER IN A POOL, CLUSTERING IN PROCESS ***', exc_info=True)
+            for n, sub, sub_kwargs in pending:
+                if n not in found:
+                    found[n], component_stats[n] = cluster_component(engine, sub, **sub_kwargs)
+
+    cluster_lists = [[int(parts[n][j]) for j in cluster] for n in sorted(found) for cluster in found[n]]
+    cluster_ref = {}
+    for i, clust in enumerate(cluster_lists):
+        for j in clust:
+            cluster_ref[j] = i+1
+
+    if stats is not None:
+        stats['components'] = len(parts)
+        stats['iterations'] = sum(component['iterations'] for component in component_stats.values())
+        for key in ['memory_growth', 'process_peak_memory']:
+            stats[key] = max([0] + [component.get(key, 0) for component in component_stats.values()])
+        blocks = [(parts[n], component['converged'].tocoo()) for n, component in sorted(component_stats.items())
+            if 'converged' in component]
+        if blocks:
+            # Put each component's converged matrix back where its users are in the whole matrix.
+            stats['converged'] = sparse.csc_matrix((np.concatenate([block.data for members, block in blocks]),
+                (np.concatenate([members[block.row] for members, block in blocks]),
+                np.concatenate([members[block.col] for members, block in blocks]))), shape=mat.shape)
+    logging.info('*** FOUND %d CLUSTERS IN %d SECONDS ***' % (len(cluster_lists), (datetime.now()-start).seconds))
+    return cluster_lists, cluster_ref
+
+
+"""
+The clustering engines, by name. Each takes an adjacency matrix, and a "stats" dictionary to record its iterations in,
+and returns a list of clusters and a dictionary of the cluster of each index. MCL suits small neighbourhoods, label
+propagation and Louvain take time in proportion to the number of links, so they suit big ones.
+"""
+clustering_engines = {'mcl': sparse_clusterize, 'dense_mcl': clusterize, 'label_propagation': label_propagation,
+    'louvain': louvain}
+
+
 def labelClusters(clusters, labs):
     unique_clusters = []
     cluster_sets = {}
@@ -85,7 +479,7 @@ def buildgraph(matrix, labels=False, clusters={}, clustermode=False):
         cluster_labeler = lambda x: True
     
     G = nx.Graph()
-    dim = len(matrix)
+    dim = matrix.shape[0] if sparse.issparse(matrix) else len(matrix)
     
     if not labels:
         G.add_nodes_from(list(range(dim)))
@@ -99,8 +493,11 @@ def buildgraph(matrix, labels=False, clusters={}, clustermode=False):
             if cluster:
                 G.node[i]['cluster'] = cluster_labeler(cluster)
                 
-    for i in range(dim):
-        G.add_edges_from([(i, j) for j in range(dim) if matrix[i][j]])
+    if sparse.issparse(matrix):
+        G.add_edges_from(zip(*[ids.tolist() for ids in matrix.nonzero()]))
+    else:
+        for i in range(dim):
+            G.add_edges_from([(i, j) for j in range(dim) if matrix[i][j]])
 
 #    if clusters:
 #        for i in range(dim):
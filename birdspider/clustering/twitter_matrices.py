@@ -1,29 +1,28 @@
 
 # Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
 """ Adjacency matrices for various queries relating to Twitter. """
-import re
+import numpy as np
+from scipy import sparse
+
+from cypher_queries import fof_query, trans_fof_query
 
 
 def twitterFofQuery(user):
-    fofQuery = """MATCH (a:twitter_user {screen_name:'SCREEN_NAME'})-[:FOLLOWS]->(b:twitter_user) WITH b
-    MATCH (c:twitter_user)-[:FOLLOWS]->(b:twitter_user) WITH DISTINCT c
-    MATCH (c)-[:FOLLOWS]->(d:twitter_user) RETURN DISTINCT c.screen_name,COLLECT(d.screen_name)"""
-    return re.sub(r'SCREEN_NAME', user, fofQuery)
+    """The friends-of-friends query and its parameters for a given user."""
+    return fof_query, {'screen_name': user}
 
 def twitterTransFofQuery(user):
-    fofQuery = """MATCH (a:twitter_user {screen_name:'SCREEN_NAME'})-[:FOLLOWS]->(b:twitter_user)-[:FOLLOWS]->(a) WITH b
-    MATCH (c:twitter_user)-[:FOLLOWS]->(b:twitter_user)-[:FOLLOWS]->(c)
-    RETURN DISTINCT b.screen_name,COLLECT(c.screen_name)"""
-    return re.sub(r'SCREEN_NAME', user, fofQuery)
+    """The query and parameters for the mutual friends of mutual friends of a given user."""
+    return trans_fof_query, {'screen_name': user}
 
 
 # TODO: rename to something indicating this could create any set of labels and matrix given correct sort of query?
 # although given birdspider is twitter specific may not be necessary to rename
-def twitterMatrix(db, query):
+def twitterMatrix(db, query, params={}):
     """Run a Cypher query that returns pairs of Twitter screen_names lists of others to which they are linked."""
 
     def matrix_query_as_list(tx):
-        return list(tx.run(query))
+        return list(tx.run(query, **params))
 
     with db.session() as session:
         result = session.read_transaction(matrix_query_as_list)
@@ -36,6 +35,48 @@ def twitterMatrix(db, query):
         return [float(1 & (i in row_names)) for i in screen_names]
 
     return screen_names, [get_row(i) for i in range(len(screen_names))]
+
+
+def twitterSparseMatrix(db, query, params={}, symmetric=False, weighted=False):
+    """Run the same sort of query as twitterMatrix, return the screen_names and a sparse CSR adjacency matrix.
+
+    Keyword arguments:
+    symmetric -- link each pair of users both ways if either links to the other
+    weighted -- weight each link by the number of times it's returned, or by a third column of weights lined up
+    with the screen_names in the second, instead of giving every link a weight of 1
+    """
+
+    def matrix_query_as_list(tx):
+        return list(tx.run(query, **params))
+
+    with db.session() as session:
+        result = session.read_transaction(matrix_query_as_list)
+
+    records = [record for record in result if record[0]]
+    screen_names = [record[0] for record in records]
+    index = {name: i for i, name in enumerate(screen_names)}
+
+    rows, cols, weights = [], [], []
+    for i, record in enumerate(records):
+        linked = record[1]
+        link_weights = record[2] if weighted and len(record) > 2 else [1.0] * len(linked)
+        for name, weight in zip(linked, link_weights):
+            j = index.get(name)
+            if j is not None:
+                rows.append(i)
+                cols.append(j)
+                weights.append(float(weight))
+
+    dim = len(screen_names)
+    # Duplicate links are summed when a COO matrix is converted.
+    matrix = sparse.coo_matrix((np.array(weights), (np.array(rows, dtype=int), np.array(cols, dtype=int))),
+        shape=(dim, dim)).tocsr()
+    if not weighted:
+        matrix.data[:] = 1.0
+    if symmetric:
+        matrix = (matrix + matrix.T) if weighted else matrix.maximum(matrix.T)
+
+    return screen_names, sparse.csr_matrix(matrix)
     
 
 
@@ -2,26 +2,49 @@
 """Celery tasks relating to clustering."""
 __author__ = 'Meg Gordon'
 
+from os import environ
+
 from celery.utils.log import get_task_logger
 
 from app import app
-from clustering.twitter_matrices import twitterMatrix, twitterTransFofQuery, twitterFofQuery
-from clustering.matrix_tools import clusterize, labelClusters
+from clustering.cache import cache_path, load_clustering, save_clustering, unchanged, warm_start
+from clustering.twitter_matrices import twitterSparseMatrix, twitterTransFofQuery, twitterFofQuery
+from clustering.matrix_tools import clustering_engines, component_clusterize, labelClusters, measured
 from clustering.neo import user_clusters_to_neo
-from db_settings import get_neo_driver
+from db_settings import neo_driver
+from twitter_tools.graph_version import follows_version
 
 logger = get_task_logger(__name__)
 
+# Processes to cluster the largest components of a neighbourhood in, 0 to cluster them one at a time.
+cluster_processes = int(environ.get('CLUSTER_PROCESSES', 0))
+
+# Where clusterings and their adjacency matrices are kept, to be reused while the graph doesn't change.
+cluster_cache_dir = environ.get('CLUSTER_CACHE_DIR', '/tmp/birdspider_clusters')
+
 
 @app.task
-def cluster(seed, seed_type, query_name):
+def cluster(seed, seed_type, query_name, processes=cluster_processes, engine='mcl', use_cache=True):
+    """Cluster the neighbourhood of a seed, push the clusters to Neo4J and return the clustering engine's stats.
+
+    If the seed's neighbourhood hasn't changed since it was last clustered, the clusters are already in Neo4J, so
+    nothing is pushed.
+
+    Keyword arguments:
+    processes -- cluster the largest components in this many processes
+    engine -- the name of the clustering engine: 'mcl', 'dense_mcl', 'label_propagation' or 'louvain'
+    use_cache -- reuse the last clustering of the seed if the graph hasn't changed, or start MCL from it if it has
+    """
     logger.info('*** START CLUSTERING: seed %s, seed_type %s, query_name %s ***' % (seed, seed_type, query_name))
+    if engine not in clustering_engines:
+        logger.warn('*** CLUSTERING: no such engine %s ***' % engine)
+        return
     if seed_type == 'twitter_user':
         seed_id_name = 'screen_name'
         if query_name == "TransFoF":
-            query = twitterTransFofQuery(seed)
+            query, params = twitterTransFofQuery(seed)
         elif query_name == 'FoF':
-            query = twitterTransFofQuery(seed)
+            query, params = twitterTransFofQuery(seed)
         else:
             logger.warn('*** CLUSTERING:  not yet implemented for seed type %s ***' % seed_type)
             return
@@ -29,12 +52,32 @@ def cluster(seed, seed_type, query_name):
         logger.warn('*** CLUSTERING:  not yet implemented for seed type %s ***' % seed_type)
         return
 
-    db = get_neo_driver()
+    # Read the count before the query, so FOLLOWS written while clustering are picked up next time.
+    version = follows_version()
+    path = cache_path(cluster_cache_dir, seed_type, seed, query_name, engine)
+    cached = load_clustering(path) if use_cache else None
+    if cached and cached['version'] == version:
+        logger.info('*** CLUSTERING: NO FOLLOWS WRITTEN SINCE SEED %s WAS CLUSTERED ***' % seed)
+        return {'engine': engine, 'cached': True}
+
+    db = neo_driver()
 
     logger.info('*** CLUSTERING: get matrix for seed %s ***' % seed)
-    matrix_labels_and_results = twitterMatrix(db, query)
+    matrix_labels_and_results = twitterSparseMatrix(db, query, params)
+    if cached and unchanged(cached, *matrix_labels_and_results):
+        logger.info('*** CLUSTERING: NEIGHBOURHOOD OF SEED %s IS UNCHANGED ***' % seed)
+        save_clustering(path, version, cached['labels'], cached['adjacency'], cached['clusters'], cached['converged'])
+        return {'engine': engine, 'cached': True}
+
+    start = warm_start(cached, *matrix_labels_and_results) if engine == 'mcl' else None
+    engine_args = {} if start is None else {'warm_start': start}
     logger.info('*** CLUSTERING: find clusters for seed %s ***' )
-    cluster_results = clusterize(matrix_labels_and_results[1])
+    cluster_results = measured(component_clusterize, matrix_labels_and_results[1],
+        engine=clustering_engines[engine], processes=processes, **engine_args)
+    converged = cluster_results[2].pop('converged', None)
+    stats = dict(cluster_results[2], engine=engine, users=len(matrix_labels_and_results[0]), cached=False,
+        warm_start=start is not None)
+    logger.info('*** CLUSTERING STATS: %s ***' % ', '.join('%s %s' % item for item in sorted(stats.items())))
     logger.info('*** CLUSTERING: label clusters for seed %s ***' )
     labelled_clusters = labelClusters(cluster_results[0], matrix_labels_and_results[0])
 
@@ -44,5 +87,10 @@ def cluster(seed, seed_type, query_name):
     else:
         logger.warn('*** CLUSTERING: not yet implemented for seed type %s ***' % seed_type)
 
-    db.close()
+    # Only once the clusters are in Neo4J, or a failed push would never be retried.
+    if use_cache:
+        save_clustering(path, version, matrix_labels_and_results[0], matrix_labels_and_results[1], cluster_results[0],
+            converged)
+
     logger.info('*** CLUSTERING FINISHED: seed %s, seed_type %s, query_name %s ***' % (seed, seed_type, query_name))
+    return stats
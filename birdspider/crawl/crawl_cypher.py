@@ -4,11 +4,13 @@
 __author__ = 'Giles Richard Greenway'
 
 
-import json
 import logging
-import redis
-from datetime import datetime, timedelta
-from db_settings import cache
+from datetime import datetime
+from cypher_queries import (create_crawl_query, crawl_centred_on_query, next_followers_queries,
+    next_friends_queries, next_tweets_queries, update_crawl_query)
+from crawl.frontier import refill_frontier, take_from_frontier, wait_for_frontier
+from crawl.rings import next_in_rings
+from db_settings import neo_driver
 
 
 def start_user_crawl(db, user, crawl_task, status='initiated'):
@@ -17,24 +19,15 @@ def start_user_crawl(db, user, crawl_task, status='initiated'):
     right_now = started.isoformat()
 
     # push new node to neo4j
-    crawl_data = {'timestamp': right_now, 'crawl_task': crawl_task, 'status': status}
-    create_query = '''UNWIND $data AS d
-        CREATE (a:crawl {timestamp: d.timestamp, crawl_task: d.crawl_task, status: d.status})
-        RETURN id(a)'''
-
     with db.session() as session:
         with session.begin_transaction() as tx:
-            crawl_id = tx.run(create_query, data=crawl_data).single().value()
+            crawl_id = tx.run(create_crawl_query, timestamp=right_now, crawl_task=crawl_task,
+                status=status).single().value()
 
     # relationship: crawl--centred_on-->user
-    match = "MATCH (c:crawl), (t:twitter_user {{screen_name: '{}'}}) WHERE ID(c) = {}".format(user, crawl_id)
-
-    merge = "MERGE (c)-[:CENTRED_ON]->(t)"
-
-    relation_query = '\n'.join(['UNWIND $data AS d', match, merge])
     with db.session() as session:
         with session.begin_transaction() as tx:
-            tx.run(relation_query, data=user)
+            tx.run(crawl_centred_on_query, user=user, crawl_id=crawl_id)
 
     return crawl_id
 
@@ -43,78 +36,39 @@ def update_crawl(db, crawl_task, status):
     updated = datetime.now()
     right_now = updated.isoformat()
 
-    match = "MATCH  (c:crawl {{crawl_task: '{}'}})".format(crawl_task)
-    update = "SET c.status = '{}', c.timestamp = '{}'".format(status, right_now)
-    query = '\n'.join([match, update])
-
     with db.session() as session:
         with session.begin_transaction() as tx:
-            tx.run(query)
-
-
-
-#TODO: make sure this query really does the following
-# how this function works
-# a user node has the friend and follower counts as attributes (in json returned when you get the user,
-#  so therefore in neo node added)
-# if the count of fr and fol in the attributes of a node are more than half of actual num of relations in the graph
-# then that is the node you pick to scrape next
-# rephrase or rewrite?
-# actual number of relationships is less than the count attribute
-def nextFriends(db, latest=False, max_friends=2000, max_followers=2000, limit=20):
-    """ Return a list of non-supernode users who have fewer friend relationships than Twitter thinks they should."""
-    desc = 'DESC' if latest else ''
+            tx.run(update_crawl_query, crawl_task=crawl_task, status=status, right_now=right_now)
 
-    query = """MATCH (a:twitter_user)-[:FOLLOWS]-(b:twitter_user) WITH a, COUNT(*) as c
-        WHERE c < a.friends_count/2 AND a.friends_count < {} AND a.followers_count < {} AND NOT EXISTS (a.protected)
-        AND NOT EXISTS (a.defunct)
-        RETURN a.screen_name
-        ORDER BY a.last_scraped {} LIMIT {}""".format(max_friends, max_followers, desc, limit)
 
+def crawl_candidates(db, query, **params):
+    """Run one of the crawl's selection queries, return the screen_names it picks."""
     with db.session() as session:
         with session.begin_transaction() as tx:
-            result = tx.run(query)
-            next_friends = [record.values()[0] for record in result]
+            result = tx.run(query, **params)
+            return [record.values()[0] for record in result]
 
-    return next_friends
+
+def nextFriends(db, latest=False, max_friends=2000, max_followers=2000, limit=20):
+    """ Return a list of non-supernode users who have fewer friend relationships than Twitter thinks they should."""
+    return crawl_candidates(db, next_friends_queries[bool(latest)], max_friends=max_friends,
+        max_followers=max_followers, limit=limit)
 
 
 def nextFollowers(db, latest=False, max_friends=2000, max_followers=2000, limit=20):
     """ Return a list of non-supernode users who have fewer follower relationships than Twitter thinks they should."""
-    desc = ' DESC' if latest else ''
-    query = """MATCH (b:twitter_user)-[:FOLLOWS]-(a:twitter_user) WITH a, COUNT(*) as c
-        WHERE c < a.followers_count/2 AND a.followers_count < {} AND a.friends_count < {} AND NOT EXISTS (a.protected)
-        AND NOT EXISTS (a.defunct)
-        RETURN a.screen_name
-        ORDER BY a.last_scraped {} LIMIT {}""".format(max_followers, max_friends, desc, limit)
-
-    with db.session() as session:
-        with session.begin_transaction() as tx:
-            result = tx.run(query)
-            next_followers = [record.values()[0] for record in result]
-
-    return next_followers
-
-
-def nextTweets(db, latest=False, max_friends=2000, max_followers=2000, limit=20, max_tweets=3000):
-    """ Return a list of non-supernode users who have fewer tweets than Twitter thinks they should."""
-    desc = ' DESC' if latest else ''
-    query = """MATCH (a:twitter_user) WHERE NOT (a)-[:TWEETED]->(:tweet) WITH a, COUNT(*) as c
-        WHERE c < a.statuses_count AND c < {} AND a.followers_count < {} AND a.friends_count < {}
-        AND NOT EXISTS (a.protected) AND NOT EXISTS (a.defunct)
-        RETURN a.screen_name
-        ORDER BY a.last_scraped {} LIMIT {}""".format(max_tweets, max_followers, max_friends, desc, limit)
+    return crawl_candidates(db, next_followers_queries[bool(latest)], max_friends=max_friends,
+        max_followers=max_followers, limit=limit)
 
-    with db.session() as session:
-        with session.begin_transaction() as tx:
-            result = tx.run(query)
-            next_tweets = [record.values()[0] for record in result]
 
-    return next_tweets
+def nextTweets(db, latest=False, max_friends=2000, max_followers=2000, limit=20):
+    """ Return a list of non-supernode users who have tweeted, but have no tweets in the graph."""
+    return crawl_candidates(db, next_tweets_queries[bool(latest)], max_friends=max_friends,
+        max_followers=max_followers, limit=limit)
 
 
-def whoNext(job, latest=False):
-    """Find the next user to retrieve friends, followers or tweets, closest to the initial seed of the network."""
+def nextUsers(db, job, latest=False):
+    """Return the users that need their friends, followers or tweets retrieved, closest to the initial seed first."""
     if job == 'friends':
         victim_getter = nextFriends
 
@@ -124,71 +78,43 @@ def whoNext(job, latest=False):
     if job == 'tweets':
         victim_getter = nextTweets
 
-    victim_list = False
-    while not victim_list:
-        try:
-            victim_list = victim_getter(latest=latest)
-        except:
-            pass
-
-    return victim_list[0]
-
-
-def nextNearest(db, user, job, root_task, max_friends=2000, max_followers=2000, limit=20, max_tweets=2000, test=False):
-    """Find the next user to retrieve friends, followers or tweets, closest to a given user."""
-    cacheKey = '_'.join(['nextnearest', job, user, root_task])
-    nextUserDump = cache.get(cacheKey).decode('utf-8')
-    next_users = False
-    if nextUserDump:
-        try:
-            next_users = json.loads(nextUserDump)
-        except:
-            next_users = []
-    if next_users:
-        logging.info('*** NEXT '+job+': '+', '.join(next_users)+' from '+user+' ***')
-        next_user = next_users.pop(0)
-        cache.set(cacheKey, json.dumps(next_users))
-        return next_user
+    try:
+        return victim_getter(db, latest=latest)
+    except:
+        return []
 
-    query_str = "MATCH (a:twitter_user {{screen_name: '{}'}})-[:FOLLOWS]-(d:twitter_user)".format(user)
-    query_str += ' MATCH (b:twitter_user)-[:FOLLOWS]-(d) WITH DISTINCT b '
-    if job == 'friends':
-        query_str += 'MATCH (b)-[:FOLLOWS]->(c:twitter_user) '
-    if job == 'followers':
-        query_str += 'MATCH (b)<-[:FOLLOWS]-(c:twitter_user) '
-    if job == 'tweets':
-        query_str += 'MATCH (b)-[:TWEETED]->(c:tweet) '
-    query_str += 'WITH b, COUNT(c) AS n '
-    query_str += 'WHERE b.friends_count < {} AND b.followers_count < {} ' \
-                 'AND NOT EXISTS (b.protected) AND NOT EXISTS (b.defunct) '.format(max_friends, max_followers)
-    if job == 'friends':
-        query_str += 'AND n < b.friends_count/2 '
-    if job == 'followers':
-        query_str += 'AND n < b.followers_count/2 '
-    if job == 'tweets':
-        query_str += 'AND b.statuses_count > 0 AND n < b.statuses_count/2 AND n<{} '.format(max_tweets)
-    query_str += 'RETURN b.screen_name ORDER BY b.{}_last_scraped LIMIT {}'.format(job, limit)
 
-    logging.info('*** Looking for '+job+' for '+user+' ***')
+def nextFromFrontier(job, latest=False):
+    """Take the next user to retrieve friends, followers or tweets from the crawl frontier, or None if it's empty.
 
-    if test:
-        return query_str
+    An empty frontier is topped up from the graph every so often, to catch users it doesn't know about.
+    """
+    victim_list = take_from_frontier(job, latest=latest)
+    if not victim_list and refill_frontier(job, lambda: nextUsers(neo_driver(), job, latest=latest)):
+        victim_list = take_from_frontier(job, latest=latest)
+
+    return victim_list[0] if victim_list else None
+
+
+def whoNext(job, latest=False, timeout=30):
+    """Find the next user to retrieve friends, followers or tweets, closest to the initial seed of the network.
+
+    Waits up to <timeout> seconds for one to be found, returns None if there still isn't one.
+    """
+    victim = nextFromFrontier(job, latest=latest)
+    if victim is None and wait_for_frontier([job], timeout=timeout):
+        victim = nextFromFrontier(job, latest=latest)
+
+    return victim
 
-    query = query_str
-    try:
-        with db.session() as session:
-            with session.begin_transaction() as tx:
-                result = tx.run(query)
-                next_users = [record.values()[0] for record in result]
-    except:
-        next_users = []
 
-    if next_users:
-        logging.info('*** NEXT '+job+': '+', '.join(next_users)+' from '+user+' ***')
-        next_user = next_users.pop(0)
-        cache.set(cacheKey, json.dumps(next_users))
+def nextNearest(user, job, root_task):
+    """Find the next user to retrieve friends, followers or tweets, closest to a given user, or False if there
+    isn't one."""
+    next_user = next_in_rings(job, root_task)
+    if next_user:
+        logging.info('*** NEXT '+job+': '+next_user+' from '+user+' ***')
         return next_user
-    else:
-        logging.info('No more '+job+' for '+user)
 
+    logging.info('No more '+job+' for '+user)
     return False
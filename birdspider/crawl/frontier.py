@@ -0,0 +1,137 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""
+The crawl frontier: the users waiting to have their friends, followers or tweets fetched by the default scrape.
+
+There's a Redis sorted set for each job, scored by the time the user was first written, so the default scrape takes
+users in the order they were found, (or the newest first). The graph writers add users as they store them, so
+choosing the next user is a pop rather than a query over the whole graph. Users that have been taken are kept in a
+set for each job, so writing them again doesn't put them back.
+"""
+
+import logging
+import time
+
+from db_settings import cache
+
+frontier_prefix = 'crawl_frontier_'
+taken_prefix = 'crawl_taken_'
+refill_key = 'crawl_frontier_refilled'
+
+frontier_jobs = ['friends', 'followers', 'tweets']
+
+# Users with more friends or followers than this are supernodes, and aren't crawled.
+max_friends = 2000
+max_followers = 2000
+
+# Each job needs a user to have something to fetch.
+job_counts = {'friends': 'friends_count', 'followers': 'followers_count', 'tweets': 'statuses_count'}
+
+add_users = cache.register_script("""
+local added = 0
+for i = 1, #ARGV, 2 do
+    if redis.call('SISMEMBER', KEYS[2], ARGV[i + 1]) == 0 then
+        added = added + redis.call('ZADD', KEYS[1], 'NX', ARGV[i], ARGV[i + 1])
+    end
+end
+return added
+""")
+
+take_users = cache.register_script("""
+local users
+if ARGV[2] == '1' then
+    users = redis.call('ZREVRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+else
+    users = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+end
+if #users > 0 then
+    redis.call('ZREM', KEYS[1], unpack(users))
+    redis.call('SADD', KEYS[2], unpack(users))
+end
+return users
+""")
+
+
+def frontier_key(job):
+    return frontier_prefix + job
+
+
+def taken_key(job):
+    return taken_prefix + job
+
+
+def crawlable(twit, job):
+    """Whether a rendered Twitter user belongs in the frontier for the job."""
+    return (twit.get('screen_name', False) and twit.get(job_counts[job], 0) > 0
+        and twit.get('friends_count', 0) < max_friends and twit.get('followers_count', 0) < max_followers
+        and not twit.get('protected', False) and not twit.get('defunct', False))
+
+
+def add_to_frontier(renderedTwits):
+    """Add rendered Twitter users that have just been written to the frontiers of the jobs they need."""
+    score = time.time()
+    renderedTwits = list(renderedTwits)
+    pipe = cache.pipeline()
+    for job in frontier_jobs:
+        args = []
+        for twit in renderedTwits:
+            if crawlable(twit, job):
+                args.extend([score, twit['screen_name']])
+        if args:
+            add_users(keys=[frontier_key(job), taken_key(job)], args=args, client=pipe)
+    pipe.execute()
+
+
+def take_from_frontier(job, latest=False, count=1):
+    """Pop the next users for the job, oldest first unless <latest>. Returns a list of screen_names."""
+    users = take_users(keys=[frontier_key(job), taken_key(job)], args=[count, '1' if latest else '0'])
+    return [user.decode('utf-8') for user in users]
+
+
+def wait_for_frontier(jobs, timeout=30):
+    """Block until one of the job's frontiers has a user in it, or <timeout> seconds pass. True if one does."""
+    popped = cache.bzpopmin([frontier_key(job) for job in jobs], timeout=timeout)
+    if not popped:
+        return False
+    key, user, score = popped
+    # Only waiting, so put the user back where it was.
+    cache.zadd(key, {user: score}, nx=True)
+    return True
+
+
+def drop_from_frontier(user):
+    """Take a user out of every frontier, such as when their account has gone."""
+    pipe = cache.pipeline()
+    for job in frontier_jobs:
+        pipe.zrem(frontier_key(job), user)
+    pipe.execute()
+
+
+def refill_frontier(job, candidates, interval=300):
+    """Add users found by a graph query to the job's frontier, at most once every <interval> seconds.
+
+    This picks up users written before the frontier existed, or taken by jobs that never finished.
+    """
+    if not cache.set(refill_key + '_' + job, 'true', nx=True, ex=interval):
+        return 0
+    users = candidates()
+    if not users:
+        return 0
+    args = []
+    score = time.time()
+    for user in users:
+        args.extend([score, user])
+    # Users found by the query still need fetching, even if they were taken before.
+    pipe = cache.pipeline()
+    pipe.srem(taken_key(job), *users)
+    add_users(keys=[frontier_key(job), taken_key(job)], args=args, client=pipe)
+    added = pipe.execute()[-1]
+    logging.info('*** REFILLED %s FRONTIER WITH %d USERS ***' % (job.upper(), added))
+    return added
+
+
+def frontier_sizes():
+    """The number of users waiting in each frontier."""
+    pipe = cache.pipeline()
+    for job in frontier_jobs:
+        pipe.zcard(frontier_key(job))
+    return dict(zip(frontier_jobs, pipe.execute()))
@@ -0,0 +1,149 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""
+Leases on the slots of a scrape's crawl lanes, and on fetching each user's timeline, friends or followers.
+
+A slot is marked as running with a key that expires after LANE_LEASE seconds, and the user it was given is kept in a
+Redis hash for the scrape. The job fetching the user renews the lease after every page. If its worker dies, the lease
+runs out while the user is still in the hash, so the next time the scrape runs it hands the same user to the slot
+again, and the new job carries on from the paging checkpoint of the old one.
+
+Fetch leases are shared by every crawl. Whichever job takes the lease on a user's job fetches it, and when it's done
+the lease is kept as 'fresh' for FETCH_FRESHNESS seconds, so overlapping scrapes don't spend their rate limits
+fetching the same users again.
+"""
+
+from db_settings import cache
+from twitter_settings import FETCH_FRESHNESS, LANE_LEASE
+
+claim = cache.register_script("""
+local state = redis.call('GET', KEYS[1])
+if state == 'running' then
+    return {0, ''}
+end
+local abandoned = false
+if not state then
+    abandoned = redis.call('HGET', KEYS[2], KEYS[1])
+end
+if ARGV[2] == '1' and not abandoned then
+    return {0, ''}
+end
+redis.call('SET', KEYS[1], 'running', 'EX', ARGV[1])
+return {1, abandoned or ''}
+""")
+
+renew = cache.register_script("""
+if redis.call('GET', KEYS[1]) == 'running' then
+    return redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return 0
+""")
+
+release = cache.register_script("""
+local user = redis.call('HGET', KEYS[2], KEYS[1])
+if user and user ~= ARGV[1] then
+    return 0
+end
+redis.call('HDEL', KEYS[2], KEYS[1])
+redis.call('SET', KEYS[1], 'done')
+return 1
+""")
+
+
+take_fetch = cache.register_script("""
+local held = redis.call('GET', KEYS[1])
+if held == 'fresh' then
+    return 'fresh'
+end
+if held and held ~= ARGV[1] then
+    return 'fetching'
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 'acquired'
+""")
+
+renew_fetch = cache.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+""")
+
+settle_fetch = cache.register_script("""
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('SET', KEYS[1], 'fresh', 'EX', ARGV[2])
+else
+    redis.call('DEL', KEYS[1])
+end
+return 1
+""")
+
+
+def slot_users_key(root_id):
+    return 'scrape_slots_' + root_id
+
+
+def claim_slot(key, root_id, abandoned_only=False):
+    """Lease a lane's slot if it's idle, or its last lease ran out before the job finished.
+
+    Returns (claimed, user), where user is the screen_name the abandoned job was fetching, or None.
+
+    Keyword arguments:
+    abandoned_only -- only claim the slot to hand out an abandoned user again
+    """
+    claimed, user = claim(keys=[key, slot_users_key(root_id)], args=[LANE_LEASE, '1' if abandoned_only else '0'])
+    return bool(claimed), user.decode('utf-8') if user else None
+
+
+def assign_slot(key, root_id, user):
+    """Record the user a leased slot is fetching, so it can be handed out again if the job is lost."""
+    cache.hset(slot_users_key(root_id), key, user)
+
+
+def renew_lease(key, ttl=LANE_LEASE):
+    """Extend a running slot's lease by <ttl> seconds. Does nothing if the job doesn't belong to a lane."""
+    if key:
+        renew(keys=[key], args=[ttl])
+
+
+def release_slot(key, root_id, user):
+    """Mark a slot as done, unless it's already been handed to another user. True if it was released."""
+    return bool(release(keys=[key, slot_users_key(root_id)], args=[user]))
+
+
+def slots_in_use(root_id):
+    """The number of the scrape's slots with a user that hasn't been finished, whether or not their lease is live."""
+    return cache.hlen(slot_users_key(root_id))
+
+
+class FetchLease(object):
+    """The lease on fetching one of a user's jobs, ('tweets', 'friends' or 'followers') shared by every crawl."""
+
+    def __init__(self, job, user, owner):
+        """
+        Positional arguments:
+        job -- what's being fetched
+        user -- the screen_name of the user it's fetched for
+        owner -- identifies the fetch, so it can take the lease again when it's retried or resumed
+        """
+        self.key = '_'.join(['fetch_lease', job, user])
+        self.owner = owner
+
+    def acquire(self):
+        """Take the lease. Returns 'acquired', or 'fetching' if another job holds it, or 'fresh' if it was fetched
+        within the last FETCH_FRESHNESS seconds.
+        """
+        return take_fetch(keys=[self.key], args=[self.owner, LANE_LEASE]).decode('utf-8')
+
+    def renew(self, ttl=LANE_LEASE):
+        renew_fetch(keys=[self.key], args=[self.owner, ttl])
+
+    def finish(self):
+        """The fetch is done, so keep it fresh."""
+        settle_fetch(keys=[self.key], args=[self.owner, FETCH_FRESHNESS])
+
+    def release(self):
+        """The fetch failed, so let another job have a go."""
+        settle_fetch(keys=[self.key], args=[self.owner, 0])
@@ -0,0 +1,131 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""
+Distance rings for user scrapes.
+
+Each user scrape keeps the distance from its seed of every user it has found, in a Redis hash, and a sorted set for
+each job scored by distance, so the nearest users are crawled first, ring by ring. The seed's neighbours are looked
+up in the graph once, when the scrape starts. After that, the rings grow as each user's connections are pushed: any
+connection the scrape hasn't seen before is one further from the seed than that user.
+
+Connections fetched by id that aren't in the graph yet have no screen_name, so each one's connecting user is kept
+until it's been looked up, then it joins the rings one further out than them.
+"""
+
+from crawl.frontier import crawlable, frontier_jobs
+from cypher_queries import seed_neighbours_query
+from db_settings import cache
+
+active_key = 'crawl_ring_scrapes'
+via_key = 'crawl_ring_via'
+
+extend = cache.register_script("""
+local distance = redis.call('HGET', KEYS[1], ARGV[1])
+if not distance then
+    return 0
+end
+distance = tonumber(distance) + 1
+local added = 0
+for i = 2, #ARGV, 2 do
+    if redis.call('HSETNX', KEYS[1], ARGV[i], distance) == 1 then
+        added = added + 1
+        for j = 1, #ARGV[i + 1] do
+            if string.sub(ARGV[i + 1], j, j) == '1' then
+                redis.call('ZADD', KEYS[j + 1], distance, ARGV[i])
+            end
+        end
+    end
+end
+return added
+""")
+
+
+def distance_key(root_id):
+    return 'crawl_distance_' + root_id
+
+
+def ring_key(job, root_id):
+    return '_'.join(['crawl_ring', job, root_id])
+
+
+def ring_keys(root_id):
+    return [distance_key(root_id)] + [ring_key(job, root_id) for job in frontier_jobs]
+
+
+def extend_rings(user, renderedTwits, root_ids=None):
+    """Put connections of <user> that are new to any of the running user scrapes in the next ring out.
+
+    Positional arguments:
+    user -- the screen_name of the user whose connections these are
+    renderedTwits -- the rendered Twitter users they're connected to
+    """
+    if root_ids is None:
+        root_ids = [root_id.decode('utf-8') for root_id in cache.smembers(active_key)]
+    args = [user]
+    for twit in renderedTwits:
+        if twit.get('screen_name', False):
+            args.extend([twit['screen_name'], ''.join('1' if crawlable(twit, job) else '0' for job in frontier_jobs)])
+    if len(args) == 1 or not root_ids:
+        return
+    pipe = cache.pipeline()
+    for root_id in root_ids:
+        extend(keys=ring_keys(root_id), args=args, client=pipe)
+    pipe.execute()
+
+
+def await_hydration(user, ids):
+    """Remember that users known only by their ids are connections of <user>, while any user scrapes are running."""
+    if not ids or not cache.scard(active_key):
+        return
+    pipe = cache.pipeline()
+    for user_id in ids:
+        pipe.hset(via_key, str(user_id), user)
+    pipe.execute()
+
+
+def extend_hydrated(ids, renderedTwits=()):
+    """Put users that have just been looked up by id into the rings, beside the users they're connections of.
+
+    Positional arguments:
+    ids -- the ids that were looked up, whether they were found or not
+    renderedTwits -- the rendered Twitter users that were found
+    """
+    ids = [str(user_id) for user_id in ids]
+    if not ids:
+        return
+    pipe = cache.pipeline()
+    pipe.hmget(via_key, ids)
+    pipe.hdel(via_key, *ids)
+    via = dict(zip(ids, pipe.execute()[0]))
+    connections = {}
+    for twit in renderedTwits:
+        user = via.get(str(twit.get('id_str', twit.get('id', ''))))
+        if user:
+            connections.setdefault(user.decode('utf-8'), []).append(twit)
+    for user, twits in connections.items():
+        extend_rings(user, twits)
+
+
+def start_rings(db, user, root_id):
+    """Start a user scrape's rings with its seed, and the seed's neighbours from the graph."""
+    pipe = cache.pipeline()
+    pipe.delete(*ring_keys(root_id))
+    pipe.hset(distance_key(root_id), user, 0)
+    pipe.sadd(active_key, root_id)
+    pipe.execute()
+
+    with db.session() as session:
+        neighbours = [record.values()[0] for record in session.run(seed_neighbours_query, user=user)]
+    extend_rings(user, neighbours, root_ids=[root_id])
+
+
+def stop_rings(root_id):
+    pipe = cache.pipeline()
+    pipe.srem(active_key, root_id)
+    pipe.delete(*ring_keys(root_id))
+    pipe.execute()
+
+
+def next_in_rings(job, root_id):
+    """Pop the nearest user still to be crawled for the job, or None if the rings are empty."""
+    popped = cache.zpopmin(ring_key(job, root_id))
+    return popped[0][0].decode('utf-8') if popped else None
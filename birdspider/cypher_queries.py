@@ -0,0 +1,221 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""
+Every Cypher query used by the graph writers, crawl and clustering, built once at import.
+
+Values are always passed as parameters, never formatted into the query text, so that each query has exactly one
+text and Neo4j can plan it once and reuse the plan from its cache. Labels and relationship types can't be
+parameters, so queries that vary by them are stored in dictionaries keyed by label, one text per label.
+"""
+
+tweet_labels = ['tweet', 'retweet', 'quotetweet']
+tweet_actions = {'tweet': 'TWEETED', 'retweet': 'RETWEETED', 'quotetweet': 'QUOTED'}
+
+entity_types = ['hashtags', 'urls', 'media']
+entity_node_labels = {'hashtags': 'hashtag', 'urls': 'url', 'media': 'media'}
+entity_ids = {'hashtags': 'text', 'urls': 'expanded_url', 'media': 'id_str'}
+entity_relations = {'hashtags': 'TAGGED', 'urls': 'LINKS_TO', 'media': 'EMBEDS'}
+
+crawl_jobs = ['friends', 'followers', 'tweets']
+
+
+def unwind_query(*clauses):
+    return '\n'.join(['UNWIND $data AS d'] + list(clauses))
+
+
+# Each twitter_user counts its FOLLOWS relationships and tweets in the graph, and keeps flags of whether it still needs
+# its friends, followers or tweets fetching, so the crawl can find them by seeking an index on the flag, rather than
+# comparing properties of every user or counting relationships.
+degree_counters = ['friends_in_graph', 'followers_in_graph', 'tweets_in_graph']
+
+crawl_flags = {
+    'needs_friends': 'coalesce({0}.friends_in_graph, 0) < {0}.friends_count/2',
+    'needs_followers': 'coalesce({0}.followers_in_graph, 0) < {0}.followers_count/2',
+    'needs_tweets': 'coalesce({0}.tweets_in_graph, 0) = 0 AND {0}.statuses_count > 0'}
+
+
+def new_user_counters(node):
+    return 'ON CREATE SET ' + ', '.join('{}.{} = 0'.format(node, counter) for counter in degree_counters)
+
+
+def count_up(node, counter):
+    return '{0}.{1} = coalesce({0}.{1}, 0) + 1'.format(node, counter)
+
+
+def flag_updates(node, *flags):
+    """Assignments of <node>'s crawl flags, (all of them by default) from its counters and counts.
+
+    They go in a SET clause of their own, after the one that changes the counters or counts.
+    """
+    return ', '.join('{}.{} = {}'.format(node, flag, crawl_flags[flag].format(node))
+        for flag in flags or sorted(crawl_flags))
+
+
+def merge_follows(friends, user='t', other='f'):
+    """MERGE <user> following <other>, (or the other way round) and count the relationship if it's new."""
+    follower, followed = (user, other) if friends else (other, user)
+    return 'MERGE ({})-[:FOLLOWS]->({}) ON CREATE SET {}, {} SET {}, {}'.format(follower, followed,
+        count_up(follower, 'friends_in_graph'), count_up(followed, 'followers_in_graph'),
+        flag_updates(follower, 'needs_friends'), flag_updates(followed, 'needs_followers'))
+
+
+def merge_tweet_action(label, user='u', tweet='t'):
+    return 'MERGE ({})-[:{}]->({}) ON CREATE SET {} SET {}'.format(user, tweet_actions[label], tweet,
+        count_up(user, 'tweets_in_graph'), flag_updates(user, 'needs_tweets'))
+
+
+# Graph writers.
+
+# Users with an id are MERGEd on it, so one that's changed their screen_name keeps the same node, as does one only
+# known by id, (from the friends/ids or followers/ids endpoints). If another node holds the screen_name, it's adopted
+# when it has no id and there's no node with this one, otherwise its screen_name has passed to this user, so it
+# loses it. Users without an id, in $unidentified, are MERGEd on their screen_name.
+users_query = unwind_query('OPTIONAL MATCH (s:twitter_user {id: d.id})',
+    'OPTIONAL MATCH (o:twitter_user {screen_name: d.screen_name}) WHERE o.id IS NULL OR o.id <> d.id',
+    'WITH d, o, s IS NULL AND o IS NOT NULL AND o.id IS NULL AS adopt',
+    'FOREACH (n IN CASE WHEN adopt THEN [o] ELSE [] END | SET n.id = d.id)',
+    'FOREACH (n IN CASE WHEN o IS NOT NULL AND NOT adopt THEN [o] ELSE [] END | REMOVE n.screen_name)',
+    'WITH d', 'MERGE (x:twitter_user {id: d.id})', new_user_counters('x'), 'SET x += d.props',
+    'SET ' + flag_updates('x'),
+    'WITH count(*) AS merged', 'UNWIND $unidentified AS d',
+    'MERGE (x:twitter_user {screen_name: d.screen_name})', new_user_counters('x'), 'SET x += d.props',
+    'SET ' + flag_updates('x'))
+
+connections_scraped_queries = {
+    friends: '\n'.join(['MATCH (t:twitter_user {screen_name: $user})',
+        'SET t.{}_last_scraped = $right_now'.format('friends' if friends else 'followers')])
+    for friends in [True, False]}
+
+connections_queries = {
+    friends: unwind_query('MATCH (t:twitter_user {screen_name: $user}), (f:twitter_user {screen_name: d.screen_name})',
+        merge_follows(friends))
+    for friends in [True, False]}
+
+multi_user_connections_scraped_queries = {
+    friends: unwind_query('MATCH (t:twitter_user {screen_name: d.user})',
+        'SET t.{}_last_scraped = d.right_now'.format('friends' if friends else 'followers'))
+    for friends in [True, False]}
+
+multi_user_connections_queries = {
+    friends: unwind_query('MATCH (t:twitter_user {screen_name: d.user}), (f:twitter_user {screen_name: d.screen_name})',
+        merge_follows(friends))
+    for friends in [True, False]}
+
+connection_ids_queries = {
+    friends: unwind_query('MATCH (t:twitter_user {screen_name: $user})', 'MERGE (f:twitter_user {id: d})',
+        new_user_counters('f'), merge_follows(friends),
+        'RETURN f.id, CASE WHEN f.screen_name IS NULL THEN null ELSE properties(f) END')
+    for friends in [True, False]}
+
+user_counts_query = 'MATCH (t:twitter_user {screen_name: $user}) RETURN t.friends_count, t.followers_count'
+
+tweets_queries = {label: unwind_query('MERGE (x:{} {{id: d.id}})'.format(label), 'SET x += d.props')
+    for label in tweet_labels}
+
+tweet_actions_queries = {
+    label: unwind_query('MATCH (u:twitter_user {{screen_name: $user}}), (t:{} {{id_str: d.id_str}})'.format(label),
+        merge_tweet_action(label))
+    for label in tweet_labels}
+
+multi_user_tweet_actions_queries = {
+    label: unwind_query(
+        'MATCH (u:twitter_user {{screen_name: d.screen_name}}), (t:{} {{id_str: d.id_str}})'.format(label),
+        merge_tweet_action(label))
+    for label in tweet_labels}
+
+tweet_links_queries = {
+    (src_label, relation): unwind_query(
+        'MATCH (src:{} {{id_str: d.src_id_str}}), (dest:tweet {{id_str: d.dest_id_str}})'.format(src_label),
+        'MERGE (src)-[:{}]->(dest)'.format(relation))
+    for src_label, relation in [('retweet', 'RETWEET_OF'), ('quotetweet', 'QUOTE_OF')]}
+
+entities_queries = {
+    entity_type: unwind_query('MERGE (x:{} {{id: d.id}})'.format(entity_node_labels[entity_type]), 'SET x += d.props')
+    for entity_type in entity_types}
+
+mentions_queries = {
+    label: unwind_query('MATCH (src:{} {{id_str: d.src}}), (dest:twitter_user {{screen_name: d.dest}})'.format(label),
+        'MERGE (src)-[:MENTIONS]->(dest)')
+    for label in tweet_labels}
+
+entity_links_queries = {
+    (label, entity_type): unwind_query('MATCH (src:{} {{id_str: d.src}}), (dest:{} {{{}: d.dest}})'.format(
+        label, entity_node_labels[entity_type], entity_ids[entity_type]),
+        'MERGE (src)-[:{}]->(dest)'.format(entity_relations[entity_type]))
+    for label in tweet_labels for entity_type in entity_types}
+
+set_user_defunct_query = 'MATCH (t:twitter_user {screen_name: $user}) SET t.defunct = true'
+
+# Count the relationships of users written before the counters were kept, and set their crawl flags, a batch at a time
+# in order of their ids, (found with a seek on the id constraint's index).
+backfill_degrees_query = '''MATCH (a:twitter_user) WHERE a.id > $after
+    WITH a ORDER BY a.id LIMIT $batch_size
+    SET a.friends_in_graph = size((a)-[:FOLLOWS]->(:twitter_user)),
+        a.followers_in_graph = size((a)<-[:FOLLOWS]-(:twitter_user)),
+        a.tweets_in_graph = size((a)-[:TWEETED|RETWEETED|QUOTED]->())
+    SET {}
+    RETURN count(a), max(a.id)'''.format(flag_updates('a'))
+
+
+# Crawl.
+
+create_crawl_query = '''CREATE (a:crawl {timestamp: $timestamp, crawl_task: $crawl_task, status: $status})
+    RETURN id(a)'''
+
+crawl_centred_on_query = '''MATCH (c:crawl), (t:twitter_user {screen_name: $user}) WHERE ID(c) = $crawl_id
+    MERGE (c)-[:CENTRED_ON]->(t)'''
+
+update_crawl_query = '''MATCH (c:crawl {crawl_task: $crawl_task})
+    SET c.status = $status, c.timestamp = $right_now'''
+
+next_friends_queries = {latest: """MATCH (a:twitter_user) WHERE a.needs_friends = true
+    AND a.friends_count < $max_friends AND a.followers_count < $max_followers
+    AND NOT EXISTS (a.protected) AND NOT EXISTS (a.defunct)
+    RETURN a.screen_name
+    ORDER BY a.last_scraped {} LIMIT $limit""".format('DESC' if latest else '')
+    for latest in [True, False]}
+
+next_followers_queries = {latest: """MATCH (a:twitter_user) WHERE a.needs_followers = true
+    AND a.followers_count < $max_followers AND a.friends_count < $max_friends
+    AND NOT EXISTS (a.protected) AND NOT EXISTS (a.defunct)
+    RETURN a.screen_name
+    ORDER BY a.last_scraped {} LIMIT $limit""".format('DESC' if latest else '')
+    for latest in [True, False]}
+
+next_tweets_queries = {latest: """MATCH (a:twitter_user) WHERE a.needs_tweets = true
+    AND a.followers_count < $max_followers AND a.friends_count < $max_friends
+    AND NOT EXISTS (a.protected) AND NOT EXISTS (a.defunct)
+    RETURN a.screen_name
+    ORDER BY a.last_scraped {} LIMIT $limit""".format('DESC' if latest else '')
+    for latest in [True, False]}
+
+seed_neighbours_query = '''MATCH (a:twitter_user {screen_name: $user})-[:FOLLOWS]-(d:twitter_user)
+    RETURN DISTINCT properties(d)'''
+
+
+# Clustering.
+
+fof_query = """MATCH (a:twitter_user {screen_name: $screen_name})-[:FOLLOWS]->(b:twitter_user) WITH b
+    MATCH (c:twitter_user)-[:FOLLOWS]->(b:twitter_user) WITH DISTINCT c
+    MATCH (c)-[:FOLLOWS]->(d:twitter_user) RETURN DISTINCT c.screen_name,COLLECT(d.screen_name)"""
+
+trans_fof_query = """MATCH (a:twitter_user {screen_name: $screen_name})-[:FOLLOWS]->(b:twitter_user)-[:FOLLOWS]->(a)
+    WITH b
+    MATCH (c:twitter_user)-[:FOLLOWS]->(b:twitter_user)-[:FOLLOWS]->(c)
+    RETURN DISTINCT b.screen_name,COLLECT(c.screen_name)"""
+
+create_clustering_query = '''CREATE (a:clustering {timestamp: $timestamp, adjacency_criteria: $adjacency_criteria})
+    RETURN id(a)'''
+
+clustering_seed_types = {'twitter_user': 'screen_name'}
+
+seed_for_queries = {
+    (seed_type, seed_id_label): unwind_query(
+        'MATCH (c:clustering), (s:{} {{{}: d}}) WHERE ID(c) = $clustering_id'.format(seed_type, seed_id_label),
+        'MERGE (s)-[:SEED_FOR]->(c)')
+    for seed_type, seed_id_label in clustering_seed_types.items()}
+
+create_cluster_query = '''MATCH (a:clustering) WHERE ID(a) = $clustering_id
+    CREATE (b:cluster {size: $size})-[:CLUSTERED_BY]->(a) RETURN id(b)'''
+
+cluster_members_query = unwind_query('MATCH (m:twitter_user {screen_name: d}), (c:cluster) WHERE ID(c) = $cluster_id',
+    'MERGE (m)-[:MEMBER_OF]->(c)')
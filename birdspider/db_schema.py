@@ -0,0 +1,180 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""Uniqueness constraints and indexes for every property the graph writers MERGE or MATCH on."""
+
+import logging
+
+from cypher_queries import backfill_degrees_query, next_followers_queries, next_friends_queries, next_tweets_queries
+from twitter_tools.neo import connections_statements, tweet_dump_statements
+
+"""
+(label, property) pairs that MERGE keys on. Each gets a uniqueness constraint, which is backed by an index.
+"""
+schema_constraints = [('twitter_user', 'screen_name'), ('twitter_user', 'id'), ('tweet', 'id'), ('retweet', 'id'),
+    ('quotetweet', 'id'), ('hashtag', 'id'), ('url', 'id'), ('media', 'id')]
+
+"""
+(label, property) pairs that are only MATCHed on, which just need a plain index.
+"""
+schema_indexes = [('tweet', 'id_str'), ('retweet', 'id_str'), ('quotetweet', 'id_str'),
+    ('hashtag', 'text'), ('url', 'expanded_url'), ('media', 'id_str'), ('crawl', 'crawl_task')]
+
+"""
+(label, property) pairs that the crawl selects users by: flags of whether they still need fetching, and their counts.
+"""
+crawl_indexes = [('twitter_user', 'needs_friends'), ('twitter_user', 'needs_followers'),
+    ('twitter_user', 'needs_tweets'), ('twitter_user', 'friends_count'), ('twitter_user', 'followers_count')]
+
+"""
+(label, property) pairs that used to have a plain index, which has to go before they can have a constraint. The index
+is only swapped for the constraint once no two nodes share a value, and comes back if the constraint can't be made.
+"""
+retired_indexes = [('twitter_user', 'id')]
+
+scan_operators = ('NodeByLabelScan', 'AllNodesScan')
+
+
+def schema_name(kind, label, prop):
+    return '_'.join([kind, label, prop])
+
+
+def constraint_query(label, prop):
+    return 'CREATE CONSTRAINT {} IF NOT EXISTS ON (n:{}) ASSERT n.{} IS UNIQUE'.format(
+        schema_name('unique', label, prop), label, prop)
+
+
+def index_query(label, prop):
+    return 'CREATE INDEX {} IF NOT EXISTS FOR (n:{}) ON (n.{})'.format(
+        schema_name('index', label, prop), label, prop)
+
+
+def drop_index_query(label, prop):
+    return 'DROP INDEX {} IF EXISTS'.format(schema_name('index', label, prop))
+
+
+def duplicates_query(label, prop):
+    return ('MATCH (n:{0}) WHERE n.{1} IS NOT NULL WITH n.{1} AS key, count(*) AS nodes WHERE nodes > 1 '
+        'RETURN count(key)').format(label, prop)
+
+
+def retire_index(session, label, prop):
+    """Swap a retired index for a uniqueness constraint. Returns the number of schema commands that failed."""
+    name = schema_name('index', label, prop)
+    if not session.run('CALL db.indexes() YIELD name WHERE name = $name RETURN name', name=name).single():
+        return 0
+    duplicates = session.run(duplicates_query(label, prop)).single().value()
+    if duplicates:
+        logging.error('*** %d VALUES OF %s.%s ARE SHARED BY SEVERAL NODES, KEEPING %s ***' %
+            (duplicates, label, prop, name))
+        return 1
+    session.run(drop_index_query(label, prop)).consume()
+    try:
+        session.run(constraint_query(label, prop)).consume()
+    except:
+        logging.error('*** COULD NOT CREATE %s, RESTORING %s ***' % (schema_name('unique', label, prop), name),
+            exc_info=True)
+        session.run(index_query(label, prop)).consume()
+        return 1
+    return 0
+
+
+def ensure_schema(db):
+    """Idempotently create the constraints and indexes. Returns the number of schema commands that failed."""
+    failures = 0
+    with db.session() as session:
+        kept = []
+        for key in retired_indexes:
+            try:
+                failed = retire_index(session, *key)
+            except:
+                logging.error('*** COULD NOT RETIRE INDEX ON %s ***' % '.'.join(key), exc_info=True)
+                failed = 1
+            failures += failed
+            if failed:
+                kept.append(key)
+        # Until its index is retired, a key can't have a constraint.
+        queries = ([constraint_query(*key) for key in schema_constraints if key not in kept] +
+            [index_query(*key) for key in schema_indexes + crawl_indexes])
+        for query in queries:
+            # Schema commands can't share a transaction with each other, so run each one on its own.
+            try:
+                session.run(query).consume()
+            except:
+                logging.error('*** SCHEMA COMMAND FAILED: %s ***' % query, exc_info=True)
+                failures += 1
+    logging.info('*** ENSURED %d NEO CONSTRAINTS AND INDEXES, %d FAILED ***' % (len(queries), failures))
+    return failures
+
+
+def offline_indexes(db, timeout=300):
+    """Wait for the indexes to come online, return the (label, property) pairs that still aren't."""
+    with db.session() as session:
+        try:
+            session.run('CALL db.awaitIndexes($timeout)', timeout=timeout).consume()
+        except:
+            logging.warning('*** TIMED OUT WAITING FOR NEO INDEXES ***', exc_info=True)
+        result = session.run('CALL db.indexes() YIELD labelsOrTypes, properties, state')
+        online = set((record['labelsOrTypes'][0], record['properties'][0]) for record in result
+            if record['state'] == 'ONLINE' and record['labelsOrTypes'] and len(record['properties']) == 1)
+
+    return [key for key in schema_constraints + schema_indexes + crawl_indexes if key not in online]
+
+
+def sample_statements():
+    """Representative statements from each of the graph writers, with one row of placeholder data."""
+    tweet = {'id': 1, 'id_str': '1'}
+    user = {'screen_name': 'birdspider', 'id': 1, 'id_str': '1'}
+    entities = {'user_mentions': [('1', dict(user))], 'hashtags': [('1', {'text': 'birdspider'})],
+        'urls': [('1', {'expanded_url': 'birdspider'})], 'media': [('1', {'id_str': '1'})]}
+    labels = ['tweet', 'retweet', 'quotetweet']
+    tweet_dump = {label: [(dict(tweet), 'birdspider', dict(tweet))] for label in labels}
+    tweet_dump['entities'] = {label: entities for label in labels}
+    tweet_dump['users'] = {'1': dict(user)}
+
+    return (tweet_dump_statements(tweet_dump, user='birdspider') + tweet_dump_statements(tweet_dump) +
+        connections_statements('birdspider', [dict(user)]))
+
+
+def crawl_statements():
+    """The crawl's selection queries and the counter backfill, with placeholder parameters."""
+    params = {'max_friends': 2000, 'max_followers': 2000, 'limit': 20}
+    return ([(queries[latest], params) for queries in [next_friends_queries, next_followers_queries,
+        next_tweets_queries] for latest in [True, False]] +
+        [(backfill_degrees_query, {'after': -1, 'batch_size': 10000})])
+
+
+def plan_operators(plan):
+    yield plan.get('operatorType', '')
+    for child in plan.get('children', []):
+        for operator in plan_operators(child):
+            yield operator
+
+
+def label_scans(db, statements=None):
+    """EXPLAIN the write and crawl queries, return those that still plan a label or all-nodes scan."""
+    if statements is None:
+        statements = sample_statements() + crawl_statements()
+    scanning = {}
+    with db.session() as session:
+        for query, params in statements:
+            if query in scanning:
+                continue
+            plan = session.run('EXPLAIN ' + query, **params).consume().plan
+            if plan and any(op.split('@')[0] in scan_operators for op in plan_operators(plan)):
+                scanning[query] = True
+                logging.warning('*** QUERY PLANS A LABEL SCAN: %s ***' % query)
+            else:
+                scanning[query] = False
+    return [query for query, scans in scanning.items() if scans]
+
+
+def bootstrap_schema(db, timeout=300):
+    """Create the schema, wait for it to come online, then report any write queries that still scan labels.
+
+    Returns a dictionary of failed schema commands, offline indexes and label-scanning queries.
+    """
+    failures = ensure_schema(db)
+    offline = offline_indexes(db, timeout=timeout)
+    if offline:
+        logging.warning('*** NEO INDEXES NOT ONLINE: %s ***' % ', '.join('.'.join(key) for key in offline))
+    scans = label_scans(db)
+    return {'failed': failures, 'offline': ['.'.join(key) for key in offline], 'label_scans': scans}
@@ -13,14 +13,74 @@ neo_host = environ.get('NEO_HOST', 'localhost')
 
 uri = "neo4j://{}:7687".format(neo_host)
 
+# Create constraints and indexes, and wait for them to come online, before a worker starts consuming tasks.
+neo_schema_on_start = environ.get('NEO_SCHEMA_ON_START', 'true').lower() == 'true'
+neo_schema_timeout = int(environ.get('NEO_SCHEMA_TIMEOUT', 300))
+
+# Maximum number of Bolt connections held by each worker process's driver.
+neo_pool_size = int(environ.get('NEO_POOL_SIZE', 10))
+
+_neo_driver = None
+
+# Retry transient Neo4j errors with exponential backoff and jitter, between 0 and base * 2^attempt seconds.
+neo_retry_max_tries = int(environ.get('NEO_RETRY_MAX_TRIES', 8))
+neo_retry_base = float(environ.get('NEO_RETRY_BASE', 0.5))
+neo_retry_cap = float(environ.get('NEO_RETRY_CAP', 30))
+
+# Pause writes for the cooldown, in seconds, after this many consecutive connection failures.
+neo_circuit_threshold = int(environ.get('NEO_CIRCUIT_THRESHOLD', 5))
+neo_circuit_cooldown = int(environ.get('NEO_CIRCUIT_COOLDOWN', 60))
+
+
 def get_neo_driver():
     neo_user = environ.get('NEO_USER', False)
     neo_pass = environ.get('NEO_PW', False)
     if neo_user and neo_pass:
-        return GraphDatabase.driver(uri, auth=(neo_user, neo_pass), encrypted=False)
+        return GraphDatabase.driver(uri, auth=(neo_user, neo_pass), encrypted=False,
+            max_connection_pool_size=neo_pool_size)
     else:
         return None
 
+
+def init_neo_driver(**kwargs):
+    """Create this process's long-lived driver. Connected to Celery's worker_process_init signal."""
+    global _neo_driver
+    # Any driver inherited from the parent process shares its sockets, so don't use or close it.
+    _neo_driver = get_neo_driver()
+
+
+def neo_driver():
+    """Return the driver shared by all the tasks in this process, creating it if need be.
+
+    Don't close it, the worker does that when the process shuts down.
+    """
+    global _neo_driver
+    if _neo_driver is None:
+        _neo_driver = get_neo_driver()
+    return _neo_driver
+
+
+def close_neo_driver(**kwargs):
+    """Close this process's driver. Connected to Celery's worker_process_shutdown signal."""
+    global _neo_driver
+    if _neo_driver is not None:
+        _neo_driver.close()
+        _neo_driver = None
+
+
+# Buffer rendered users, connections and tweets in Redis, and write them to Neo4j in large batches, either when
+# the buffer holds WRITE_BEHIND_FLUSH_SIZE payloads or every WRITE_BEHIND_FLUSH_INTERVAL seconds.
+# The periodic flush needs Celery beat, (celery worker -B).
+write_behind = environ.get('WRITE_BEHIND', 'false').lower() == 'true'
+write_behind_flush_size = int(environ.get('WRITE_BEHIND_FLUSH_SIZE', 500))
+write_behind_flush_interval = float(environ.get('WRITE_BEHIND_FLUSH_INTERVAL', 10))
+
+# Don't re-write users, hashtags, URLs, media and original tweets written in the last KNOWN_ENTITY_TTL seconds
+# with the same content. KNOWN_ENTITY_LRU_SIZE nodes are also remembered by each worker process.
+known_entity_filter = environ.get('KNOWN_ENTITY_FILTER', 'true').lower() == 'true'
+known_entity_ttl = int(environ.get('KNOWN_ENTITY_TTL', 6 * 3600))
+known_entity_lru_size = int(environ.get('KNOWN_ENTITY_LRU_SIZE', 100000))
+
 solr_host = "birdspider_solr"
 
 solr_core = "birdspider"
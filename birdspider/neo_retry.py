@@ -0,0 +1,121 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""
+Retry policy for Neo4j transactions.
+
+Only transient errors, (including deadlocks) and lost connections are retried, with exponential backoff and full
+jitter so that workers that collided on the same locks don't wake up together and collide again. Anything else,
+such as a Cypher syntax error, is raised straight away. Consecutive connection failures across all the workers trip
+a circuit breaker held in Redis, which holds off write tasks until Neo4j has had time to come back.
+"""
+
+from functools import wraps
+import logging
+import random
+import time
+
+from neo4j.exceptions import ServiceUnavailable, SessionExpired, TransientError
+
+from db_settings import (cache, neo_circuit_cooldown, neo_circuit_threshold, neo_retry_base, neo_retry_cap,
+    neo_retry_max_tries)
+
+circuit_key = 'neo_circuit_open'
+failures_key = 'neo_circuit_failures'
+stats_key = 'neo_retry_counts'
+
+
+class NeoUnavailable(Exception):
+    """Neo4j can't be reached, or the circuit breaker is open. <wait> is the suggested time to wait in seconds."""
+
+    def __init__(self, wait):
+        super(NeoUnavailable, self).__init__('Neo4j unavailable, wait %ds' % wait)
+        self.wait = wait
+
+
+def classify(error):
+    """Return 'transient', 'unavailable' or 'fatal' for an exception raised by a transaction."""
+    if isinstance(error, TransientError):
+        return 'transient'
+    if isinstance(error, (ServiceUnavailable, SessionExpired, ConnectionError)):
+        return 'unavailable'
+    return 'fatal'
+
+
+def backoff(attempt, base=neo_retry_base, cap=neo_retry_cap):
+    """Exponential backoff with full jitter for the given attempt, starting at 1."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def count(outcome):
+    cache.hincrby(stats_key, outcome, 1)
+
+
+def retry_stats():
+    """Counts of retried, failed and exhausted transactions and circuit breaker trips, across all workers."""
+    return {key.decode('utf-8'): int(val) for key, val in cache.hgetall(stats_key).items()}
+
+
+def circuit_wait():
+    """Seconds until the circuit breaker closes, or 0 if writes can go ahead."""
+    ttl = cache.ttl(circuit_key)
+    return ttl if ttl and ttl > 0 else 0
+
+
+def trip():
+    """Record a connection failure, open the circuit if there have been too many in a row."""
+    pipe = cache.pipeline()
+    pipe.incr(failures_key)
+    pipe.expire(failures_key, neo_circuit_cooldown)
+    failures = pipe.execute()[0]
+    if failures >= neo_circuit_threshold and cache.set(circuit_key, 'open', ex=neo_circuit_cooldown, nx=True):
+        count('circuit_opened')
+        logging.error('*** NEO UNAVAILABLE AFTER %d FAILURES, PAUSING WRITES FOR %ds ***' %
+            (failures, neo_circuit_cooldown))
+
+
+def neo_retry(work, max_tries=neo_retry_max_tries):
+    """Call work() until it succeeds, retrying only transient and connection errors. Returns its result."""
+    attempt = 0
+    while True:
+        wait = circuit_wait()
+        if wait:
+            raise NeoUnavailable(wait)
+        try:
+            result = work()
+        except Exception as e:
+            kind = classify(e)
+            if kind == 'fatal':
+                count('failed')
+                raise
+            count(kind)
+            if kind == 'unavailable':
+                trip()
+            attempt += 1
+            if attempt >= max_tries:
+                count('exhausted')
+                logging.error('*** Neo tx failed after %d attempts ***' % attempt, exc_info=True)
+                if kind == 'unavailable':
+                    raise NeoUnavailable(max(circuit_wait(), 1)) from e
+                raise
+            delay = backoff(attempt)
+            logging.warning('*** Neo tx failed (%s), attempt %d, retrying in %.2fs ***' % (kind, attempt, delay),
+                exc_info=True)
+            time.sleep(delay)
+        else:
+            if attempt:
+                cache.delete(failures_key)
+            return result
+
+
+def neo_write_task(task_function):
+    """Decorate a bound Celery task that writes to Neo4j, so that it waits while the circuit breaker is open."""
+    @wraps(task_function)
+    def wrapped(self, *args, **kwargs):
+        wait = circuit_wait()
+        if wait:
+            logging.info('*** NEO CIRCUIT OPEN, DEFERRING %s FOR %ds ***' % (self.name, wait))
+            raise self.retry(countdown=wait, max_retries=None)
+        try:
+            return task_function(self, *args, **kwargs)
+        except NeoUnavailable as e:
+            raise self.retry(exc=e, countdown=e.wait, max_retries=None)
+    return wrapped
@@ -0,0 +1,31 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""The modules import each other by their flat names, as the workers do, so put them on the path."""
+
+import os
+import sys
+
+import pytest
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, package_dir)
+
+
+@pytest.fixture
+def fake_cache(monkeypatch):
+    """Swap the Redis client for an empty fakeredis one, in every module that imported it and every Lua script
+    registered with it.
+    """
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    import db_settings
+    real = db_settings.cache
+    fake = fakeredis.FakeStrictRedis()
+    for module in list(sys.modules.values()):
+        if not getattr(module, '__file__', None) or not module.__file__.startswith(package_dir):
+            continue
+        for name, value in list(vars(module).items()):
+            if value is real:
+                monkeypatch.setattr(module, name, fake)
+            elif getattr(value, 'registered_client', None) is real:
+                monkeypatch.setattr(value, 'registered_client', fake)
+    return fake
@@ -0,0 +1,97 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""Run the cluster task from the query's matrix to the clusters it pushes, with Neo4j and Redis stubbed out."""
+
+import pytest
+
+for module in ['numpy', 'scipy', 'networkx', 'celery', 'neo4j', 'redis']:
+    pytest.importorskip(module)
+
+from scipy import sparse
+
+import clustering_tasks
+
+labels = ['a%d' % i for i in range(4)] + ['b%d' % i for i in range(4)]
+
+
+def two_cliques(bridge=False, extra=False):
+    """Two groups of four users who all follow each other, optionally with one link between the groups, and another
+    from one of the first group.
+    """
+    links = [(i, j) for group in (range(4), range(4, 8)) for i in group for j in group if i != j]
+    if bridge:
+        links.extend([(3, 4), (4, 3)])
+    if extra:
+        links.append((0, 5))
+    rows, cols = zip(*links)
+    return sparse.csr_matrix(([1.0] * len(links), (rows, cols)), shape=(8, 8))
+
+
+@pytest.fixture
+def task(monkeypatch, tmp_path):
+    pushed = []
+    state = {'version': 1, 'matrix': two_cliques()}
+    monkeypatch.setattr(clustering_tasks, 'cluster_cache_dir', str(tmp_path))
+    monkeypatch.setattr(clustering_tasks, 'neo_driver', lambda: None)
+    monkeypatch.setattr(clustering_tasks, 'follows_version', lambda: state['version'])
+    monkeypatch.setattr(clustering_tasks, 'twitterSparseMatrix', lambda db, query, params: (labels, state['matrix']))
+    monkeypatch.setattr(clustering_tasks, 'user_clusters_to_neo',
+        lambda db, clusters, seed, query: pushed.append(clusters))
+    return pushed, state
+
+
+@pytest.mark.parametrize('engine', sorted(clustering_tasks.clustering_engines))
+def test_cluster_pushes_clusters(task, engine):
+    pushed, state = task
+    stats = clustering_tasks.cluster('a0', 'twitter_user', 'TransFoF', engine=engine)
+
+    assert stats['engine'] == engine
+    assert stats['cached'] is False
+    assert stats['users'] == len(labels)
+    for key in ['seconds', 'iterations', 'components', 'memory_growth', 'process_peak_memory']:
+        assert key in stats
+    assert 'converged' not in stats
+    assert sorted(sorted(clust) for clust in pushed[0]) == [labels[:4], labels[4:]]
+
+
+@pytest.mark.parametrize('engine', sorted(clustering_tasks.clustering_engines))
+def test_cluster_runs_engine_on_connected_graph(task, engine):
+    pushed, state = task
+    state['matrix'] = two_cliques(bridge=True)
+    stats = clustering_tasks.cluster('a0', 'twitter_user', 'TransFoF', engine=engine)
+
+    assert stats['components'] == 1
+    assert len(pushed) == 1
+    assert all(member in labels for clust in pushed[0] for member in clust)
+
+
+def test_cluster_reuses_cache(task):
+    pushed, state = task
+    state['matrix'] = two_cliques(bridge=True)
+    clustering_tasks.cluster('a0', 'twitter_user', 'TransFoF')
+    assert clustering_tasks.cluster('a0', 'twitter_user', 'TransFoF') == {'engine': 'mcl', 'cached': True}
+
+    state['version'] = 2
+    assert clustering_tasks.cluster('a0', 'twitter_user', 'TransFoF') == {'engine': 'mcl', 'cached': True}
+
+    state['version'] = 3
+    state['matrix'] = two_cliques(bridge=True, extra=True)
+    stats = clustering_tasks.cluster('a0', 'twitter_user', 'TransFoF')
+    assert stats['cached'] is False
+    assert stats['warm_start'] is True
+    assert len(pushed) == 2
+
+
+def test_failed_push_is_not_cached(task, monkeypatch):
+    pushed, state = task
+
+    def fail(db, clusters, seed, query):
+        raise RuntimeError('Neo4j is down')
+
+    monkeypatch.setattr(clustering_tasks, 'user_clusters_to_neo', fail)
+    with pytest.raises(RuntimeError):
+        clustering_tasks.cluster('a0', 'twitter_user', 'TransFoF')
+
+    monkeypatch.setattr(clustering_tasks, 'user_clusters_to_neo',
+        lambda db, clusters, seed, query: pushed.append(clusters))
+    assert clustering_tasks.cluster('a0', 'twitter_user', 'TransFoF')['cached'] is False
+    assert len(pushed) == 1
@@ -0,0 +1,127 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""Creating the schema, and swapping retired indexes for constraints only when that's safe."""
+
+import pytest
+
+for module in ['neo4j', 'twython']:
+    pytest.importorskip(module)
+
+import db_schema
+
+
+class Result(object):
+
+    def __init__(self, value=None):
+        self.value_ = value
+
+    def consume(self):
+        pass
+
+    def single(self):
+        return None if self.value_ is None else self
+
+    def value(self):
+        return self.value_
+
+
+class Session(object):
+    """Records the commands run, with the retired index present or not, some shared ids, and commands that fail."""
+
+    def __init__(self, indexed=True, duplicates=0, failing=()):
+        self.indexed = indexed
+        self.duplicates = duplicates
+        self.failing = failing
+        self.run_queries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def run(self, query, **params):
+        self.run_queries.append(query)
+        if query in self.failing:
+            raise Exception('schema command failed')
+        if query.startswith('CALL db.indexes()'):
+            return Result(params['name'] if self.indexed else None)
+        if query.startswith('MATCH'):
+            return Result(self.duplicates)
+        return Result()
+
+
+class Driver(object):
+
+    def __init__(self, session):
+        self.session_ = session
+
+    def session(self):
+        return self.session_
+
+
+drop = db_schema.drop_index_query('twitter_user', 'id')
+constraint = db_schema.constraint_query('twitter_user', 'id')
+index = db_schema.index_query('twitter_user', 'id')
+
+
+def test_schema_without_retired_index():
+    session = Session(indexed=False)
+    assert db_schema.ensure_schema(Driver(session)) == 0
+    assert drop not in session.run_queries
+    assert constraint in session.run_queries
+
+
+def test_retired_index_swapped_for_constraint():
+    session = Session()
+    assert db_schema.ensure_schema(Driver(session)) == 0
+    assert session.run_queries.index(drop) < session.run_queries.index(constraint)
+    assert index not in session.run_queries
+
+
+def test_retired_index_kept_while_ids_are_shared():
+    session = Session(duplicates=3)
+    assert db_schema.ensure_schema(Driver(session)) == 1
+    assert drop not in session.run_queries
+    assert constraint not in session.run_queries
+
+
+def test_retired_index_restored_when_constraint_fails():
+    session = Session(failing=[constraint])
+    assert db_schema.ensure_schema(Driver(session)) == 1
+    assert session.run_queries.index(drop) < session.run_queries.index(constraint) < session.run_queries.index(index)
+    assert session.run_queries.count(constraint) == 1
+
+
+@pytest.mark.parametrize('query, params', db_schema.crawl_statements())
+def test_crawl_queries_seek_an_index(query, params):
+    """Each crawl query starts from an equality or range on one indexed property, rather than comparing two."""
+    where = query.split('WHERE ', 1)[1].split('\n')[0]
+    prop = where.split('.', 1)[1].split(' ', 1)[0]
+    assert ('twitter_user', prop) in db_schema.schema_constraints + db_schema.crawl_indexes
+    assert '= true' in where or '> $' in where
+
+
+class Explained(object):
+
+    def __init__(self, plan):
+        self.plan = plan
+
+    def consume(self):
+        return self
+
+
+class PlanSession(Session):
+    """EXPLAINs queries that mention a crawl flag or seek on ids with an index seek, anything else with a label scan."""
+
+    def run(self, query, **params):
+        self.run_queries.append(query)
+        seek = 'needs_' in query or 'a.id > $after' in query
+        return Explained({'operatorType': 'ProduceResults@neo4j',
+            'children': [{'operatorType': 'NodeIndexSeek@neo4j' if seek else 'NodeByLabelScan@neo4j'}]})
+
+
+def test_label_scans_explains_crawl_queries():
+    session = PlanSession()
+    scans = db_schema.label_scans(Driver(session), db_schema.crawl_statements() + [('MATCH (n:x) RETURN n', {})])
+    assert scans == ['MATCH (n:x) RETURN n']
+    assert all('EXPLAIN ' + query in session.run_queries for query, params in db_schema.crawl_statements())
@@ -0,0 +1,66 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""Skipping nodes written recently with the same content, and only counting them as written once committed."""
+
+import pytest
+
+for module in ['neo4j', 'redis', 'twython']:
+    pytest.importorskip(module)
+
+from neo4j.exceptions import TransientError
+
+from twitter_tools import known_entities, neo
+
+users = [{'screen_name': 'alice', 'id': 1, 'name': 'Alice'}, {'screen_name': 'bob', 'id': 2, 'name': 'Bob'}]
+
+
+@pytest.fixture
+def lru(fake_cache, monkeypatch):
+    monkeypatch.setattr(known_entities, '__lru__', known_entities.OrderedDict())
+    return known_entities.__lru__
+
+
+def fresh(items):
+    return known_entities.KnownEntityFilter().fresh('twitter_user', [dict(item) for item in items], 'screen_name')
+
+
+def test_nothing_is_known_until_committed(lru):
+    known = known_entities.KnownEntityFilter()
+    assert known.fresh('twitter_user', users, 'screen_name') == users
+    assert fresh(users) == users
+
+    known.commit()
+    assert fresh(users) == []
+    assert known_entities.known_entity_stats()['twitter_user'] == {'hits': 2, 'misses': 4, 'hit_rate': 1 / 3}
+
+
+def test_other_workers_commits_are_seen(lru):
+    known = known_entities.KnownEntityFilter()
+    known.fresh('twitter_user', users, 'screen_name')
+    known.commit()
+    lru.clear()
+    assert fresh(users) == []
+
+
+def test_changed_content_is_fresh(lru):
+    known = known_entities.KnownEntityFilter()
+    known.fresh('twitter_user', users, 'screen_name')
+    known.commit()
+    renamed = [dict(users[0], name='Alice B'), dict(users[1], last_scraped='2020-01-01T00:00:00')]
+    assert fresh(renamed) == renamed[:1]
+
+
+def test_users_are_known_only_after_their_transaction_commits(lru, monkeypatch):
+    monkeypatch.setattr(neo, 'add_to_frontier', lambda twits: None)
+
+    def failed_tx(db, statements):
+        raise TransientError('deadlock')
+    monkeypatch.setattr(neo, 'neo_batch_tx', failed_tx)
+    with pytest.raises(TransientError):
+        neo.users2Neo(None, [dict(user) for user in users])
+    assert fresh(users) == users
+
+    written = []
+    monkeypatch.setattr(neo, 'neo_batch_tx', lambda db, statements: written.extend(statements))
+    neo.users2Neo(None, [dict(user) for user in users])
+    assert len(written[0][1]['data']) == 2
+    assert fresh(users) == []
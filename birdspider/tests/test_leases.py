@@ -0,0 +1,90 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""Leasing crawl lane slots and fetches, and handing them out again when the job holding them is lost."""
+
+import pytest
+
+pytest.importorskip('redis')
+
+from crawl import leases
+
+
+def expire(cache, key):
+    """The lease runs out."""
+    cache.delete(key)
+
+
+def test_slot_is_claimed_once(fake_cache):
+    assert leases.claim_slot('slot_1', 'root') == (True, None)
+    assert leases.claim_slot('slot_1', 'root') == (False, None)
+    assert 0 < fake_cache.ttl('slot_1') <= leases.LANE_LEASE
+
+
+def test_finished_slot_is_claimed_again(fake_cache):
+    leases.claim_slot('slot_1', 'root')
+    leases.assign_slot('slot_1', 'root', 'alice')
+    assert leases.slots_in_use('root') == 1
+    assert leases.release_slot('slot_1', 'root', 'alice')
+    assert leases.slots_in_use('root') == 0
+    assert leases.claim_slot('slot_1', 'root', abandoned_only=True) == (False, None)
+    assert leases.claim_slot('slot_1', 'root') == (True, None)
+
+
+def test_expired_slot_hands_out_its_user_again(fake_cache):
+    leases.claim_slot('slot_1', 'root')
+    leases.assign_slot('slot_1', 'root', 'alice')
+    expire(fake_cache, 'slot_1')
+    assert leases.claim_slot('slot_1', 'root', abandoned_only=True) == (True, 'alice')
+    assert leases.claim_slot('slot_1', 'root') == (False, None)
+
+
+def test_renewing_keeps_a_running_slot(fake_cache):
+    leases.claim_slot('slot_1', 'root')
+    leases.renew_lease('slot_1', ttl=5000)
+    assert fake_cache.ttl('slot_1') > leases.LANE_LEASE
+    leases.release_slot('slot_1', 'root', 'alice')
+    leases.renew_lease('slot_1', ttl=5000)
+    assert fake_cache.ttl('slot_1') == -1
+
+
+def test_slot_handed_to_another_user_is_not_released(fake_cache):
+    leases.claim_slot('slot_1', 'root')
+    leases.assign_slot('slot_1', 'root', 'bob')
+    assert not leases.release_slot('slot_1', 'root', 'alice')
+    assert leases.slots_in_use('root') == 1
+
+
+def test_fetch_lease_is_held_by_one_owner(fake_cache):
+    lease = leases.FetchLease('tweets', 'alice', 'lane_1')
+    assert lease.acquire() == 'acquired'
+    assert lease.acquire() == 'acquired'
+    assert leases.FetchLease('tweets', 'alice', 'lane_2').acquire() == 'fetching'
+    assert leases.FetchLease('friends', 'alice', 'lane_2').acquire() == 'acquired'
+
+
+def test_finished_fetch_stays_fresh(fake_cache):
+    lease = leases.FetchLease('tweets', 'alice', 'lane_1')
+    lease.acquire()
+    lease.finish()
+    assert leases.FetchLease('tweets', 'alice', 'lane_2').acquire() == 'fresh'
+    assert 0 < fake_cache.ttl(lease.key) <= leases.FETCH_FRESHNESS
+
+
+def test_released_or_expired_fetch_is_taken_over(fake_cache):
+    lease = leases.FetchLease('tweets', 'alice', 'lane_1')
+    lease.acquire()
+    lease.release()
+    assert leases.FetchLease('tweets', 'alice', 'lane_2').acquire() == 'acquired'
+    expire(fake_cache, lease.key)
+    assert lease.acquire() == 'acquired'
+
+
+def test_only_the_owner_renews_or_settles_a_fetch(fake_cache):
+    lease = leases.FetchLease('tweets', 'alice', 'lane_1')
+    other = leases.FetchLease('tweets', 'alice', 'lane_2')
+    lease.acquire()
+    other.renew(ttl=5000)
+    other.finish()
+    assert fake_cache.get(lease.key) == b'lane_1'
+    assert fake_cache.ttl(lease.key) <= leases.LANE_LEASE
+    lease.renew(ttl=5000)
+    assert fake_cache.ttl(lease.key) > leases.LANE_LEASE
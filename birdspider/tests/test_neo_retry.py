@@ -0,0 +1,88 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""Which Neo4j errors are retried, how long to wait between attempts, and when the circuit breaker opens."""
+
+import pytest
+
+for module in ['neo4j', 'redis']:
+    pytest.importorskip(module)
+
+from neo4j.exceptions import CypherSyntaxError, ServiceUnavailable, SessionExpired, TransientError
+
+import neo_retry
+
+
+@pytest.fixture
+def sleeps(fake_cache, monkeypatch):
+    slept = []
+    monkeypatch.setattr(neo_retry.time, 'sleep', slept.append)
+    return slept
+
+
+def failing(*errors):
+    """A transaction that raises each of the errors in turn, then returns 'done'."""
+    pending = list(errors)
+
+    def work():
+        if pending:
+            raise pending.pop(0)
+        return 'done'
+    return work
+
+
+@pytest.mark.parametrize('error, kind', [
+    (TransientError('deadlock'), 'transient'),
+    (ServiceUnavailable('no route'), 'unavailable'),
+    (SessionExpired('gone'), 'unavailable'),
+    (ConnectionResetError(), 'unavailable'),
+    (CypherSyntaxError('typo'), 'fatal'),
+    (ValueError(), 'fatal'),
+])
+def test_classify(error, kind):
+    assert neo_retry.classify(error) == kind
+
+
+@pytest.mark.parametrize('attempt', range(1, 10))
+def test_backoff_is_jittered_below_the_capped_exponential(attempt):
+    delays = [neo_retry.backoff(attempt, base=0.5, cap=30) for n in range(200)]
+    assert all(0 <= delay <= min(30, 0.5 * 2 ** attempt) for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_transient_errors_are_retried_after_backing_off(sleeps):
+    work = failing(TransientError('deadlock'), TransientError('deadlock'))
+    assert neo_retry.neo_retry(work) == 'done'
+    assert len(sleeps) == 2
+    assert sleeps[0] <= neo_retry.neo_retry_base * 2 and sleeps[1] <= neo_retry.neo_retry_base * 4
+    assert neo_retry.retry_stats() == {'transient': 2}
+
+
+def test_fatal_errors_are_raised_at_once(sleeps):
+    with pytest.raises(CypherSyntaxError):
+        neo_retry.neo_retry(failing(CypherSyntaxError('typo')))
+    assert sleeps == []
+    assert neo_retry.retry_stats() == {'failed': 1}
+
+
+def test_exhausted_transient_errors_are_raised(sleeps):
+    with pytest.raises(TransientError):
+        neo_retry.neo_retry(failing(*[TransientError('deadlock')] * 3), max_tries=3)
+    assert len(sleeps) == 2
+    assert neo_retry.retry_stats() == {'transient': 3, 'exhausted': 1}
+
+
+def test_connection_failures_open_the_circuit(sleeps, monkeypatch):
+    monkeypatch.setattr(neo_retry, 'neo_circuit_threshold', 2)
+    with pytest.raises(neo_retry.NeoUnavailable) as raised:
+        neo_retry.neo_retry(failing(*[ServiceUnavailable('no route')] * 3), max_tries=2)
+    assert raised.value.wait == neo_retry.circuit_wait() > 0
+    assert neo_retry.retry_stats()['circuit_opened'] == 1
+
+    calls = []
+    with pytest.raises(neo_retry.NeoUnavailable):
+        neo_retry.neo_retry(lambda: calls.append(1))
+    assert calls == []
+
+
+def test_success_resets_the_failure_count(sleeps, fake_cache):
+    assert neo_retry.neo_retry(failing(ServiceUnavailable('no route'))) == 'done'
+    assert not fake_cache.exists(neo_retry.failures_key)
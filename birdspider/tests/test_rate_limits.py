@@ -0,0 +1,73 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""Reserving and refilling the shared token buckets, and emptying them when Twitter says so."""
+
+import pytest
+
+pytest.importorskip('redis')
+
+from twitter_tools import rate_limits
+
+
+class Clock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(fake_cache, monkeypatch):
+    """Three calls per 30 second window, one every ten seconds, on a clock that only moves when told to."""
+    clock = Clock()
+    monkeypatch.setattr(rate_limits, 'time', clock)
+    monkeypatch.setattr(rate_limits, 'DEFAULT_RATE_LIMIT', 3)
+    monkeypatch.setattr(rate_limits, 'RATE_LIMIT_WINDOW', 30)
+    monkeypatch.setattr(rate_limits, 'RATE_LIMIT_MARGIN', 0)
+    return clock
+
+
+def test_reserve_until_empty(clock):
+    assert [rate_limits.reserve('app', 'lookup_user') for n in range(3)] == [0, 0, 0]
+    assert rate_limits.available(['app'], 'lookup_user') == {'app': 0}
+
+
+def test_waiting_callers_get_their_own_slots(clock):
+    for n in range(3):
+        rate_limits.reserve('app', 'lookup_user')
+    assert [rate_limits.reserve('app', 'lookup_user') for n in range(3)] == [10, 20, 30]
+
+
+def test_buckets_refill(clock):
+    for n in range(3):
+        rate_limits.reserve('app', 'lookup_user')
+    clock.now += 20
+    assert rate_limits.available(['app'], 'lookup_user') == {'app': pytest.approx(2)}
+    assert [rate_limits.reserve('app', 'lookup_user') for n in range(2)] == [0, 0]
+    assert rate_limits.reserve('app', 'lookup_user') > 0
+
+
+def test_buckets_are_per_handle_and_method(clock):
+    for n in range(3):
+        rate_limits.reserve('app', 'lookup_user')
+    assert rate_limits.reserve('user', 'lookup_user') == 0
+    assert rate_limits.reserve('app', 'get_user_timeline') == 0
+
+
+def test_exhausted_bucket_is_blocked_until_reset(clock):
+    rate_limits.exhaust('app', 'lookup_user', reset=clock.now + 60)
+    assert rate_limits.blocked_for('app', 'lookup_user') == 60
+    assert rate_limits.available(['app'], 'lookup_user') == {'app': 0}
+    assert rate_limits.reserve('app', 'lookup_user') >= 60
+
+    clock.now += 100
+    assert rate_limits.blocked_for('app', 'lookup_user') == 0
+    assert rate_limits.available(['app'], 'lookup_user')['app'] > 0
+
+
+def test_reconcile_learns_the_limit(clock):
+    rate_limits.reconcile('app', 'lookup_user', 900, 10, clock.now + 30)
+    assert rate_limits.available(['app'], 'lookup_user') == {'app': pytest.approx(10)}
+    clock.now += 1
+    assert rate_limits.available(['app'], 'lookup_user') == {'app': pytest.approx(40)}
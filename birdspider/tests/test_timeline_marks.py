@@ -0,0 +1,41 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""Moving a user's high-water mark only once every page of a timeline fetch is written."""
+
+import pytest
+
+pytest.importorskip('redis')
+
+from twitter_tools import timeline_marks
+
+
+def test_mark_only_moves_forward(fake_cache):
+    assert timeline_marks.advance_high_water('alice', 10 ** 18)
+    assert not timeline_marks.advance_high_water('alice', 9 * 10 ** 17)
+    assert timeline_marks.high_water('alice') == 10 ** 18
+
+
+def test_mark_waits_for_earlier_pages(fake_cache):
+    for page in range(3):
+        timeline_marks.page_sent('fetch')
+    assert not timeline_marks.page_written('alice', 'fetch', highWater=300)
+    assert not timeline_marks.page_written('alice', 'fetch')
+    assert timeline_marks.high_water('alice') == 0
+    assert timeline_marks.page_written('alice', 'fetch')
+    assert timeline_marks.high_water('alice') == 300
+    assert not fake_cache.exists(timeline_marks.fetch_prefix + 'fetch')
+
+
+def test_mark_waits_for_last_page(fake_cache):
+    for page in range(2):
+        timeline_marks.page_sent('fetch')
+    assert not timeline_marks.page_written('alice', 'fetch')
+    assert timeline_marks.page_written('alice', 'fetch', highWater=200)
+    assert timeline_marks.high_water('alice') == 200
+
+
+def test_mark_stays_if_a_page_is_never_written(fake_cache):
+    for page in range(2):
+        timeline_marks.page_sent('fetch')
+    assert not timeline_marks.page_written('alice', 'fetch', highWater=200)
+    assert timeline_marks.high_water('alice') == 0
+    assert fake_cache.ttl(timeline_marks.fetch_prefix + 'fetch') > 0
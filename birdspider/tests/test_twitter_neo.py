@@ -0,0 +1,52 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""The statements the graph writers build from rendered data."""
+
+import pytest
+
+for module in ['neo4j', 'twython']:
+    pytest.importorskip(module)
+
+from twitter_tools import neo
+
+
+def test_users_are_merged_on_id_when_they_have_one():
+    twits = [{'screen_name': 'alice', 'id': 1}, {'screen_name': 'bob'}, {'id': 3}]
+    query, params = neo.users_statement(twits, right_now='2020-01-01T00:00:00')
+    assert 'MERGE (x:twitter_user {id: d.id})' in query
+    assert [(d['id'], d['screen_name']) for d in params['data']] == [(1, 'alice')]
+    assert [d['screen_name'] for d in params['unidentified']] == ['bob']
+    assert params['data'][0]['props']['last_scraped'] == '2020-01-01T00:00:00'
+
+
+class Session(object):
+
+    def __init__(self):
+        self.run_queries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def begin_transaction(self):
+        return self
+
+    def run(self, query, **params):
+        self.run_queries.append(query)
+
+
+class Driver(object):
+
+    def __init__(self):
+        self.session_ = Session()
+
+    def session(self):
+        return self.session_
+
+
+def test_users_without_ids_are_written(monkeypatch):
+    monkeypatch.setattr(neo, 'neo_retry', lambda work: work())
+    db = Driver()
+    neo.neo_batch_tx(db, [neo.users_statement([{'screen_name': 'bob'}]), neo.users_statement([])])
+    assert db.session_.run_queries == [neo.users_query]
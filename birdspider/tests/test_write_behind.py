@@ -0,0 +1,101 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""Taking batches off the write buffer, and putting them back or dead-lettering them when a flush fails."""
+
+import json
+
+import pytest
+
+for module in ['neo4j', 'redis', 'twython']:
+    pytest.importorskip(module)
+
+from neo4j.exceptions import ConstraintError, TransientError
+
+from twitter_tools.timeline_marks import high_water, page_sent
+import write_behind
+
+
+@pytest.fixture
+def buffer(fake_cache, monkeypatch):
+    """Buffer five payloads, and make flush_batch write each batch as one statement with Neo4j stubbed out."""
+    written = []
+    monkeypatch.setattr(write_behind, 'new_known_filter', lambda: None)
+    monkeypatch.setattr(write_behind, 'add_to_frontier', lambda twits: list(twits))
+    monkeypatch.setattr(write_behind, 'buffered_statements',
+        lambda payloads, known=None: [[p['n'] for p in payloads]])
+    monkeypatch.setattr(write_behind, 'neo_batch_tx', lambda db, statements: written.extend(statements) or 0.1)
+    for n in range(5):
+        write_behind.buffer_write('users', twits=[], n=n)
+    return written
+
+
+def buffered(cache, key=write_behind.buffer_key):
+    return [json.loads(item)['n'] for item in cache.lrange(key, 0, -1)]
+
+
+def failing_tx(error):
+    def tx(db, statements):
+        raise error
+    return tx
+
+
+def test_take_batch_moves_items_in_flight(buffer, fake_cache):
+    keys = [write_behind.buffer_key, 'batch', write_behind.in_flight_key]
+    items = write_behind.take_batch(keys=keys, args=[3, 100])
+    assert [json.loads(item)['n'] for item in items] == [0, 1, 2]
+    assert buffered(fake_cache) == [3, 4]
+    assert buffered(fake_cache, 'batch') == [0, 1, 2]
+    assert fake_cache.zscore(write_behind.in_flight_key, 'batch') == 100
+
+
+def test_requeue_batch_puts_items_back_in_order(buffer, fake_cache):
+    keys = [write_behind.buffer_key, 'batch', write_behind.in_flight_key]
+    write_behind.take_batch(keys=keys, args=[3, 100])
+    assert write_behind.requeue_batch(keys=keys) == 3
+    assert buffered(fake_cache) == [0, 1, 2, 3, 4]
+    assert not fake_cache.exists('batch')
+    assert fake_cache.zcard(write_behind.in_flight_key) == 0
+
+
+def test_flush_batch_deletes_committed_batch(buffer, fake_cache):
+    assert write_behind.flush_batch(None, 3) == 3
+    assert buffer == [[0, 1, 2]]
+    assert buffered(fake_cache) == [3, 4]
+    assert fake_cache.zcard(write_behind.in_flight_key) == 0
+    assert fake_cache.keys(write_behind.batch_prefix + '*') == []
+
+
+def test_flush_batch_requeues_transient_failures(buffer, fake_cache, monkeypatch):
+    monkeypatch.setattr(write_behind, 'neo_batch_tx', failing_tx(TransientError('deadlock')))
+    with pytest.raises(TransientError):
+        write_behind.flush_batch(None, 3)
+    assert buffered(fake_cache) == [0, 1, 2, 3, 4]
+    assert fake_cache.zcard(write_behind.in_flight_key) == 0
+    assert fake_cache.llen(write_behind.dead_letter_key) == 0
+
+
+def test_flush_batch_dead_letters_fatal_failures(buffer, fake_cache, monkeypatch):
+    monkeypatch.setattr(write_behind, 'neo_batch_tx', failing_tx(ConstraintError('duplicate id')))
+    assert write_behind.flush_batch(None, 3) == 0
+    assert buffered(fake_cache) == [3, 4]
+    assert buffered(fake_cache, write_behind.dead_letter_key) == [0, 1, 2]
+    assert fake_cache.zcard(write_behind.in_flight_key) == 0
+
+
+def test_stale_batches_are_requeued(buffer, fake_cache):
+    keys = [write_behind.buffer_key, 'batch', write_behind.in_flight_key]
+    write_behind.take_batch(keys=keys, args=[2, 0])
+    write_behind.requeue_stale_batches()
+    assert buffered(fake_cache) == [0, 1, 2, 3, 4]
+
+
+def test_flush_batch_advances_high_water_after_commit(buffer, fake_cache, monkeypatch):
+    page_sent('fetch')
+    write_behind.buffer_write('tweets', dump={'users': {}}, user='alice', fetch='fetch', highWater=500, n=5)
+    monkeypatch.setattr(write_behind, 'neo_batch_tx', failing_tx(TransientError('deadlock')))
+    with pytest.raises(TransientError):
+        write_behind.flush_batch(None, 6)
+    assert high_water('alice') == 0
+
+    monkeypatch.setattr(write_behind, 'neo_batch_tx', lambda db, statements: 0.1)
+    assert write_behind.flush_batch(None, 6) == 6
+    assert high_water('alice') == 500
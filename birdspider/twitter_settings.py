@@ -12,4 +12,41 @@ ACCESS_TOKEN = environ.get('ACCESS_TOKEN', None)
 API_TIMEOUT = 900
 
 SUPERNODE_FOLLOWERS = 1000
-SUPERNODE_FOLLOWING = 1000
\ No newline at end of file
+SUPERNODE_FOLLOWING = 1000
+
+# "list" crawls connections 200 full profiles at a time, "ids" crawls 5000 ids at a time and looks up the
+# profiles of new users in batches of 100, except for the followers or friends of supernodes.
+CONNECTION_CRAWL_MODE = environ.get('CONNECTION_CRAWL_MODE', 'list')
+HYDRATE_BATCH_SIZE = 100
+# Calls per RATE_LIMIT_WINDOW seconds assumed for an endpoint until Twitter tells us its actual limit.
+RATE_LIMIT_WINDOW = 900
+DEFAULT_RATE_LIMIT = 15
+# Seconds to wait after Twitter says a rate-limit window resets before trusting it.
+RATE_LIMIT_MARGIN = 30
+
+# Extra tokens for the credential pool: comma-separated OAUTH2 bearer tokens, and OAUTH1 "token:secret" pairs.
+TWITTER_APP_TOKENS = [token for token in environ.get('TWITTER_APP_TOKENS', '').split(',') if token]
+TWITTER_USER_TOKENS = [pair for pair in environ.get('TWITTER_USER_TOKENS', '').split(',') if pair]
+
+# Kept-alive connections to the Twitter API per worker process and set of credentials.
+TWITTER_HTTP_POOL_SIZE = int(environ.get('TWITTER_HTTP_POOL_SIZE', 4))
+
+# Seconds a task may spend paging through an API method before it goes back on the queue.
+PAGE_TIME_BUDGET = int(environ.get('PAGE_TIME_BUDGET', 120))
+
+# Scrapes hand out work as soon as a job finishes, and also check on their lanes this often in case they missed it.
+SCRAPE_WATCHDOG = int(environ.get('SCRAPE_WATCHDOG', 300))
+
+# The most users each crawl lane fetches at once, fewer when the rate limit for the lane's API method runs low.
+SCRAPE_PARALLELISM = int(environ.get('SCRAPE_PARALLELISM', 4))
+
+# Seconds a default scrape with nothing left to crawl waits for a new user to turn up before it checks again.
+FRONTIER_WAIT = int(environ.get('FRONTIER_WAIT', 30))
+
+# Seconds a crawl lane's slot is leased to the job fetching its user. The job renews the lease after every page, and
+# if its worker dies the lease runs out and the scrape hands the user to the slot again.
+LANE_LEASE = int(environ.get('LANE_LEASE', 600))
+
+# Seconds after a user's timeline, friends or followers are fetched during which no crawl fetches them again. With 0,
+# crawls still never fetch the same thing at the same time.
+FETCH_FRESHNESS = int(environ.get('FETCH_FRESHNESS', 3600))
@@ -5,26 +5,164 @@
 __author__ = 'Giles Richard Greenway'
 
 from datetime import datetime
+import json
 
 from celery import chain, group
+from celery.signals import worker_init, worker_ready
 from celery.task.control import revoke
 from celery.utils.log import get_task_logger
 
 from itertools import groupby
+from uuid import uuid4
 
 from app import app
-from db_settings import get_neo_driver, cache
+from db_schema import bootstrap_schema
+from db_settings import (get_neo_driver, neo_driver, cache, neo_schema_on_start, neo_schema_timeout, write_behind,
+    write_behind_flush_size)
+from neo_retry import neo_write_task, retry_stats
 from solr_tools import tweets2Solr
 from twitter_settings import *
-from twitter_tools.neo import connections2Neo, tweetDump2Neo, users2Neo, setUserDefunct, multiUserTweetDump2Neo
-from twitter_tools.rated_twitter import RatedTwitter
+from twitter_tools.credential_pool import live_handles, pool_credentials
+from twitter_tools.known_entities import known_entity_stats
+from twitter_tools.neo import (backfill_degrees, connection_ids2Neo, connections2Neo, tweetDump2Neo, users2Neo,
+    setUserDefunct, multiUserTweetDump2Neo, user_counts)
+from twitter_tools.paging import Pager, next_cursor
+from twitter_tools.rate_limits import available, blocked_for
+from twitter_tools.rated_twitter import RatedTwitter, latency_percentiles
 from twitter_tools.streaming_twitter import StreamingTwitter
+from twitter_tools.timeline_marks import high_water, page_sent, page_written
 from twitter_tools.tools import renderTwitterUser, decomposeTweets
-from crawl.crawl_cypher import nextNearest, whoNext, start_user_crawl, update_crawl
+from write_behind import buffer_write, flush_write_buffer, request_flush
+from crawl.crawl_cypher import nextFromFrontier, nextNearest, start_user_crawl, update_crawl
+from crawl.frontier import frontier_sizes, wait_for_frontier
+from crawl.leases import (FetchLease, assign_slot, claim_slot, release_slot, renew_lease, slot_users_key,
+    slots_in_use)
+from crawl.rings import await_hydration, extend_hydrated, extend_rings, start_rings, stop_rings
 
 logger = get_task_logger(__name__)
 
 
+@worker_init.connect
+def schema_on_start(sender=None, **kwargs):
+    """Make sure the graph schema is in place before the worker starts ingesting."""
+    if not neo_schema_on_start:
+        return
+    db = get_neo_driver()
+    if db is None:
+        logger.warning('*** NO NEO CREDENTIALS, NOT CHECKING THE SCHEMA ***')
+        return
+    try:
+        bootstrap_schema(db, timeout=neo_schema_timeout)
+    except:
+        logger.error('*** COULD NOT BOOTSTRAP THE NEO SCHEMA ***', exc_info=True)
+    finally:
+        db.close()
+
+
+@app.task(name='twitter_tasks.ensureSchema', bind=True)
+def ensureSchema(self, timeout=300):
+    """Create Neo4J constraints and indexes for every MERGE/MATCH key, and wait for them to come online.
+
+    Returns the number of failed schema commands, indexes that aren't online and write queries that scan labels.
+    """
+    return bootstrap_schema(neo_driver(), timeout=timeout)
+
+
+@app.task(name='twitter_tasks.backfillDegrees', bind=True)
+@neo_write_task
+def backfillDegrees(self, after=-1, batch_size=10000):
+    """Fill in the in-graph degree counters of users written before they were kept, a batch at a time.
+
+    Keyword arguments:
+    after -- the user id to carry on from, set when the task calls itself
+    batch_size -- the number of users to count in each transaction
+    """
+    counted, last_id = backfill_degrees(neo_driver(), after=after, batch_size=batch_size)
+    if counted == batch_size:
+        backfillDegrees.delay(after=last_id, batch_size=batch_size)
+    else:
+        logger.info('*** DONE BACKFILLING DEGREE COUNTERS ***')
+
+
+@app.task(name='twitter_tasks.neoRetryStats', bind=True)
+def neoRetryStats(self):
+    """Return counts of retried Neo4J transactions by error type, failures and circuit breaker trips."""
+    return retry_stats()
+
+
+def requeue_pager(task, pager, cacheKey=False, lease=None):
+    """Put a paging task back on the queue if it was rate-limited or ran out of time, it'll resume from its checkpoint.
+
+    Keyword arguments:
+    cacheKey -- the crawl lane slot the task is fetching for, whose lease is extended to cover the wait
+    lease -- the task's FetchLease, also extended
+    """
+    if pager.status == 'limited':
+        logger.info('*** TWITTER RATE-LIMITED: %s, WAITING %ds ***' % (pager.checkpoint_key, pager.wait))
+        renew_lease(cacheKey, pager.wait + LANE_LEASE)
+        if lease:
+            lease.renew(pager.wait + LANE_LEASE)
+        raise task.retry(countdown=pager.wait, max_retries=None)
+    if pager.status == 'timeout':
+        logger.info('*** OUT OF TIME: %s ***' % pager.checkpoint_key)
+        renew_lease(cacheKey)
+        if lease:
+            lease.renew()
+        raise task.retry(countdown=0, max_retries=None)
+
+
+def lease_fetch(task, job, user, cacheKey=False):
+    """Take the lease on fetching <user>'s tweets, friends or followers, shared by every crawl.
+
+    Returns the lease, or None if the job was fetched recently, or is being fetched for another crawl lane. In that
+    case the task's own lane is finished, since the other job's results go to every scrape. A task that isn't part of
+    a lane is put back on the queue to wait for the other job to finish.
+    """
+    lease = FetchLease(job, user, cacheKey or task.request.id)
+    held = lease.acquire()
+    if held == 'acquired':
+        return lease
+    if held == 'fresh' or cacheKey:
+        logger.info('*** %s: %s %s, SKIPPING ***' % (user, job.upper(),
+            'FETCHED RECENTLY' if held == 'fresh' else 'ALREADY BEING FETCHED'))
+        if cacheKey:
+            finish_lane(cacheKey, user)
+        return None
+    logger.info('*** %s: WAITING FOR %s ALREADY BEING FETCHED ***' % (user, job.upper()))
+    raise task.retry(countdown=PAGE_TIME_BUDGET, max_retries=None)
+
+
+def buffer_graph_write(kind, **payload):
+    """Add rendered data to the write-behind buffer, flush it if it's full."""
+    if buffer_write(kind, **payload) >= write_behind_flush_size and request_flush():
+        flushWriteBuffer.delay()
+
+
+@app.task(name='twitter_tasks.flushWriteBuffer', bind=True)
+@neo_write_task
+def flushWriteBuffer(self):
+    """Write buffered users, connections and tweets to Neo4J in large batches."""
+    return flush_write_buffer(neo_driver())
+
+
+@app.task(name='twitter_tasks.knownEntityStats', bind=True)
+def knownEntityStats(self):
+    """Return the hits, misses and hit rate of the filter that skips re-writing unchanged nodes, by label."""
+    return known_entity_stats()
+
+
+@app.task(name='twitter_tasks.crawlFrontier', bind=True)
+def crawlFrontier(self):
+    """Return the number of users waiting to have their friends, followers or tweets fetched by the default scrape."""
+    return frontier_sizes()
+
+
+@app.task(name='twitter_tasks.twitterLatency', bind=True)
+def twitterLatency(self):
+    """Return the median, 90th and 99th percentile latency of recent calls to each Twitter API method."""
+    return latency_percentiles()
+
+
 @app.task(name='twitter_tasks.twitterCall', bind=True)
 def twitterCall(self, method_name, credentials=False, **kwargs):
     """Attempt a given Twitter API call, retry if rate-limited. Returns the result of the call.
@@ -49,10 +187,9 @@ def twitterCall(self, method_name, credentials=False, **kwargs):
 
 
 @app.task(name='twitter_tasks.pushRenderedTwits2Neo', bind=True)
+@neo_write_task
 def pushRenderedTwits2Neo(self, twits):
-    db = get_neo_driver()
-    users2Neo(db, twits)
-    db.close()
+    users2Neo(neo_driver(), twits)
 
 
 @app.task(name='twitter_tasks.pushTwitterUsers', bind=True)
@@ -68,7 +205,10 @@ def pushTwitterUsers(self, twits):
         twit['last_scraped'] = rightNow
         logger.info('***Push twitter user: ' + twit['screen_name'] + ' ***')
     renderedTwits = [renderTwitterUser(twit) for twit in twits]
-    pushRenderedTwits2Neo.delay(renderedTwits)
+    if write_behind:
+        buffer_graph_write('users', twits=renderedTwits)
+    else:
+        pushRenderedTwits2Neo.delay(renderedTwits)
 
 
 @app.task(name='twitter_tasks.getTwitterUsers', bind=True)
@@ -126,7 +266,10 @@ def push_stream_results(self, statuses):
 
     pushTwitterUsers.delay(users)
 
-    pushRenderedMultiUserTweets2Neo.delay(decomposed_tweets)
+    if write_behind:
+        buffer_graph_write('tweets', dump=decomposed_tweets)
+    else:
+        pushRenderedMultiUserTweets2Neo.delay(decomposed_tweets)
 
 
 @app.task(name='twitter_tasks.search', bind=True)
@@ -134,43 +277,32 @@ def search(self, query_terms, result_type='mixed', page_size=100, lang='en', twe
 
     logger.info('***Starting TWITTER search ***')
     api = RatedTwitter(credentials=credentials)
-    limit = api.search_wait()
-    if limit:
-        logger.info('*** TWITTER RATE-LIMITED: search starts with: %s:%d  ***' % (query_terms[0], str(count)))
-        raise search.retry(countdown=limit)
-    else:
-        query = {'q': query_terms,
-                 'result_type': result_type,
-                 'count': page_size,
-                 'lang': lang,
-                 }
-        if tweet_id:
-            query['max_id'] = tweet_id
-
-        okay, result = api.search(**query)
-
-        if okay:
-            logger.info('*** TWITTER search starts with: %s:%s ***' % (query_terms[0], str(tweet_id)))
-            if result:
-                push_search_results.delay(result)
-                newCount = count + len(result['statuses'])
-                if maxTweets:
-                    if newCount > maxTweets: # No need for the task to call itself again.
-                        return
-
-                try:
-                    # Parse the data returned to get max_id to be passed in consequent call.
-                    next_results_url_params = result['search_metadata']['next_results']
-                    next_max_id = next_results_url_params.split('max_id=')[1].split('&')[0]
-
-                    # Not done yet, the task calls itself with an updated count and tweetId.
-                    search.delay(query_terms, maxTweets=maxTweets, count=newCount, tweet_id=next_max_id,
-                                 result_type=result_type, page_size=page_size, lang=lang, credentials=credentials)
-                except:  #do we have anything we want in the except clause if there is not a next batch of tweets?
-                    return
-        else:
-            if result == 'limited':
-                raise search.retry(countdown=api.search_wait())
+    query = {'q': query_terms,
+             'result_type': result_type,
+             'count': page_size,
+             'lang': lang,
+             }
+    if tweet_id:
+        query['max_id'] = tweet_id
+
+    def advance(state, result):
+        newCount = state['count'] + len(result['statuses'])
+        if maxTweets and newCount > maxTweets: # No need to get another page.
+            return None
+        try:
+            # Parse the data returned to get max_id to be passed in the next call.
+            next_results_url_params = result['search_metadata']['next_results']
+            next_max_id = next_results_url_params.split('max_id=')[1].split('&')[0]
+        except:  # There isn't a next batch of tweets.
+            return None
+        return dict(state, count=newCount, args=dict(state['args'], max_id=next_max_id))
+
+    pager = Pager(api, 'search', str(query_terms))
+    for result in pager.pages({'args': query, 'count': count}, advance):
+        logger.info('*** TWITTER search starts with: %s:%s ***' % (query_terms[0], str(pager.state['args'].get('max_id', 0))))
+        push_search_results.delay(result)
+
+    requeue_pager(self, pager)
 
 
 @app.task(name='twitter_tasks.push_search_results', bind=True)
@@ -187,21 +319,24 @@ def push_search_results(self, search_results, cacheKey=False):
 
     pushTwitterUsers.delay(users)
 
-    pushRenderedMultiUserTweets2Neo.delay(decomposed_tweets)
+    if write_behind:
+        buffer_graph_write('tweets', dump=decomposed_tweets)
+    else:
+        pushRenderedMultiUserTweets2Neo.delay(decomposed_tweets)
 
 
 @app.task(name='twitter_tasks.pushRenderedMultiUserTweets2Neo', bind=True)
+@neo_write_task
 def pushRenderedMultiUserTweets2Neo(self, all_tweets_dump):
-    db = get_neo_driver()
-    multiUserTweetDump2Neo(db, all_tweets_dump)
-    db.close()
+    multiUserTweetDump2Neo(neo_driver(), all_tweets_dump)
 
 
 @app.task(name='twitter_tasks.pushRenderedTweets2Neo', bind=True)
-def pushRenderedTweets2Neo(self, user, tweetDump):
-    db = get_neo_driver()
-    tweetDump2Neo(db, user, tweetDump)
-    db.close()
+@neo_write_task
+def pushRenderedTweets2Neo(self, user, tweetDump, fetch=None, highWater=0):
+    tweetDump2Neo(neo_driver(), user, tweetDump)
+    if fetch:
+        page_written(user, fetch, highWater)
 
 
 @app.task(name='twitter_tasks.pushRenderedTweets2Solr', bind=True)
@@ -210,7 +345,7 @@ def pushRenderedTweets2Solr(self, tweets):
 
 
 @app.task(name='twitter_tasks.pushTweets', bind=True)
-def pushTweets(self, tweets, user, cacheKey=False):
+def pushTweets(self, tweets, user, cacheKey=False, fetch=None, highWater=0):
     """ Dump a set of tweets from a given user's timeline to Neo4J/Solr.
 
     Positional arguments:
@@ -219,24 +354,30 @@ def pushTweets(self, tweets, user, cacheKey=False):
     
     Keyword arguments:
     cacheKey -- a Redis key that identifies an on-going task to grab a user's timeline
+    fetch -- identifies the timeline fetch the tweets are a page of, the user's mark moves once it's all written
+    highWater -- the newest tweet id of the whole fetch, set with the last tweets
     
     """
     logger.info('Executing pushTweets task id {0.id}, task parent id {0.parent_id}, root id {0.root_id}'.format(self.request))
 
     tweetDump = decomposeTweets(tweets)  # Extract mentions, URLs, replies hashtags etc...
 
-    pushRenderedTweets2Neo.delay(user, tweetDump)
+    if write_behind:
+        buffer_graph_write('tweets', dump=tweetDump, user=user, fetch=fetch, highWater=highWater)
+    else:
+        pushRenderedTweets2Neo.delay(user, tweetDump, fetch=fetch, highWater=highWater)
         
     for label in ['tweet', 'retweet', 'quotetweet']:
         pushRenderedTweets2Solr.delay([t[0] for t in tweetDump[label]])
 
     if cacheKey: # These are the last Tweets, tell the scraper we're done.
-        cache.set(cacheKey, 'done')
+        finish_lane(cacheKey, user)
         logger.info('*** %s: DONE WITH TWEETS ***' % user) 
 
 
 @app.task(name='twitter_tasks.getTweets', bind=True)
-def getTweets(self, user, maxTweets=3000,  count=0, tweetId=0, cacheKey=False, credentials=False):
+def getTweets(self, user, maxTweets=3000,  count=0, tweetId=0, cacheKey=False, credentials=False, sinceId=None,
+    newestId=0):
     logger.info('Executing getTweets task id {0.id}, args: {0.args!r} kwargs: {0.kwargs!r}'.format(self.request))
     logger.info('task parent id {0.parent_id}, root id {0.root_id}'.format(self.request))
     """Get tweets from the timeline of the given user, push them to Neo4J.
@@ -247,53 +388,69 @@ def getTweets(self, user, maxTweets=3000,  count=0, tweetId=0, cacheKey=False, c
     Keyword arguments:
     maxTweets -- The maximum number of tweets to retrieve
     cacheKey -- a Redis key that identifies an on-going task to grab a user's timeline
-    count -- The number of tweets already retrieved, set when the task calls itself
-    tweetId -- The maximum tweet ID to retrieve, set when the task calls itself
+    count -- The number of tweets already retrieved
+    tweetId -- The maximum tweet ID to retrieve
+    sinceId -- Only retrieve tweets newer than this, defaults to the newest tweet already stored, 0 for all of them
+    newestId -- The newest tweet ID already retrieved
     
     """
-    api = RatedTwitter(credentials=credentials)
-    limit = api.get_user_timeline_wait()
-    if limit:
-        logger.info('*** TWITTER RATE-LIMITED: statuses.user_timeline: %s:%d  ***' % (user, str(count)))
-        raise getTweets.retry(countdown=limit)
-    else:
-        args = {'screen_name': user, 'exclude_replies': False, 'include_rts': True, 'trim_user': False, 'count': 200}
-        if tweetId:
-            args['max_id'] = tweetId
-
-        okay, result = api.get_user_timeline(**args)
+    lease = lease_fetch(self, 'tweets', user, cacheKey)
+    if not lease:
+        return
 
-        if okay:
-            logger.info('*** TWITTER USER_TIMELINE: %s:%s ***' % (user, str(tweetId)))
-            if result:
-                newCount = count + len(result)
-                if maxTweets:
-                    if newCount > maxTweets: # No need for the task to call itself again.
-                        pushTweets.delay(result, user, cacheKey=cacheKey) # Give pushTweets the cache-key to end the job.
-                        return
-                    else:
-                        pushTweets.delay(result, user)
-
-                newTweetId = min([t['id'] for t in result]) - 1
-                # Not done yet, the task calls itself with an updated count and tweetId.
-                getTweets.delay(user, maxTweets=maxTweets, count=newCount, tweetId=newTweetId, cacheKey=cacheKey, credentials=credentials)
-            else:
-                pushTweets.delay([], user, cacheKey=cacheKey)  # Nothing more found, so tell pushTweets the job is done.
+    api = RatedTwitter(credentials=credentials)
+    if sinceId is None:
+        sinceId = high_water(user)
+    args = {'screen_name': user, 'exclude_replies': False, 'include_rts': True, 'trim_user': False, 'count': 200}
+    if tweetId:
+        args['max_id'] = tweetId
+    if sinceId:
+        args['since_id'] = sinceId
+
+    def advance(state, result):
+        if not result:  # Nothing more found, so the job is done.
+            return None
+        ids = [t['id'] for t in result]
+        newCount = state['count'] + len(result)
+        # No need for another page if we've got enough, or caught up with the stored tweets.
+        if (maxTweets and newCount > maxTweets) or (sinceId and min(ids) <= sinceId):
+            return None
+        return dict(state, count=newCount, newest=max([state['newest']] + ids),
+            args=dict(state['args'], max_id=min(ids) - 1))
+
+    pager = Pager(api, 'get_user_timeline', user)
+    for result in pager.pages({'args': args, 'count': count, 'newest': newestId, 'fetch': uuid4().hex}, advance):
+        logger.info('*** TWITTER USER_TIMELINE: %s:%s:%s ***' % (user, str(pager.state['args'].get('max_id', 0)),
+            str(sinceId)))
+        renew_lease(cacheKey)
+        lease.renew()
+        # A resumed fetch carries on counting its pages under the same id, from the checkpoint.
+        fetch = pager.state['fetch']
+        page_sent(fetch)
+        if pager.last:
+            # Give pushTweets the cache-key to end the job, and the newest id to mark it as stored.
+            newest = max([pager.state['newest']] + [t['id'] for t in result])
+            pushTweets.delay(result, user, cacheKey=cacheKey, fetch=fetch, highWater=newest)
+            if sinceId and not pager.state['count'] and not result:
+                logger.info('*** %s: NO NEW TWEETS SINCE %s ***' % (user, str(sinceId)))
         else:
-            if result == '404':
-                db = get_neo_driver()
-                setUserDefunct(db, user)
-                db.close()
-            cache.set('scrape_tweets_' + self.request.root_id, 'done')
-            if result == 'limited':
-                raise getTweets.retry(countdown=api.get_user_timeline_wait())
+            pushTweets.delay(result, user, fetch=fetch)
+
+    requeue_pager(self, pager, cacheKey, lease)
+    if pager.status == 'done':
+        lease.finish()
+    else:
+        lease.release()
+        if pager.status == '404':
+            setUserDefunct(neo_driver(), user)
+        if cacheKey:
+            finish_lane(cacheKey, user)
 
 
 @app.task(name='twitter_tasks.pushRenderedConnections2Neo', bind=True)
+@neo_write_task
 def pushRenderedConnections2Neo(self, user, renderedTwits, friends=True):
-    db = get_neo_driver()
-    connections2Neo(db, user,renderedTwits,friends=friends)
-    db.close()
+    connections2Neo(neo_driver(), user,renderedTwits,friends=friends)
 
 
 @app.task(name='twitter_tasks.pushTwitterConnections', bind=True)
@@ -317,10 +474,14 @@ def pushTwitterConnections(self, twits, user, friends=True, cacheKey=False):
     
     if twits:
         rendered_twits = [renderTwitterUser(twit) for twit in twits]
-        pushRenderedConnections2Neo.delay(user, rendered_twits, friends=friends)
+        if write_behind:
+            buffer_graph_write('connections', user=user, twits=rendered_twits, friends=friends)
+        else:
+            pushRenderedConnections2Neo.delay(user, rendered_twits, friends=friends)
+        extend_rings(user, rendered_twits)
 
     if cacheKey:  # These are the last connections, tell the scraper we're done.
-        cache.set(cacheKey, 'done')
+        finish_lane(cacheKey, user)
         logger.info('*** %s: DONE WITH %s ***' % (user, job))
 
 
@@ -334,48 +495,162 @@ def getTwitterConnections(self, user, friends=True, cursor=-1, credentials=False
     Keyword arguments:
     friends -- "twits" are the user's friends if True, (default) else they're followers 
     cacheKey -- a Redis key that identifies an on-going task to grab a user's friends or followers
-    cursor -- Id of the next block of connections to retrieve, set when the task calls itself
+    cursor -- Id of the first block of connections to retrieve
     """
     api = RatedTwitter(credentials=credentials)
     if friends:
-        method = api.get_friends_list
-        limit = api.get_friends_list_wait()
         method_name = 'get_friends_list'
     else:
-        method = api.get_followers_list
-        limit = api.get_followers_list_wait()
         method_name = 'get_followers_list'
-    
-    if limit:
-        logger.info('*** TWITTER RATE-LIMITED: %s:%s ***' % (method_name, str(cursor)))
-        raise getTwitterConnections.retry(countdown=limit)
+
+    lease = lease_fetch(self, 'friends' if friends else 'followers', user, cacheKey)
+    if not lease:
+        return
+
+    pager = Pager(api, method_name, user)
+    # We can get a maximum of 200 connections at once.
+    for result in pager.pages({'args': {'screen_name': user, 'cursor': cursor, 'count': 200}}, next_cursor):
+        logger.info('*** TWITTER CURSOR: %s:%s:%s ***' % (method_name, user, str(pager.state['args']['cursor'])))
+        renew_lease(cacheKey)
+        lease.renew()
+        if pager.last:
+            pushTwitterConnections.delay(result['users'], user, friends=friends, cacheKey=cacheKey) # All done, send the cacheKey.
+        else:
+            pushTwitterConnections.delay(result['users'], user, friends=friends)
+
+    requeue_pager(self, pager, cacheKey, lease)
+    if pager.status == 'done':
+        lease.finish()
     else:
-        okay, result = method(screen_name=user, cursor=cursor, count=200)  # We can get a maximum of 200 connections at once.
-        if okay:
-            logger.info('*** TWITTER CURSOR: %s:%s:%s ***' % (method_name, user, str(cursor)))
-            twits = result['users']
-            next_cursor = result.get('next_cursor', False)
-            if next_cursor: # Unless the next cursor is 0, we're not done yet.
-                getTwitterConnections.delay(user, friends=friends, cursor=next_cursor, cacheKey=cacheKey, credentials=credentials)
-                pushTwitterConnections.delay(twits, user, friends=friends)
+        lease.release()
+        if pager.status == '404':
+            setUserDefunct(neo_driver(), user)
+        if cacheKey:
+            finish_lane(cacheKey, user)
+
+
+@app.task(name='twitter_tasks.pushTwitterConnectionIds', bind=True)
+@neo_write_task
+def pushTwitterConnectionIds(self, ids, user, friends=True, hydrate=True, last=False, cacheKey=False):
+    """Push the ids of the Twitter connections of a given user to Neo4J, queue new ones to have their profiles
+    looked up.
+
+    Positional arguments:
+    ids -- a list of Twitter user ids
+    user -- The screen_name of the user
+
+    Keyword arguments:
+    friends -- "ids" are the user's friends if True, (default) else they're followers
+    hydrate -- look up the profiles of new users, unless the user is a supernode
+    last -- these are the last of the user's connections
+    cacheKey -- a Redis key that identifies an on-going task to grab a user's friends or followers
+    """
+    db = neo_driver()
+    if ids:
+        unhydrated, known = connection_ids2Neo(db, user, ids, friends=friends)
+        extend_rings(user, known)
+        if hydrate and unhydrated:
+            friends_count, followers_count = user_counts(db, user)
+            if friends and friends_count > SUPERNODE_FOLLOWING or not friends and followers_count > SUPERNODE_FOLLOWERS:
+                logger.info('*** %s IS A SUPERNODE, NOT HYDRATING ***' % user)
             else:
-                pushTwitterConnections.delay(twits, user, friends=friends, cacheKey=cacheKey) # All done, send the cacheKey.
-                    
-        else:
-            if result == 'limited':
-                raise getTwitterConnections.retry(exc=Exception('Twitter rate-limited', method_name), countdown=API_TIMEOUT)
-            if result == '404':
-                db = get_neo_driver()
-                setUserDefunct(db, user)
-                db.close()
-                if friends:
-                    cache.set('scrape_friends_' + self.request.root_id, 'done')
-                else:
-                    cache.set('scrape_followers_' + self.request.root_id, 'done')
+                await_hydration(user, unhydrated)
+                queued = cache.sadd('hydrate_user_ids', *unhydrated)
+                if queued and cache.scard('hydrate_user_ids') >= HYDRATE_BATCH_SIZE:
+                    hydrateUsers.delay()
+
+    if last:  # Hydrate whatever's left over, and tell the scraper we're done.
+        if hydrate:
+            hydrateUsers.delay()
+        if cacheKey:
+            finish_lane(cacheKey, user)
+        logger.info('*** %s: DONE WITH %s IDS ***' % (user, 'FRIENDS' if friends else 'FOLLOWERS'))
+
+
+@app.task(name='twitter_tasks.getTwitterConnectionIds', bind=True)
+def getTwitterConnectionIds(self, user, friends=True, cursor=-1, credentials=False, cacheKey=False, hydrate=True):
+    """Get the ids of the connections of the given user, push them to Neo4J and look up new users in batches.
+
+    Positional arguments:
+    user -- The screen_name of the user
+
+    Keyword arguments:
+    friends -- get the user's friends if True, (default) else their followers
+    cacheKey -- a Redis key that identifies an on-going task to grab a user's friends or followers
+    cursor -- Id of the first block of connections to retrieve
+    hydrate -- look up the profiles of new users
+    """
+    api = RatedTwitter(credentials=credentials)
+    if friends:
+        method_name = 'get_friends_ids'
+    else:
+        method_name = 'get_followers_ids'
+
+    lease = lease_fetch(self, 'friends' if friends else 'followers', user, cacheKey)
+    if not lease:
+        return
+
+    pager = Pager(api, method_name, user)
+    for result in pager.pages({'args': {'screen_name': user, 'cursor': cursor, 'count': 5000}}, next_cursor):
+        logger.info('*** TWITTER CURSOR: %s:%s:%s ***' % (method_name, user, str(pager.state['args']['cursor'])))
+        renew_lease(cacheKey)
+        lease.renew()
+        pushTwitterConnectionIds.delay(result['ids'], user, friends=friends, hydrate=hydrate, last=pager.last,
+            cacheKey=cacheKey if pager.last else False)
+
+    requeue_pager(self, pager, cacheKey, lease)
+    if pager.status == 'done':
+        lease.finish()
+    else:
+        lease.release()
+        if pager.status == '404':
+            setUserDefunct(neo_driver(), user)
+        if cacheKey:
+            finish_lane(cacheKey, user)
+
+
+@app.task(name='twitter_tasks.hydrateUsers', bind=True)
+def hydrateUsers(self, credentials=False):
+    """Look up the profiles of up to 100 users queued by pushTwitterConnectionIds, and store them in Neo4J."""
+    ids = [i.decode('utf-8') for i in cache.spop('hydrate_user_ids', HYDRATE_BATCH_SIZE) or []]
+    if not ids:
+        return
+
+    # Only spend a call from the rate limit once there's something to look up.
+    api = RatedTwitter(credentials=credentials)
+    limit = api.lookup_user_wait()
+    if limit:
+        logger.info('*** TWITTER RATE-LIMITED: lookup_user ***')
+        cache.sadd('hydrate_user_ids', *ids)
+        raise hydrateUsers.retry(countdown=limit)
+
+    okay, result = api.lookup_user(user_id=','.join(ids))
+    if okay:
+        logger.info('*** HYDRATED %d OF %d USERS ***' % (len(result), len(ids)))
+        pushTwitterUsers.delay(result)
+        extend_hydrated(ids, [renderTwitterUser(twit) for twit in result])
+    elif result == 'limited':
+        cache.sadd('hydrate_user_ids', *ids)
+        raise hydrateUsers.retry(countdown=max(1, blocked_for(api.handle, 'lookup_user')))
+    elif result != '404':  # A 404 means none of them exist any more.
+        cache.sadd('hydrate_user_ids', *ids)
+    else:
+        extend_hydrated(ids)
+
+    if cache.scard('hydrate_user_ids') >= HYDRATE_BATCH_SIZE:
+        hydrateUsers.delay(credentials=credentials)
+
+
+def connections_task():
+    """The task that crawls connections, depending on CONNECTION_CRAWL_MODE."""
+    if CONNECTION_CRAWL_MODE == 'ids':
+        return getTwitterConnectionIds
+    else:
+        return getTwitterConnections
 
 
 @app.task(name='twitter_tasks.seedUser', bind=True)
-def seedUser(self, user, scrape=False, credentials=False):
+def seedUser(self, user, scrape=False, credentials=False, parallelism=SCRAPE_PARALLELISM):
     """Retrieve the given Twitter user's account, and their timelines, friends and followers. Optionally, start scraping around them."""
     logger.info('*** SEEDING: %s ***' % (user,))
     logger.info('Executing getTweets task id {0.id}, args: {0.args!r} kwargs: {0.kwargs!r}'.format(self.request))
@@ -383,143 +658,274 @@ def seedUser(self, user, scrape=False, credentials=False):
 
     if scrape:
         chain(getTwitterUsers.s([user], credentials=credentials),
-              getTwitterConnections.si(user, credentials=credentials), getTwitterConnections.si(user, credentials=credentials, friends=False),
-              getTweets.si(user, maxTweets=1000, credentials=credentials), startUserScrape.si(user, credentials=credentials))()
+              connections_task().si(user, credentials=credentials), connections_task().si(user, credentials=credentials, friends=False),
+              getTweets.si(user, maxTweets=1000, credentials=credentials), startUserScrape.si(user, credentials=credentials,
+              parallelism=parallelism))()
     else:
-        chain(getTwitterUsers.s([user], credentials=credentials), getTwitterConnections.si(user, credentials=credentials),
-              getTwitterConnections.si(user, credentials=credentials, friends=False),
+        chain(getTwitterUsers.s([user], credentials=credentials), connections_task().si(user, credentials=credentials),
+              connections_task().si(user, credentials=credentials, friends=False),
               getTweets.si(user, maxTweets=1000, credentials=credentials))()
 
 
+scrape_lanes = ['friends', 'followers', 'tweets']
+
+# The root task ids of the scrapes that are running, so a restarted worker can resume them.
+scrapes_key = 'scrape_roots'
+
+
+def lane_key(lane, root_id, slot=0):
+    return '_'.join(['scrape', lane, str(slot), root_id])
+
+
+def in_flight_key(lane, root_id):
+    return '_'.join(['scrape', lane, 'users', root_id])
+
+
+def lane_method(lane):
+    """The API method that a lane's jobs spend their rate limit on."""
+    if lane == 'tweets':
+        return 'get_user_timeline'
+    if CONNECTION_CRAWL_MODE == 'ids':
+        return 'get_%s_ids' % lane
+    return 'get_%s_list' % lane
+
+
+def lane_slots(lane, parallelism, credentials=False):
+    """How many of a lane's <parallelism> slots to fill: no more than there are calls left in the rate limit."""
+    if credentials:
+        handles = ['user_']
+    else:
+        handles = live_handles(list(pool_credentials().keys()))
+    budget = sum(available(handles, lane_method(lane)).values())
+    return max(1, min(parallelism, int(budget)))
+
+
+def claim_user(lane, root_id, candidates):
+    """Return the first of the candidates that isn't already being fetched by one of the lane's slots."""
+    for user in candidates:
+        if cache.sadd(in_flight_key(lane, root_id), user):
+            return user
+    return None
+
+
+def fetch_lane(lane, user, cache_key, credentials=False):
+    """Start the job that fetches <user>'s friends, followers or tweets for a crawl lane."""
+    if lane == 'tweets':
+        getTweets.delay(user, maxTweets=1000, credentials=credentials, cacheKey=cache_key)
+    else:
+        connections_task().delay(user, friends=(lane == 'friends'), credentials=credentials, cacheKey=cache_key)
+
+
+def fill_lanes(root_id, candidates, parallelism=1, credentials=False):
+    """Give each idle slot of each lane a user to fetch.
+
+    Positional arguments:
+    root_id -- the id of the task that started the scrape
+    candidates -- a function of a lane that returns an iterable of the next users for it
+    """
+    for lane in scrape_lanes:
+        slots = lane_slots(lane, parallelism, credentials)
+        idle = 0
+        for slot in range(parallelism):
+            key = lane_key(lane, root_id, slot)
+            # Slots over the rate limit's budget are only claimed to finish a job whose lease ran out.
+            claimed, user = claim_slot(key, root_id, abandoned_only=(slot >= slots))
+            if not claimed:
+                continue
+            idle += 1
+            if user:
+                logger.info('*** LEASE EXPIRED, RESUMING %s FOR %s ***' % (lane.upper(), user))
+            else:
+                user = claim_user(lane, root_id, candidates(lane))
+            if user:
+                assign_slot(key, root_id, user)
+                fetch_lane(lane, user, key, credentials=credentials)
+            else:
+                cache.set(key, 'done')
+        if not idle:
+            logger.info('*** %s BUSY ***' % lane.upper())
+
+
+def lanes_running(root_id):
+    """Whether any of the scrape's slots have a job that hasn't finished, even one whose lease has run out."""
+    return slots_in_use(root_id) > 0
+
+
+def wake_scrape(root_id):
+    """Run the scrape started by the task <root_id> straight away, to hand out work to its idle lanes."""
+    mode = cache.get('scrape_mode_' + root_id)
+    options = cache.get('scrape_options_' + root_id)
+    options = json.loads(options.decode('utf-8')) if options else {}
+    if mode and mode.decode('utf-8') == 'default':
+        doDefaultScrape.delay(root_id=root_id, **options)
+    elif mode and mode.decode('utf-8') == 'user':
+        doUserScrape.delay(root_id=root_id, **options)
+
+
+def finish_lane(cache_key, user):
+    """Tell a scrape that the job for <user> in one of its lanes is done, so the next one is dispatched right away."""
+    scrape, lane, slot, root_id = cache_key.split('_', 3)
+    cache.srem(in_flight_key(lane, root_id), user)
+    if release_slot(cache_key, root_id, user):
+        wake_scrape(root_id)
+
+
+def forget_scrape(root_id):
+    """Clear the lanes of a scrape that's finished or been stopped, so it isn't resumed."""
+    pipe = cache.pipeline()
+    pipe.srem(scrapes_key, root_id)
+    pipe.delete(slot_users_key(root_id), *[in_flight_key(lane, root_id) for lane in scrape_lanes])
+    pipe.execute()
+
+
+def watch_scrape(task, root_id, **kwargs):
+    """Check on a scrape every SCRAPE_WATCHDOG seconds, in case the message that should have woken it was lost."""
+    if cache.set('scrape_watchdog_' + root_id, 'true', nx=True, ex=SCRAPE_WATCHDOG):
+        task.apply_async(kwargs=dict(kwargs, root_id=root_id), countdown=SCRAPE_WATCHDOG)
+
+
 @app.task(name='twitter_tasks.startScrape', bind=True)
-def startScrape(self, latest=False, credentials=False):
+def startScrape(self, latest=False, credentials=False, parallelism=SCRAPE_PARALLELISM):
     """Start the default scrape, retrieving the users that need timelines, friends or followers updated,
-    in the order that they were first added. """
+    in the order that they were first added.
+
+    Keyword arguments:
+    parallelism -- the most users each lane fetches at once, fewer if the rate limit is running low
+    """
     logger.info('*** STARTED SCRAPING: DEFAULT: ***') 
     cache.set('default_scrape_' + self.request.root_id, 'true')
     cache.set('scrape_mode_' + self.request.root_id, 'default')
+    cache.set('scrape_options_' + self.request.root_id, json.dumps({'latest': latest, 'credentials': credentials,
+        'parallelism': parallelism}))
     
-    for key in ['scrape_friends', 'scrape_followers', 'scrape_tweets']:
-        cache.set(key + '_' + self.request.root_id, '')
-    
-    doDefaultScrape.delay(latest=latest, credentials=credentials)
+    forget_scrape(self.request.root_id)
+    cache.sadd(scrapes_key, self.request.root_id)
+
+    doDefaultScrape.delay(latest=latest, credentials=credentials, parallelism=parallelism,
+        root_id=self.request.root_id)
 
 
 @app.task(name='twitter_tasks.doDefaultScrape', bind=True)
-def doDefaultScrape(self, latest=False, credentials=False):
-    """Retrieve the tweets, friends or followers of trhe next users in the default scrape."""
-    keep_going = cache.get('default_scrape_' + self.request.root_id)
+def doDefaultScrape(self, latest=False, credentials=False, parallelism=1, root_id=None):
+    """Retrieve the tweets, friends or followers of the next users in the default scrape, for each idle lane.
+
+    Runs whenever one of the scrape's jobs finishes.
+    """
+    root_id = root_id or self.request.root_id
+    keep_going = cache.get('default_scrape_' + root_id)
     if (not keep_going) or keep_going.decode('utf-8') != 'true':
         logger.info('*** STOPPED DEFAULT SCRAPE ***') 
+        forget_scrape(root_id)
         return False
     
     logger.info('*** SCRAPING... ***')
 
-    this_friend = cache.get('scrape_friends_' + self.request.root_id)
-    if (not this_friend) or this_friend.decode('utf-8') == 'done':
-        cache.set('scrape_friends_' + self.request.root_id, 'running')
-        getTwitterConnections.delay(whoNext('friends', latest=latest),  credentials=credentials, cacheKey='scrape_friends_' + self.request.root_id)
-    else:
-        logger.info('*** FRIENDS BUSY ***')
+    def candidates(lane):
+        next_user = nextFromFrontier(lane, latest=latest)
+        while next_user:
+            yield next_user
+            next_user = nextFromFrontier(lane, latest=latest)
 
-    this_follower = cache.get('scrape_followers_' + self.request.root_id)
-    if (not this_follower) or this_follower.decode('utf-8') == 'done':
-        cache.set('scrape_followers_' + self.request.root_id, 'running')
-        getTwitterConnections.delay(whoNext('friends', latest=latest), credentials=credentials, friends=False, cacheKey='scrape_followers_' + self.request.root_id)
-    else:
-        logger.info('*** FOLLOWERS BUSY ***')
+    fill_lanes(root_id, candidates, parallelism=parallelism, credentials=credentials)
 
-    this_tweet = cache.get('scrape_tweets_' + self.request.root_id)
-    if (not this_tweet) or this_tweet.decode('utf-8') == 'done':
-        cache.set('scrape_tweets_' + self.request.root_id, 'running')
-        getTweets.delay(whoNext('tweets', latest=latest), maxTweets=1000, credentials=credentials, cacheKey='scrape_tweets_' + self.request.root_id)
+    if not lanes_running(root_id) and wait_for_frontier(scrape_lanes, timeout=FRONTIER_WAIT):
+        # Nothing was left to crawl, until now.
+        doDefaultScrape.delay(latest=latest, credentials=credentials, parallelism=parallelism, root_id=root_id)
     else:
-        logger.info('*** TWEETS BUSY ***')
-                    
-    doDefaultScrape.apply_async(kwargs={'latest': latest}, credentials=credentials, countdown=30)
+        watch_scrape(doDefaultScrape, root_id, latest=latest, credentials=credentials, parallelism=parallelism)
 
 
 @app.task(name='twitter_tasks.startUserScrape', bind=True)
-def startUserScrape(self, user, credentials=False):
-    """Start scraping around the given user."""
+def startUserScrape(self, user, credentials=False, parallelism=SCRAPE_PARALLELISM):
+    """Start scraping around the given user.
+
+    Keyword arguments:
+    parallelism -- the most users each lane fetches at once, fewer if the rate limit is running low
+    """
     logger.info('*** STARTED SCRAPING: USER: %s ***' % (user,))
     cache.set('user_scrape_' + self.request.root_id, 'true')
     cache.set('scrape_mode_' + self.request.root_id, 'user')
     cache.set('scrape_user_' + self.request.root_id, user)
+    cache.set('scrape_options_' + self.request.root_id, json.dumps({'credentials': credentials,
+        'parallelism': parallelism}))
 
     # add crawl node for this user as centre of scrape
-    db = get_neo_driver()
-    start_user_crawl(db, user, crawl_task=self.request.root_id, status='initiated')
-    db.close()
+    start_user_crawl(neo_driver(), user, crawl_task=self.request.root_id, status='initiated')
 
-    for key in ['scrape_friends', 'scrape_followers', 'scrape_tweets']:
-        cache.set(key + '_' + self.request.root_id, '')
-        
-    for job in ['friends', 'followers', 'tweets']:
-        cache_key = '_'.join(['nextnearest', job, user, self.request.root_id])
-        cache.set(cache_key, '')
+    forget_scrape(self.request.root_id)
+    cache.sadd(scrapes_key, self.request.root_id)
+
+    start_rings(neo_driver(), user, self.request.root_id)
         
-    doUserScrape.delay(credentials=credentials)
+    doUserScrape.delay(credentials=credentials, parallelism=parallelism, root_id=self.request.root_id)
 
 
 @app.task(name='twitter_tasks.doUserScrape', bind=True)
-def doUserScrape(self, credentials=False):
-    """Retrieve the next timelines, friends and followers for the next accounts in the user scrape. """
-    keep_going = cache.get('user_scrape_' + self.request.root_id)
+def doUserScrape(self, credentials=False, parallelism=1, root_id=None):
+    """Retrieve the next timelines, friends and followers for the next accounts in the user scrape, for each idle lane.
+
+    Runs whenever one of the scrape's jobs finishes.
+    """
+    root_id = root_id or self.request.root_id
+    keep_going = cache.get('user_scrape_' + root_id)
     if (not keep_going) or keep_going.decode('utf-8') != 'true':
         logger.info('*** STOPPED USER SCRAPE ***')
         # mark crawl as stopped on crawl node
-        db = get_neo_driver()
-        update_crawl(db, crawl_task=self.request.root_id, status='done')
-        db.close()
+        update_crawl(neo_driver(), crawl_task=root_id, status='done')
+        stop_rings(root_id)
+        forget_scrape(root_id)
         return False
 
-    user = cache.get('scrape_user_' + self.request.root_id).decode('utf-8')
+    user = cache.get('scrape_user_' + root_id).decode('utf-8')
     logger.info('*** SCRAPING USER: %s... ***' % (user,))
 
-    this_friend = cache.get('scrape_friends_' + self.request.root_id).decode('utf-8')
-    if (not this_friend) or this_friend == 'done':
-        db = get_neo_driver()
-        next_friends = nextNearest(db, user, 'friends', self.request.root_id)
-        db.close()
-        if next_friends:
-            cache.set('scrape_friends_' + self.request.root_id, 'running')
-            getTwitterConnections.delay(next_friends, cacheKey='scrape_friends_' + self.request.root_id)
-    else:
-        logger.info('*** FRIENDS BUSY ***')
-
-    this_follower = cache.get('scrape_followers_' + self.request.root_id).decode('utf-8')
-    if (not this_follower) or this_follower == 'done':
-        db = get_neo_driver()
-        next_followers = nextNearest(db, user, 'followers', self.request.root_id)
-        db.close()
-        if next_followers:
-            cache.set('scrape_followers_' + self.request.root_id, 'running')
-            getTwitterConnections.delay(next_followers, friends=False, cacheKey='scrape_followers_' + self.request.root_id)
-    else:
-        logger.info('*** FOLLOWERS BUSY ***')
+    def candidates(lane):
+        # Skip over a few users that other slots are already fetching, then give up until one of them is done.
+        for attempt in range(20):
+            next_user = nextNearest(user, lane, root_id)
+            if not next_user:
+                return
+            yield next_user
 
-    this_tweet = cache.get('scrape_tweets_' + self.request.root_id).decode('utf-8')
-    if (not this_tweet) or this_tweet == 'done':
-        db = get_neo_driver()
-        next_tweets = nextNearest(db, user, 'tweets', self.request.root_id)
-        db.close()
-        if next_tweets:
-            cache.set('scrape_tweets_' + self.request.root_id, 'running')
-            getTweets.delay(next_tweets, maxTweets=1000, credentials=credentials, cacheKey='scrape_tweets_' + self.request.root_id)
-    else:
-        logger.info('*** TWEETS BUSY ***')
+    fill_lanes(root_id, candidates, parallelism=parallelism, credentials=credentials)
 
-    if 'running' in [cache.get(k).decode('utf-8') for k in
-                     ['scrape_friends_' + self.request.root_id, 'scrape_followers_' + self.request.root_id,
-                      'scrape_tweets_' + self.request.root_id]]:
-        doUserScrape.apply_async(countdown=30, credentials=credentials)
+    if lanes_running(root_id):
+        watch_scrape(doUserScrape, root_id, credentials=credentials, parallelism=parallelism)
     else:
-        cache.set('user_scrape_' + self.request.root_id, 'false')
-        cache.set('scrape_mode_' + self.request.root_id, '')
+        cache.set('user_scrape_' + root_id, 'false')
+        cache.set('scrape_mode_' + root_id, '')
+        stop_rings(root_id)
+        forget_scrape(root_id)
         logger.info('*** FINISHED SCRAPING USER: %s ***' % (user,))
 
 
+@app.task(name='twitter_tasks.resumeScrape', bind=True)
+def resumeScrape(self, root_id):
+    """Carry on with a scrape after its workers were restarted.
+
+    Its frontier or rings, the users its lanes were fetching and their paging checkpoints are all still in Redis, so
+    nothing is queried or fetched again. Slots whose leases have run out are handed their users again, and the
+    watchdog is started afresh, in case its message was lost with the worker.
+
+    Positional arguments:
+    root_id -- the id of the task that started the scrape
+    """
+    if not cache.sismember(scrapes_key, root_id):
+        logger.info('*** NO SCRAPE TO RESUME: %s ***' % root_id)
+        return False
+    logger.info('*** RESUMING SCRAPE: %s, %d SLOTS IN USE ***' % (root_id, slots_in_use(root_id)))
+    cache.delete('scrape_watchdog_' + root_id)
+    wake_scrape(root_id)
+    return True
+
+
+@worker_ready.connect
+def resume_scrapes(sender=None, **kwargs):
+    """Resume every scrape that was running when the worker started."""
+    for root_id in cache.smembers(scrapes_key):
+        resumeScrape.delay(root_id.decode('utf-8'))
+
+
 
 # currently does simplistic cache value based halt. The effect is that the next time round on the loop, the
 # executing scrape will test for keep going and see 'false' instead of true and stop gracefully at that point.
@@ -0,0 +1,58 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""
+A pool of application and user tokens for the Twitter API.
+
+Each token has its own handle, so each has its own rate-limit bucket for every endpoint. Calls go to the token
+with the most budget left for the endpoint. Tokens that are refused with a 401 are dropped by every worker.
+"""
+
+import hashlib
+import logging
+
+from db_settings import cache
+from twitter_settings import (ACCESS_TOKEN, CONSUMER_KEY, CONSUMER_SECRET, TWITTER_APP_TOKENS,
+    TWITTER_USER_TOKENS)
+from twitter_tools.rate_limits import available
+
+dropped_key = 'dropped_credentials'
+
+
+def token_handle(prefix, token):
+    return prefix + hashlib.sha1(token.encode('utf-8')).hexdigest()[:8] + '_'
+
+
+def pool_credentials():
+    """Return a dictionary of Twython constructor arguments for every token in the pool, keyed by handle.
+
+    The preconfigured application token keeps the handle "app_". Extra application tokens come from the
+    comma-separated TWITTER_APP_TOKENS, and user tokens from TWITTER_USER_TOKENS as "token:secret" pairs.
+    """
+    credentials = {}
+    if ACCESS_TOKEN:
+        credentials['app_'] = ((CONSUMER_KEY,), {'access_token': ACCESS_TOKEN, 'oauth_version': 2})
+    for token in TWITTER_APP_TOKENS:
+        credentials[token_handle('app_', token)] = ((CONSUMER_KEY,), {'access_token': token, 'oauth_version': 2})
+    for pair in TWITTER_USER_TOKENS:
+        token, secret = pair.split(':', 1)
+        credentials[token_handle('user_', token)] = ((CONSUMER_KEY, CONSUMER_SECRET, token, secret), {})
+    return credentials
+
+
+def drop_credential(handle):
+    """Stop every worker from using a token that Twitter has refused."""
+    if cache.sadd(dropped_key, handle):
+        logging.error('*** DROPPED TWITTER CREDENTIALS %s FROM THE POOL ***' % handle)
+
+
+def live_handles(handles):
+    dropped = set(handle.decode('utf-8') for handle in cache.smembers(dropped_key))
+    return [handle for handle in handles if handle not in dropped]
+
+
+def best_handle(handles, method_name):
+    """The live handle with the most budget left for the API method, or None if they've all been dropped."""
+    live = live_handles(handles)
+    if len(live) < 2:
+        return live[0] if live else None
+    budgets = available(live, method_name)
+    return max(live, key=lambda handle: budgets[handle])
@@ -0,0 +1,21 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""
+A counter of writes of FOLLOWS relationships to the graph.
+
+Clusterings remember the count when they were made, so if it hasn't moved, nothing they depend on can have changed.
+"""
+
+from db_settings import cache
+
+follows_version_key = 'follows_version'
+
+
+def follows_changed():
+    """Count a committed write of FOLLOWS relationships."""
+    cache.incr(follows_version_key)
+
+
+def follows_version():
+    """The number of FOLLOWS writes so far."""
+    version = cache.get(follows_version_key)
+    return int(version) if version else 0
@@ -0,0 +1,123 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""
+Filter out users, hashtags, URLs, media and tweets that have recently been written with identical content.
+
+Each node is identified by a token of its label, key and a hash of its properties, (ignoring "last_scraped").
+Tokens are held in an in-process LRU cache and in Redis sets shared by all the workers. Each set covers a window
+of "known_entity_ttl" seconds and expires after two, so a node counts as known for between one and two windows
+after it was last written. Tokens are only marked as known once the transaction that wrote them commits.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import time
+
+from db_settings import cache, known_entity_lru_size, known_entity_ttl
+
+stats_key = 'known_entity_stats'
+window_prefix = 'known_entities_'
+
+__lru__ = OrderedDict()
+
+ignored_props = ('last_scraped',)
+
+
+def content_hash(props):
+    content = {key: val for key, val in props.items() if key not in ignored_props}
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def window_keys():
+    window = int(time.time() // known_entity_ttl)
+    return window_prefix + str(window), window_prefix + str(window - 1)
+
+
+def lru_known(token, now):
+    expiry = __lru__.get(token, False)
+    if expiry and expiry > now:
+        __lru__.move_to_end(token)
+        return True
+    return False
+
+
+def mark_known(tokens):
+    """Record that the nodes identified by the tokens have been written."""
+    if not tokens:
+        return
+    now = time.time()
+    for token in tokens:
+        __lru__[token] = now + known_entity_ttl
+        __lru__.move_to_end(token)
+    while len(__lru__) > known_entity_lru_size:
+        __lru__.popitem(last=False)
+
+    current, previous = window_keys()
+    pipe = cache.pipeline()
+    pipe.sadd(current, *tokens)
+    pipe.expire(current, 2 * known_entity_ttl)
+    pipe.execute()
+
+
+def known_entity_stats():
+    """Hits, misses and hit rate of the filter for each label, across all the workers."""
+    counts = {key.decode('utf-8'): int(val) for key, val in cache.hgetall(stats_key).items()}
+    labels = set(key.rsplit('_', 1)[0] for key in counts)
+    stats = {}
+    for label in labels:
+        hits = counts.get(label + '_hits', 0)
+        misses = counts.get(label + '_misses', 0)
+        stats[label] = {'hits': hits, 'misses': misses, 'hit_rate': float(hits) / max(hits + misses, 1)}
+    return stats
+
+
+class KnownEntityFilter(object):
+    """Collects the tokens of nodes that are about to be written, so they can be marked known after the commit."""
+
+    def __init__(self):
+        self.tokens = []
+
+    def fresh(self, label, items, key_field):
+        """Return the items that haven't been written recently with the same content.
+
+        Positional arguments:
+        label -- the node label
+        items -- a list of dictionaries of node properties
+        key_field -- the property the node is MERGEd on
+        """
+        now = time.time()
+        tokens = [':'.join([label, str(item.get(key_field, '')), content_hash(item)]) for item in items]
+
+        unknown = [i for i, token in enumerate(tokens) if not lru_known(token, now)]
+        if unknown:
+            current, previous = window_keys()
+            pipe = cache.pipeline()
+            for i in unknown:
+                pipe.sismember(current, tokens[i])
+                pipe.sismember(previous, tokens[i])
+            found = pipe.execute()
+            in_redis = set(i for n, i in enumerate(unknown) if found[2 * n] or found[2 * n + 1])
+            # Remember nodes written by other workers, to save asking Redis next time.
+            for i in in_redis:
+                __lru__[tokens[i]] = now + known_entity_ttl
+        else:
+            in_redis = set()
+
+        fresh_items = []
+        for i in unknown:
+            if i not in in_redis:
+                fresh_items.append(items[i])
+                self.tokens.append(tokens[i])
+
+        hits = len(items) - len(fresh_items)
+        pipe = cache.pipeline()
+        pipe.hincrby(stats_key, label + '_hits', hits)
+        pipe.hincrby(stats_key, label + '_misses', len(fresh_items))
+        pipe.execute()
+
+        return fresh_items
+
+    def commit(self):
+        """Mark everything that passed the filter as known. Call this once the transaction has committed."""
+        mark_known(self.tokens)
+        self.tokens = []
@@ -1,87 +1,92 @@
 # Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
 
 from datetime import datetime
-from itertools import chain, starmap
 import logging
-import re
 import time
 
-noSlash = re.compile(r'\\')
+from cypher_queries import (backfill_degrees_query, connection_ids_queries, connections_queries, connections_scraped_queries,
+    entities_queries, entity_ids, entity_links_queries, entity_node_labels, entity_types, mentions_queries,
+    multi_user_connections_queries, multi_user_connections_scraped_queries, multi_user_tweet_actions_queries,
+    set_user_defunct_query, tweet_actions_queries, tweet_labels, tweet_links_queries, tweets_queries,
+    unwind_query, user_counts_query, users_query)
+from crawl.frontier import add_to_frontier, drop_from_frontier
+from db_settings import known_entity_filter
+from neo_retry import neo_retry
+from twitter_tools.graph_version import follows_changed
+from twitter_tools.known_entities import KnownEntityFilter
 
 
-def cypherVal(val):
-    """Escape quotes and slashes for use in Cypher queries."""    
-    if isinstance(val, (int, bool)):
-        return str(val).lower()
+def neo_tx(db, query, data=None):
+    if data is None:
+        neo_batch_tx(db, [(query, {})])
     else:
-        # Escape all the backslashes.
-        escval = re.sub(noSlash, r'\\\\', val)
-        escval = str(re.sub("'", "\\'", escval))
-        escval = str(re.sub('"', '\\"', escval))
-        escval = str(re.sub("\n", "\\\\n", escval))
-        return "'"+escval+"'"
+        neo_batch_tx(db, [(query, {'data': data})])
+
+
+def neo_batch_tx(db, statements):
+    """Run a list of (query, parameters) statements in a single transaction, sharing one session.
+
+    Returns the time taken to run and commit the transaction in seconds.
+    """
+    # Don't bother sending UNWIND statements with nothing to unwind, (users_query also unwinds $unidentified).
+    statements = [(query, params) for query, params in statements
+        if params.get('data', True) or params.get('unidentified')]
+    with db.session() as session:
+        def work():
+            started = time.perf_counter()
+            with session.begin_transaction() as tx:
+                for query, params in statements:
+                    tx.run(query, **params)
+            return time.perf_counter() - started
+
+        return neo_retry(work)
 
 
-def nodeRef(name, label, item):
-    properties = ' { ' + ', '.join([': '.join([prop, cypherVal(val)]) for prop, val in list(item.items())]) + ' }'
-    return '(' + str('t'+name) + ': ' + str(label) + properties + ')'
+def unwind_tx(db, data, *clauses):
+    query = unwind_query(*clauses)
+    neo_tx(db, query, data)
 
 
-def mergeNode(*nodes, **kw):
-    if kw.get('match', False):
-        action = 'MATCH '
+def new_known_filter():
+    """A filter for nodes written recently with the same content, or None if the filter is switched off."""
+    if known_entity_filter:
+        return KnownEntityFilter()
     else:
-        action = 'MERGE '
-    return action + ','.join(nodes)
+        return None
 
 
-def mergeRel(src, rel, dest):
-    return 'MERGE ({})-[:{}]->({})'.format('t'+src, rel, 't'+dest)
+def users_statement(renderedTwits, right_now=None, known=None):
+    """UNWIND statement to store a list of rendered Twitter users. No relationships are formed.
 
+    Users that <known>, (a KnownEntityFilter), has seen written recently with the same profile are skipped.
+    """
+    if right_now is None:
+        right_now = datetime.now().isoformat()
 
-def unwind_query(*clauses):
-    return '\n'.join(['UNWIND $data AS d'] + list(clauses))
+    if known is not None:
+        renderedTwits = known.fresh('twitter_user', renderedTwits, 'screen_name')
+
+    for twit in renderedTwits:
+        twit['last_scraped'] = right_now
+
+    named = [twit for twit in renderedTwits if twit.get('screen_name', False)]
+    data = [{'id': twit['id'], 'screen_name': twit['screen_name'], 'props': twit}
+        for twit in named if twit.get('id') is not None]
+    unidentified = [{'screen_name': twit['screen_name'], 'props': twit} for twit in named if twit.get('id') is None]
+
+    return (users_query, {'data': data, 'unidentified': unidentified})
 
 
-def neo_tx(db, query, data=None):
-    with db.session() as session:
-        success = False
-        tries = 0
-        max_tries = 50
-        while not success and tries < max_tries:
-            try:
-                with session.begin_transaction() as tx:
-                    if data is None:
-                        tx.run(query)
-                    else:
-                        tx.run(query, data=data)
-                success = True
-            except:
-                logging.warning('*** Neo tx failed, attempt %d ***' % (tries+1,), exc_info=True)
-                tries += 1
-                time.sleep(10)
-                
-    assert success
-                
-     
-def unwind_tx(db, data, *clauses):
-    query = unwind_query(*clauses)
-    neo_tx(db, query, data)
-     
-     
 def users2Neo(db, renderedTwits):
     """Store  a list of rendered Twitter users in Neo4J. No relationships are formed."""
     started = datetime.now()
-    right_now = started.isoformat()
-    
-    for twit in renderedTwits:
-        twit['last_scraped'] = right_now
-            
-    data = [{'screen_name': twit.get('screen_name', False), 'props':twit}
-        for twit in renderedTwits if twit.get('screen_name', False)]
-    
-    unwind_tx(db, data, 'MERGE (x:twitter_user {screen_name: d.screen_name})',
-        'SET x += d.props')
+    renderedTwits = list(renderedTwits)
+
+    known = new_known_filter()
+    neo_batch_tx(db, [users_statement(renderedTwits, started.isoformat(), known=known)])
+    if known is not None:
+        known.commit()
+    add_to_frontier(renderedTwits)
 
     how_long = (datetime.now() - started).seconds
     logging.info(
@@ -89,293 +94,268 @@ def users2Neo(db, renderedTwits):
         (len(renderedTwits), how_long))
 
 
-def connections2Neo(db, user, renderedTwits, friends=True):
-    """Add friend/follower relationships between an existing user node with screen_name <user> and
-    the rendered Twitter users."""
-    started = datetime.now()
-    right_now = started.isoformat()
-        
-    users2Neo(db, renderedTwits)
-    
-    match = ("MATCH (t:twitter_user {{screen_name: '{}'}})," +
-             " (f:twitter_user {{screen_name: d.screen_name}})").format(user)
+def connections_statements(user, renderedTwits, friends=True, right_now=None, known=None):
+    """Statements that store rendered Twitter users and their friend/follower relationships with <user>."""
+    if right_now is None:
+        right_now = datetime.now().isoformat()
 
-    if friends:
-        merge = "MERGE (t)-[:FOLLOWS]->(f)"
-        update = "SET {}.friends_last_scraped = '{}'".format('t'+user, right_now)
-    else:
-        merge = "MERGE (t)<-[:FOLLOWS]-(f)"
-        update = "SET {}.followers_last_scraped = '{}'".format('t'+user, right_now)
-            
-    query = '\n'.join(['UNWIND $data AS d', match, merge])
-    
     data = [{'screen_name': twit.get('screen_name', False)}
         for twit in renderedTwits if twit.get('screen_name', False)]
 
-    userNode = nodeRef(user, 'twitter_user', {'screen_name': user})
-    update_query = '\n'.join([mergeNode(userNode, match=True), update])
+    return [users_statement(renderedTwits, right_now, known=known),
+        (connections_scraped_queries[friends], {'user': user, 'right_now': right_now}),
+        (connections_queries[friends], {'data': data, 'user': user})]
 
-    neo_tx(db, update_query)
-    neo_tx(db, query, data=data)
 
-    how_long = (datetime.now() - started).seconds
-    logging.info(
-        '*** PUSHED %d CONNECTIONS FOR %s TO NEO IN %ds ***' %
-        (len(renderedTwits), user, how_long))
+def multi_user_connections_statements(connections, right_now=None, known=None):
+    """Statements that store the friends/followers of many users at once.
 
+    Positional arguments:
+    connections -- a list of (screen_name, rendered Twitter users, friends) tuples
+    """
+    if right_now is None:
+        right_now = datetime.now().isoformat()
 
-def tweets2Neo(db, rendered_tweets, label='tweet'):
-    started = datetime.now()
-    tweets = (t[-1] for t in rendered_tweets)
+    statements = [users_statement([twit for user, twits, friends in connections for twit in twits], right_now,
+        known=known)]
+    for friends in [True, False]:
+        scraped = [{'user': user, 'right_now': right_now} for user, twits, is_friends in connections
+            if is_friends == friends]
+        data = [{'user': user, 'screen_name': twit['screen_name']} for user, twits, is_friends in connections
+            if is_friends == friends for twit in twits if twit.get('screen_name', False)]
+        if scraped:
+            statements.append((multi_user_connections_scraped_queries[friends], {'data': scraped}))
+        if data:
+            statements.append((multi_user_connections_queries[friends], {'data': data}))
 
-    data = [{'id': tweet['id'], 'props': tweet} for tweet in tweets]
+    return statements
 
-    merge = "MERGE (x:{} {{id: d.id}})".format(label)
-    update = "SET x += d.props"
 
-    unwind_tx(db, data, merge, update)
+def connections2Neo(db, user, renderedTwits, friends=True):
+    """Add friend/follower relationships between an existing user node with screen_name <user> and
+    the rendered Twitter users."""
+    started = datetime.now()
+
+    known = new_known_filter()
+    statements = connections_statements(user, renderedTwits, friends=friends, right_now=started.isoformat(),
+        known=known)
+    commit_time = neo_batch_tx(db, statements)
+    if known is not None:
+        known.commit()
+    add_to_frontier(renderedTwits)
+    follows_changed()
 
     how_long = (datetime.now() - started).seconds
     logging.info(
-        '*** PUSHED %d TWEETS TO NEO IN %ds ***' %
-        (len(rendered_tweets), how_long))
+        '*** PUSHED %d CONNECTIONS FOR %s TO NEO IN %ds (COMMIT %.3fs) ***' %
+        (len(renderedTwits), user, how_long, commit_time))
 
 
-def tweetActions(db, user, rendered_tweets, label='tweet'):
+def connection_ids2Neo(db, user, ids, friends=True):
+    """Add friend/follower relationships between an existing user node with screen_name <user> and users only
+    known by their ids. Returns the ids of the users that still need hydrating with their full profiles, and the
+    properties of those that have them already."""
     started = datetime.now()
-    
-    actions = {'tweet': 'TWEETED', 'retweet': 'RETWEETED', 'quotetweet': 'QUOTED'}
+    right_now = started.isoformat()
 
-    match = ("MATCH (u:twitter_user {{screen_name: '{}'}})," +
-             " (t:{} {{id_str: d.id_str}})").format(user, label)
+    with db.session() as session:
+        def work():
+            with session.begin_transaction() as tx:
+                tx.run(connections_scraped_queries[friends], user=user, right_now=right_now)
+                return [tuple(record.values()) for record in tx.run(connection_ids_queries[friends], data=ids,
+                    user=user)]
 
-    merge = "MERGE (u)-[:{}]->(t)".format(actions[label])
+        records = neo_retry(work)
+    unhydrated = [user_id for user_id, props in records if props is None]
+    known = [props for user_id, props in records if props is not None]
+    follows_changed()
 
-    tweets = (t[-1] for t in rendered_tweets)
-    data = [{'id_str': tweet['id_str']} for tweet in tweets]
-
-    unwind_tx(db, data, match, merge)
-    
     how_long = (datetime.now() - started).seconds
     logging.info(
-        '*** PUSHED %d TWEET ACTIONS FOR %s TO NEO IN %ds ***' %
-        (len(rendered_tweets), user, how_long))
+        '*** PUSHED %d CONNECTION IDS FOR %s TO NEO IN %ds, %d NEW ***' %
+        (len(ids), user, how_long, len(unhydrated)))
 
+    return unhydrated, known
 
-def multi_user_labelled_tweet_actions(db, tweet_dump, label='tweet'):
-    started = datetime.now()
 
-    actions = {'tweet': 'TWEETED', 'retweet': 'RETWEETED', 'quotetweet': 'QUOTED'}
+def user_counts(db, user):
+    """Return the friends_count and followers_count of the user with screen_name <user>."""
+    with db.session() as session:
+        record = session.run(user_counts_query, user=user).single()
+    if record is None:
+        return 0, 0
+    return record[0] or 0, record[1] or 0
 
-    match = ("MATCH (u:twitter_user {{screen_name: d.screen_name}})," +
-             " (t:{} {{id_str: d.id_str}})").format(label)
 
-    merge = "MERGE (u)-[:{}]->(t)".format(actions[label])
+def tweets_statement(rendered_tweets, label='tweet', known=None):
+    tweets = [t[-1] for t in rendered_tweets]
+    if known is not None:
+        tweets = known.fresh(label, tweets, 'id')
 
-    screen_names_and_tweets = (t[-2:] for t in tweet_dump)
-    data = [{'screen_name': screen_name, 'id_str': tweet['id_str']} for screen_name, tweet in screen_names_and_tweets]
+    data = [{'id': tweet['id'], 'props': tweet} for tweet in tweets]
 
-    unwind_tx(db, data, match, merge)
+    return (tweets_queries[label], {'data': data})
 
-    how_long = (datetime.now() - started).seconds
-    logging.info(
-        '*** PUSHED %d TWEET ACTIONS FOR MULTIPLE USERS TO NEO IN %ds ***' %
-        (len(data), how_long))
 
+def tweet_actions_statement(user, rendered_tweets, label='tweet'):
+    tweets = (t[-1] for t in rendered_tweets)
+    data = [{'id_str': tweet['id_str']} for tweet in tweets]
 
-def multi_user_tweet_actions(db, tweet_user_dump):
-    started = datetime.now()
-    match = ("MATCH (u:twitter_user {screen_name: d.name}), " +
-             "(t:tweet {id_str: d.id})")
-    
-    merge = "MERGE (u)-[:TWEETED]->(t)"
+    return (tweet_actions_queries[label], {'data': data, 'user': user})
+
+
+def multi_user_labelled_tweet_actions_statement(tweet_dump, label='tweet'):
+    screen_names_and_tweets = (t[-2:] for t in tweet_dump)
+    data = [{'screen_name': screen_name, 'id_str': tweet['id_str']} for screen_name, tweet in screen_names_and_tweets]
 
-    data = [{'name': user['screen_name'], 'id': id_str} for id_str, user in
+    return (multi_user_tweet_actions_queries[label], {'data': data})
+
+
+def multi_user_tweet_actions_statement(tweet_user_dump):
+    data = [{'screen_name': user['screen_name'], 'id_str': id_str} for id_str, user in
             tweet_user_dump.items()]
-    
-    unwind_tx(db, data, match, merge)
 
-    how_long = (datetime.now() - started).seconds
-    logging.info(
-        '*** PUSHED %d TWEET ACTIONS TO NEO IN %ds ***' %
-        (len(data), how_long))
+    return (multi_user_tweet_actions_queries['tweet'], {'data': data})
     
    
-def tweetLinks(db, links, src_label, dest_label, relation):
-    started = datetime.now()
-    
-    match = ("MATCH (src:{} {{id_str: d.src_id_str}}),"
-        +" (dest:{} {{id_str: d.dest_id_str}})").format(src_label, dest_label)
-
-    merge = "MERGE (src)-[:{}]->(dest)".format(relation)
-
+def tweet_links_statement(links, src_label, relation):
     data = [{'src_id_str':src['id_str'], 'dest_id_str':dest['id_str']} for dest, screen_name, src in links]
-    
-    unwind_tx(db, data, match, merge)
-       
-    how_long = (datetime.now() - started).seconds
-    logging.info(
-        '*** PUSHED %d TWEET LINKS TO NEO IN %ds ***' %
-        (len(links),how_long))
 
-entity_node_labels = {'hashtags': 'hashtag', 'urls': 'url', 'media': 'media'}
-entity_ids = {'hashtags': 'text', 'urls': 'expanded_url', 'media': 'id_str'}
+    return (tweet_links_queries[(src_label, relation)], {'data': data})
 
 
-def entities2neo(db, entities, entity_type):
-    started = datetime.now()
-    
-    merge = "MERGE (x:{} {{id: d.id}})".format(entity_node_labels[entity_type])
-    
-    update = "SET x += d.props"
-    
+def entities_statement(entities, entity_type, known=None):
     id_field = entity_ids[entity_type]
+    if known is not None:
+        entities = known.fresh(entity_node_labels[entity_type], entities, id_field)
     data = [{'id': e[id_field], 'props': e} for e in entities]
 
-    unwind_tx(db, data, merge, update)
+    return (entities_queries[entity_type], {'data': data})
 
-    how_long = (datetime.now() - started).seconds
-    logging.info(
-        '*** PUSHED %d TWEET ENTITIES TO NEO IN %ds ***' %
-        (len(entities),how_long))
 
+def mentions_statement(mentions, label):
+    data = [{'src': src, 'dest': dest['screen_name']} for (src, dest) in mentions]
 
-def entity_links(db, entities, relation, src_label, dest_label, src_prop, dest_prop):
-    started = datetime.now()
-    
-    match = ("MATCH (src:{} {{{}:d.src}}), (dest:{} {{{}:d.dest}})").format(
-    src_label, src_prop, dest_label, dest_prop)
-    
-    merge = "MERGE (src)-[:{}]->(dest)".format(relation)
-    
+    return (mentions_queries[label], {'data': data})
+
+
+def entity_links_statement(entities, label, entity_type):
+    dest_prop = entity_ids[entity_type]
     data = [{'src': src, 'dest': dest[dest_prop]} for (src, dest) in entities]
 
-    unwind_tx(db, data, match, merge)
-    
-    how_long = (datetime.now() - started).seconds
-    logging.info(
-        '*** PUSHED %d ENTITY LINKS TO NEO IN %ds ***' %
-        (len(entities),how_long))   
+    return (entity_links_queries[(label, entity_type)], {'data': data})
 
 
-def tweetDump2Neo(db, user, tweet_dump):
-    """Store a rendered set of tweets by a given user in Neo4J.
-       
-    Positional arguments:
-    user -- screen_name of the author of the tweets
-    tweetDump -- tweets, retweets, mentions, hastags, URLs and replies from "decomposeTweets"
+def tweet_dump_statements(tweet_dump, user=None, known=None):
+    """Return the ordered list of statements that store a set of tweets from "decomposeTweets".
 
+    If <user> is given, they are the author of all the tweets, otherwise authors are taken from the dump.
+    If <known>, (a KnownEntityFilter), is given, users, entities and the original tweets of retweets and quotes
+    that were written recently with the same content are skipped. Relationships are always written.
     """
-    
+    statements = []
+    right_now = datetime.now().isoformat()
+
     # user->[tweeted/RTed/quoted]->(tweet/RT/quoteTweet)
-    for label in ['tweet', 'retweet', 'quotetweet']:
+    for label in tweet_labels:
         if tweet_dump[label]:
-            tweets2Neo(db, tweet_dump[label], label=label)
-            tweetActions(db, user, tweet_dump[label], label=label)
-    
+            statements.append(tweets_statement(tweet_dump[label], label=label))
+            if user is None:
+                statements.append(multi_user_labelled_tweet_actions_statement(tweet_dump[label], label=label))
+            else:
+                statements.append(tweet_actions_statement(user, tweet_dump[label], label=label))
+
     # push original tweets from RTs/quotes
     for label in ['retweet', 'quotetweet']:
         tweets = [(tw[0],) for tw in tweet_dump[label]]
         if tweets:
-            tweets2Neo(db, tweets, label='tweet')
-    
+            statements.append(tweets_statement(tweets, label='tweet', known=known))
+
     # (RT/quote)-[RETWEET_OF/QUOTE_OF]->(tweet)
     if tweet_dump['retweet']:
-        tweetLinks(db, tweet_dump['retweet'], 'retweet', 'tweet', 'RETWEET_OF')
+        statements.append(tweet_links_statement(tweet_dump['retweet'], 'retweet', 'RETWEET_OF'))
     if tweet_dump['quotetweet']:
-        tweetLinks(db, tweet_dump['quotetweet'], 'quotetweet', 'tweet', 'QUOTE_OF')
+        statements.append(tweet_links_statement(tweet_dump['quotetweet'], 'quotetweet', 'QUOTE_OF'))
 
     # push users of original tweets.
     if tweet_dump['users']:
-        users2Neo(db, tweet_dump['users'].values())
-        multi_user_tweet_actions(db, tweet_dump['users'])
-    
+        statements.append(users_statement(list(tweet_dump['users'].values()), right_now, known=known))
+        statements.append(multi_user_tweet_actions_statement(tweet_dump['users']))
+
     # mentions
-    for label in ['tweet', 'retweet', 'quotetweet']:
+    for label in tweet_labels:
         mentions = [m[1] for m in tweet_dump['entities'][label]['user_mentions']]
         if mentions:
-            users2Neo(db, mentions)
-            entities = tweet_dump['entities'][label]['user_mentions']
-            entity_links(db, entities, 'MENTIONS', label, 'twitter_user', 'id_str', 'screen_name')
+            statements.append(users_statement(mentions, right_now, known=known))
+            statements.append(mentions_statement(tweet_dump['entities'][label]['user_mentions'], label))
 
     # hashtags, urls and media
-    for label in ['tweet', 'retweet', 'quotetweet']:
-        for entity_type in ['hashtags', 'urls', 'media']:
+    for label in tweet_labels:
+        for entity_type in entity_types:
             entities = [e[1] for e in tweet_dump['entities'][label][entity_type]]
             if entities:
-                entities2neo(db, entities, entity_type)
+                statements.append(entities_statement(entities, entity_type, known=known))
 
-        if tweet_dump['entities'][label]['hashtags']:
-            entity_links(db, tweet_dump['entities'][label]['hashtags'],
-                         'TAGGED', label, 'hashtag', 'id_str', 'text')
-        
-        if tweet_dump['entities'][label]['urls']:
-            entity_links(db, tweet_dump['entities'][label]['urls'],
-                         'LINKS_TO', label, 'url', 'id_str', 'expanded_url')
-        
-        if tweet_dump['entities'][label]['media']:
-            entity_links(db, tweet_dump['entities'][label]['media'],
-                         'EMBEDS', label, 'media', 'id_str', 'id_str')
+        for entity_type in entity_types:
+            if tweet_dump['entities'][label][entity_type]:
+                statements.append(entity_links_statement(tweet_dump['entities'][label][entity_type],
+                    label, entity_type))
 
+    return statements
 
-def multiUserTweetDump2Neo(db, tweet_dump):
-    """Store rendered sets of tweets by given users in Neo4J.
-    """
 
-    # user->[tweeted/RTed/quoted]->(tweet/RT/quoteTweet)
-    for label in ['tweet', 'retweet', 'quotetweet']:
-        if tweet_dump[label]:
-            tweets2Neo(db, tweet_dump[label], label=label)
-            multi_user_labelled_tweet_actions(db, tweet_dump[label], label=label)
+def pushTweetDump(db, tweet_dump, user=None):
+    """Store a rendered set of tweets in a single transaction, log and return the commit latency."""
+    known = new_known_filter()
+    statements = tweet_dump_statements(tweet_dump, user=user, known=known)
+    if not statements:
+        return 0.0
 
-    # push original tweets from RTs/quotes
-    for label in ['retweet', 'quotetweet']:
-        tweets = [(tw[0],) for tw in tweet_dump[label]]
-        if tweets:
-            tweets2Neo(db, tweets, label='tweet')
+    rows = sum(len(params['data']) for query, params in statements)
+    commit_time = neo_batch_tx(db, statements)
+    if known is not None:
+        known.commit()
+    add_to_frontier(tweet_dump.get('users', {}).values())
 
-    # (RT/quote)-[RETWEET_OF/QUOTE_OF]->(tweet)
-    if tweet_dump['retweet']:
-        tweetLinks(db, tweet_dump['retweet'], 'retweet', 'tweet', 'RETWEET_OF')
-    if tweet_dump['quotetweet']:
-        tweetLinks(db, tweet_dump['quotetweet'], 'quotetweet', 'tweet', 'QUOTE_OF')
+    logging.info(
+        '*** PUSHED TWEET DUMP FOR %s TO NEO: %d STATEMENTS, %d ROWS, COMMITTED IN %.3fs ***' %
+        (user if user else 'MULTIPLE USERS', len(statements), rows, commit_time))
 
-    # push users of original tweets.
-    if tweet_dump['users']:
-        users2Neo(db, tweet_dump['users'].values())
-        multi_user_tweet_actions(db, tweet_dump['users'])
+    return commit_time
 
-    # mentions
-    for label in ['tweet', 'retweet', 'quotetweet']:
-        mentions = [m[1] for m in tweet_dump['entities'][label]['user_mentions']]
-        if mentions:
-            users2Neo(db, mentions)
-            entities = tweet_dump['entities'][label]['user_mentions']
-            entity_links(db, entities, 'MENTIONS', label, 'twitter_user', 'id_str', 'screen_name')
 
-    # hashtags, urls and media
-    for label in ['tweet', 'retweet', 'quotetweet']:
-        for entity_type in ['hashtags', 'urls', 'media']:
-            entities = [e[1] for e in tweet_dump['entities'][label][entity_type]]
-            if entities:
-                entities2neo(db, entities, entity_type)
+def tweetDump2Neo(db, user, tweet_dump):
+    """Store a rendered set of tweets by a given user in Neo4J.
+       
+    Positional arguments:
+    user -- screen_name of the author of the tweets
+    tweetDump -- tweets, retweets, mentions, hastags, URLs and replies from "decomposeTweets"
 
-        if tweet_dump['entities'][label]['hashtags']:
-            entity_links(db, tweet_dump['entities'][label]['hashtags'],
-                         'TAGGED', label, 'hashtag', 'id_str', 'text')
+    """
+    return pushTweetDump(db, tweet_dump, user=user)
 
-        if tweet_dump['entities'][label]['urls']:
-            entity_links(db, tweet_dump['entities'][label]['urls'],
-                         'LINKS_TO', label, 'url', 'id_str', 'expanded_url')
 
-        if tweet_dump['entities'][label]['media']:
-            entity_links(db, tweet_dump['entities'][label]['media'],
-                         'EMBEDS', label, 'media', 'id_str', 'id_str')
+def multiUserTweetDump2Neo(db, tweet_dump):
+    """Store rendered sets of tweets by given users in Neo4J.
+    """
+    return pushTweetDump(db, tweet_dump)
+
+
+def backfill_degrees(db, after=-1, batch_size=10000):
+    """Count the relationships of the next <batch_size> users after user id <after>, and store them in their
+    "friends_in_graph", "followers_in_graph" and "tweets_in_graph" counters, and their crawl flags.
+
+    Returns the number of users counted, and the last user id, (None once they've all been done).
+    """
+    def work():
+        with db.session() as session:
+            return session.run(backfill_degrees_query, after=after, batch_size=batch_size).single().values()
 
+    counted, last_id = neo_retry(work)
+    logging.info('*** BACKFILLED DEGREE COUNTERS FOR %d USERS AFTER USER %d ***' % (counted, after))
+    return counted, last_id
 
 
 def setUserDefunct(db, user):
-    match = "MATCH (t:twitter_user {{screen_name: '{}'}})".format(user)
-    update = "SET t.defunct = true"
-    query = '\n'.join([match, update])
-    neo_tx(db, query)
+    neo_batch_tx(db, [(set_user_defunct_query, {'user': user})])
+    drop_from_frontier(user)
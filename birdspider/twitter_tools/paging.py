@@ -0,0 +1,104 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""
+Page through a Twitter API method inside one task.
+
+Pages are fetched for as long as the rate limit and the time budget allow, and handed back one at a time so each can
+be pushed as soon as it arrives. The state needed to fetch the next page is checkpointed to Redis after each page
+has been handled, so a task that's retried, re-queued or restarted after a crash carries on where it left off.
+"""
+
+import json
+import logging
+import time
+
+from db_settings import cache
+from twitter_settings import PAGE_TIME_BUDGET
+
+checkpoint_prefix = 'paging_'
+
+# A checkpoint nobody has picked up for this long belongs to a job that's been abandoned.
+checkpoint_ttl = 3600
+
+
+class Pager(object):
+    """Fetch successive pages of an API method.
+
+    After iterating over pages(), "status" is 'done', 'limited' with "wait" set to the seconds to wait, 'timeout' if
+    the time budget ran out, or the reason the last call failed.
+    """
+
+    def __init__(self, api, method_name, job, time_budget=PAGE_TIME_BUDGET):
+        """
+        Positional arguments:
+        api -- a RatedTwitter object
+        method_name -- the API method to call
+        job -- identifies the job, (such as a screen_name) so the checkpoint is found again when it's resumed
+        """
+        self.api = api
+        self.method_name = method_name
+        self.checkpoint_key = checkpoint_prefix + method_name + '_' + job
+        self.time_budget = time_budget
+        self.status = None
+        self.wait = 0
+        self.last = False
+        self.state = None
+
+    def resume(self, state):
+        """Return the checkpointed state, or <state> if there isn't one."""
+        saved = cache.get(self.checkpoint_key)
+        if saved:
+            logging.info('*** RESUMING %s ***' % self.checkpoint_key)
+            return json.loads(saved.decode('utf-8'))
+        return state
+
+    def checkpoint(self, state):
+        if state is None:
+            cache.delete(self.checkpoint_key)
+        else:
+            cache.set(self.checkpoint_key, json.dumps(state), ex=checkpoint_ttl)
+
+    def pages(self, state, advance):
+        """Yield the result of each call in turn.
+
+        Positional arguments:
+        state -- a dictionary with the keyword arguments of the first call in 'args', and anything else the caller
+        wants to keep track of
+        advance -- a function of the current state and the result that returns the state for the next page,
+        or None if this is the last one, (when "last" is set before the result is yielded)
+        """
+        self.state = self.resume(state)
+        started = time.time()
+        while True:
+            if time.time() - started > self.time_budget:
+                self.status = 'timeout'
+                return
+            self.wait = self.api.can_we_do_that(self.method_name)
+            if self.wait:
+                self.status = 'limited'
+                return
+
+            okay, result = self.api.method_call(self.method_name, **self.state['args'])
+            if not okay:
+                self.status = result
+                if result == 'limited':
+                    self.wait = self.api.can_we_do_that(self.method_name)
+                else:
+                    self.checkpoint(None)
+                return
+
+            next_state = advance(self.state, result)
+            self.last = next_state is None
+            yield result
+            self.checkpoint(next_state)
+            if self.last:
+                self.status = 'done'
+                return
+            self.state = next_state
+
+
+def next_cursor(state, result):
+    """Advance a cursored method, such as friends/list or followers/ids."""
+    cursor = result.get('next_cursor', False)
+    if cursor:  # Unless the next cursor is 0, we're not done yet.
+        return dict(state, args=dict(state['args'], cursor=cursor))
+    return None
@@ -0,0 +1,119 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""
+Token buckets in Redis, one for each set of credentials and API endpoint, shared by all the workers.
+
+Each call reserves a token before it's made. Tokens refill steadily at <limit> per <window>, where the limit is
+learnt from the "x-rate-limit-*" headers of the responses, which also bring the bucket back in line with Twitter's
+own count. When the bucket is empty, each caller is given its own slot, 1/rate seconds after the last one handed
+out, so that deferred calls are released one at a time rather than all together when the window resets.
+"""
+
+import math
+import time
+
+from db_settings import cache
+from twitter_settings import DEFAULT_RATE_LIMIT, RATE_LIMIT_MARGIN, RATE_LIMIT_WINDOW
+
+bucket_prefix = 'rate_limit_'
+
+# Keep what's been learnt about the limits for a day after the last call.
+bucket_ttl = 86400
+
+reserve_token = cache.register_script("""
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'capacity', 'updated', 'next_slot', 'blocked_until')
+local capacity = tonumber(bucket[2]) or tonumber(ARGV[2])
+local rate = capacity / window
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[3]) or now
+local next_slot = tonumber(bucket[4]) or 0
+local blocked_until = tonumber(bucket[5]) or 0
+
+if now > blocked_until then
+    tokens = math.min(capacity, tokens + (now - math.max(updated, blocked_until)) * rate)
+end
+
+local wait = 0
+if now >= blocked_until and tokens >= 1 then
+    tokens = tokens - 1
+else
+    local slot = math.max(math.max(now, blocked_until) + (1 - tokens) / rate, next_slot + 1 / rate)
+    redis.call('HSET', KEYS[1], 'next_slot', tostring(slot))
+    wait = slot - now
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'capacity', tostring(capacity), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return tostring(wait)
+""")
+
+reconcile_bucket = cache.register_script("""
+local remaining = tonumber(ARGV[3])
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens')) or remaining
+redis.call('HMSET', KEYS[1], 'tokens', tostring(math.min(tokens, remaining)), 'capacity', ARGV[2],
+    'updated', ARGV[1])
+if remaining <= 0 then
+    redis.call('HSET', KEYS[1], 'blocked_until', ARGV[4])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return remaining
+""")
+
+
+def bucket_key(handle, method_name):
+    return bucket_prefix + handle + method_name
+
+
+def reserve(handle, method_name):
+    """Take a token for the API call, or return the number of seconds to wait for one."""
+    wait = float(reserve_token(keys=[bucket_key(handle, method_name)],
+        args=[time.time(), DEFAULT_RATE_LIMIT, RATE_LIMIT_WINDOW, bucket_ttl]))
+    return int(math.ceil(wait))
+
+
+def reconcile(handle, method_name, limit, remaining, reset):
+    """Bring the bucket into line with the rate limit headers of a response.
+
+    Positional arguments:
+    limit -- calls allowed per window, from "x-rate-limit-limit"
+    remaining -- calls left in the current window, from "x-rate-limit-remaining"
+    reset -- when the current window ends, in seconds since the epoch, from "x-rate-limit-reset"
+    """
+    reconcile_bucket(keys=[bucket_key(handle, method_name)],
+        args=[time.time(), max(limit, 1), remaining, reset + RATE_LIMIT_MARGIN, bucket_ttl])
+
+
+def exhaust(handle, method_name, reset=None):
+    """Empty the bucket after a 429, until <reset> or the end of a whole window."""
+    if not reset:
+        reset = time.time() + RATE_LIMIT_WINDOW
+    key = bucket_key(handle, method_name)
+    capacity = cache.hget(key, 'capacity')
+    reconcile_bucket(keys=[key], args=[time.time(), capacity.decode('utf-8') if capacity else DEFAULT_RATE_LIMIT,
+        0, reset + RATE_LIMIT_MARGIN, bucket_ttl])
+
+
+def blocked_for(handle, method_name):
+    """Seconds until a bucket emptied by a 429 refills, without reserving a token."""
+    blocked_until = cache.hget(bucket_key(handle, method_name), 'blocked_until')
+    return max(0, int(math.ceil(float(blocked_until) - time.time()))) if blocked_until else 0
+
+
+def available(handles, method_name):
+    """Estimate the tokens left in the bucket for each of the handles, without reserving any."""
+    now = time.time()
+    pipe = cache.pipeline()
+    for handle in handles:
+        pipe.hmget(bucket_key(handle, method_name), 'tokens', 'capacity', 'updated', 'blocked_until')
+    budgets = {}
+    for handle, bucket in zip(handles, pipe.execute()):
+        tokens, capacity, updated, blocked_until = [float(val) if val else None for val in bucket]
+        capacity = capacity or DEFAULT_RATE_LIMIT
+        if tokens is None:
+            budgets[handle] = capacity
+        elif blocked_until and blocked_until > now:
+            budgets[handle] = 0
+        else:
+            refill = (now - max(updated or now, blocked_until or 0)) * capacity / RATE_LIMIT_WINDOW
+            budgets[handle] = min(capacity, tokens + refill)
+    return budgets
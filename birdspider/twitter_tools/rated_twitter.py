@@ -1,64 +1,112 @@
 # Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
 
-from datetime import datetime
 import json
 import logging
+import time
 
+from requests.adapters import HTTPAdapter
 from twython import Twython, TwythonAuthError, TwythonRateLimitError, TwythonError
 from twython.endpoints import EndpointsMixin
 
 from db_settings import cache
 from twitter_settings import *
+from twitter_tools.credential_pool import best_handle, drop_credential, pool_credentials
+from twitter_tools.rate_limits import exhaust, reconcile, reserve
 
 __twitter_methods__ = [m for m in dir(EndpointsMixin) if not m.startswith('__')]
 
+bad_token_reasons = ('Invalid or expired token', 'Could not authenticate you')
+
+latency_prefix = 'twitter_latency_'
+latency_samples = 1000
+
+# Twython clients for this process, keyed by their credentials. Each holds a requests session, so consecutive calls
+# with the same credentials reuse its kept-alive connections. Prefork workers run one task at a time, so it's safe
+# to share them, (including the headers of the last call) between tasks.
+__clients__ = {}
+
+
+def twython_client(*args, **kwargs):
+    """Return this process's Twython client for the given credentials, creating it the first time."""
+    key = (args, tuple(sorted(kwargs.items())))
+    client = __clients__.get(key, None)
+    if client is None:
+        client = Twython(*args, **kwargs)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TWITTER_HTTP_POOL_SIZE)
+        client.client.mount('https://', adapter)
+        __clients__[key] = client
+    return client
+
+
+def record_latency(method_name, seconds):
+    key = latency_prefix + method_name
+    pipe = cache.pipeline()
+    pipe.lpush(key, '%.4f' % seconds)
+    pipe.ltrim(key, 0, latency_samples - 1)
+    pipe.execute()
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_percentiles():
+    """The 50th, 90th and 99th percentile latency in seconds of the last 1000 calls to each Twitter API method."""
+    stats = {}
+    for key in cache.scan_iter(latency_prefix + '*'):
+        samples = sorted(float(val) for val in cache.lrange(key, 0, -1))
+        if samples:
+            stats[key.decode('utf-8')[len(latency_prefix):]] = {'calls': len(samples),
+                'p50': percentile(samples, 0.5), 'p90': percentile(samples, 0.9), 'p99': percentile(samples, 0.99)}
+    return stats
+
+
 class RatedTwitter(object):    
-    """Wrapper around the Twython class that tracks whether API calls are rate-limited."""
+    """Wrapper around the Twython class that tracks whether API calls are rate-limited.
+
+    Unless it's given a user's credentials, it draws on the pool of application and user tokens, and each call
+    uses whichever token has the most budget left for the API method.
+    """
 
     def __init__(self, use_app=True, credentials=False):
+        self.pool = {}
         if credentials:
             creds=json.loads(credentials)
             oauth1_token = creds.get('oauth1_token')
             oauth1_secret = creds.get('oauth1_secret')
             logging.info("*** Calls to Twitter APIs will use user provided OAUTH1 user authentication token and secret ***")
-            self.twitter = Twython(CONSUMER_KEY, CONSUMER_SECRET, oauth1_token, oauth1_secret)
+            self.twitter = twython_client(CONSUMER_KEY, CONSUMER_SECRET, oauth1_token, oauth1_secret)
             self.handle = 'user_'
         elif use_app:
-            logging.info("*** Calls to Twitter APIs will use preconfigured OAUTH2 application authentication ***")
-            self.twitter = Twython(CONSUMER_KEY, access_token=ACCESS_TOKEN, oauth_version=2)
-            self.handle = 'app_'
+            logging.info("*** Calls to Twitter APIs will use the pool of application and user tokens ***")
+            self.pool = pool_credentials()
+            self.handle = 'app_' if 'app_' in self.pool else next(iter(self.pool), 'app_')
+            self.twitter = self.pool_client(self.handle)
         else:   # TODO handle this choice better
             logging.info("*** Calls to Twitter APIs will use preconfigured OAUTH1 user authentication token and secret ***")
-            self.twitter = Twython(CONSUMER_KEY, CONSUMER_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET)
+            self.twitter = twython_client(CONSUMER_KEY, CONSUMER_SECRET, OAUTH_TOKEN, OAUTH_TOKEN_SECRET)
             self.handle = 'local_'
 
     def can_we_do_that(self, method_name):
-        """Check whether a given API call is rate-limited, return the estimated time to wait in seconds.
+        """Reserve a call to the given API method, return 0 if it can go ahead, else the time to wait in seconds.
+
+        The reservation is shared by every worker using the same credentials, so only make the call if this is 0.
     
         Positional arguments:
         method_name -- the name of the API call to test    
         """      
-        
-        # Have we recorded how many calls remain in the current window?
-        try:
-            keyval = cache.get(self.handle+method_name).decode('utf-8')
-        except:
-            keyval = False
-        # We've not made the call for these credentials. Assume all's well.
-        if not keyval: 
-            return 0
-        else:
-            history = json.loads(keyval)
-            if history['limit'] > 0:
-                # Still good to go.
-                return 0
-            reset = datetime.strptime(history['reset'].split('.')[0], "%Y-%m-%dT%H:%M:%S")
-            rightNow = datetime.now()
-            # No calls left and the window reset is in the future...
-            if reset > rightNow:
-                # ...return the time to wait.
-                return (reset - rightNow).seconds + 30
-            return 0
+        if len(self.pool) > 1:
+            handle = best_handle(list(self.pool.keys()), method_name)
+            if handle is None:
+                logging.error('*** EVERY TOKEN IN THE POOL HAS BEEN DROPPED ***')
+            elif handle != self.handle:
+                self.handle = handle
+                self.twitter = self.pool_client(handle)
+        return reserve(self.handle, method_name)
+
+    def pool_client(self, handle):
+        args, kwargs = self.pool.get(handle, ((CONSUMER_KEY,), {'access_token': ACCESS_TOKEN, 'oauth_version': 2}))
+        return twython_client(*args, **kwargs)
 
     def method_call(self, method_name, *args, **kwargs):
         """Make a Twitter API call via the underlying Twython object.
@@ -78,11 +126,15 @@ class RatedTwitter(object):
             return (False,'no_such_method')
         
         # Call the method of the Twython object.
+        start = time.time()
         try:
             result = (True, method(*args, **kwargs))
-        except TwythonAuthError:
+        except TwythonAuthError as e:
             logging.error('*** TWITTER METHOD 401: '+method_name+' ***')
             result = (False, 'forbidden')
+            # Protected accounts also give 401s, only drop tokens that Twitter doesn't accept at all.
+            if len(self.pool) > 1 and any(reason in str(e) for reason in bad_token_reasons):
+                drop_credential(self.handle)
         except TwythonRateLimitError:
             logging.error('*** TWITTER METHOD LIMITED: '+method_name+' ***')
             result = (False, 'limited')
@@ -94,21 +146,21 @@ class RatedTwitter(object):
                 logging.error('*** TWITTER METHOD FAILED: '+method_name+' ***')
                 result = (False, 'unknown')
             logging.error(args)
+        record_latency(method_name, time.time() - start)
 
         # Have we been told how many calls remain in the current window?
         try: 
-            xLimit = self.twitter.get_lastfunction_header('x-rate-limit-remaining')
+            xLimit = self.twitter.get_lastfunction_header('x-rate-limit-limit')
+            xRemaining = self.twitter.get_lastfunction_header('x-rate-limit-remaining')
             xReset = self.twitter.get_lastfunction_header('x-rate-limit-reset')
         except:
-            xLimit = xReset = False
-            
-        if xLimit:
-            limit = int(xLimit)        
-        if xReset:
-            reset = datetime.utcfromtimestamp(int(xReset)).isoformat()
-        if xLimit and xReset:
-            # Store the current number of remaining calls and time when the window resets.
-            cache.set(self.handle+method_name, json.dumps({'limit':limit, 'reset':reset}))
+            xLimit = xRemaining = xReset = False
+
+        if result == (False, 'limited'):
+            exhaust(self.handle, method_name, int(xReset) if xReset else None)
+        elif xLimit and xRemaining and xReset:
+            # Bring the shared bucket into line with Twitter's count of the remaining calls.
+            reconcile(self.handle, method_name, int(xLimit), int(xRemaining), int(xReset))
 
         return result
                 
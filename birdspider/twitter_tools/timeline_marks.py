@@ -0,0 +1,75 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""
+Per-user high-water marks: the id of the newest tweet stored from each user's timeline.
+
+Timeline fetches only ask for tweets newer than the mark. Each fetch counts its pages as they're sent to be written,
+and the last page carries the newest id of the whole fetch. A mark is only advanced once every page has been
+committed, so a fetch that dies part of the way through, or a page that can't be written, is simply repeated.
+"""
+
+from db_settings import cache
+
+marks_key = 'tweet_high_water'
+fetch_prefix = 'tweet_fetch_'
+
+# Forget the pages of a fetch that never finished after this many seconds.
+fetch_ttl = 24 * 3600
+
+# Tweet ids don't fit in a Lua number, so compare them as strings of digits, by length first.
+advance_mark = cache.register_script("""
+local old = redis.call('HGET', KEYS[1], ARGV[1])
+if (not old) or #ARGV[2] > #old or (#ARGV[2] == #old and ARGV[2] > old) then
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    return 1
+end
+return 0
+""")
+
+
+def high_water(user):
+    """The id of the newest stored tweet from the user's timeline, or 0 if there isn't one."""
+    mark = cache.hget(marks_key, user)
+    return int(mark) if mark else 0
+
+
+def advance_high_water(user, tweet_id):
+    """Move the user's mark up to <tweet_id>, unless it's already past it. True if the mark moved."""
+    if not tweet_id:
+        return False
+    return bool(advance_mark(keys=[marks_key], args=[user, str(tweet_id)]))
+
+
+# Returns the fetch's newest id once its last page is in, and every page is written.
+settle_page = cache.register_script("""
+if ARGV[1] ~= '0' then
+    redis.call('HSET', KEYS[1], 'high_water', ARGV[1])
+end
+local pages = redis.call('HINCRBY', KEYS[1], 'pages', -1)
+local mark = redis.call('HGET', KEYS[1], 'high_water')
+if pages <= 0 and mark then
+    redis.call('DEL', KEYS[1])
+    return mark
+end
+return false
+""")
+
+
+def page_sent(fetch):
+    """Count a page of the fetch identified by <fetch> that's on its way to the graph."""
+    key = fetch_prefix + fetch
+    pipe = cache.pipeline()
+    pipe.hincrby(key, 'pages', 1)
+    pipe.expire(key, fetch_ttl)
+    pipe.execute()
+
+
+def page_written(user, fetch, highWater=0):
+    """Count a page of a fetch as committed, advance the user's mark if it was the last one outstanding.
+
+    Keyword arguments:
+    highWater -- the newest tweet id of the whole fetch, sent with its last page
+
+    True if the mark moved.
+    """
+    mark = settle_page(keys=[fetch_prefix + fetch], args=[str(highWater or 0)])
+    return advance_high_water(user, int(mark)) if mark else False
@@ -0,0 +1,202 @@
+# Licensed under the Apache License Version 2.0: http://www.apache.org/licenses/LICENSE-2.0.txt
+"""
+Write-behind buffer for graph ingestion.
+
+Rather than every page of users, connections or tweets getting its own transaction, rendered data from many tasks
+is appended to a Redis list. A single flusher at a time takes a batch off the front of the list, merges it into a
+few large UNWIND statements and commits them in one transaction. Delivery is at-least-once: a batch is moved to its
+own in-flight list before it's written, and is only deleted once the transaction commits. If the write fails
+because Neo4j is busy or can't be reached, the batch goes back on the front of the buffer. If it fails for any other
+reason, such as a constraint violation, it would fail every time, so it's moved to a dead-letter list instead. If the
+flushing worker dies, the next flush puts its batch back.
+"""
+
+import json
+import logging
+import time
+from uuid import uuid4
+
+from crawl.frontier import add_to_frontier
+from db_settings import cache, write_behind_flush_size
+from neo_retry import NeoUnavailable, classify
+from twitter_tools.graph_version import follows_changed
+from twitter_tools.neo import (multi_user_connections_statements, neo_batch_tx, new_known_filter,
+    tweet_dump_statements, users_statement)
+from twitter_tools.timeline_marks import page_written
+from twitter_tools.tools import entityStore
+
+buffer_key = 'neo_write_buffer'
+batch_prefix = 'neo_write_batch_'
+in_flight_key = 'neo_write_batches'
+lock_key = 'neo_write_flush_lock'
+flush_requested_key = 'neo_write_flush_requested'
+dead_letter_key = 'neo_write_dead_letters'
+
+# A batch still in flight after the lock has expired belongs to a flusher that died.
+lock_ttl = 300
+
+take_batch = cache.register_script("""
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items == 0 then
+    return items
+end
+redis.call('LTRIM', KEYS[1], #items, -1)
+for i = 1, #items, 1000 do
+    redis.call('RPUSH', KEYS[2], unpack(items, i, math.min(i + 999, #items)))
+end
+redis.call('ZADD', KEYS[3], ARGV[2], KEYS[2])
+return items
+""")
+
+requeue_batch = cache.register_script("""
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+for i = #items, 1, -1 do
+    redis.call('LPUSH', KEYS[1], items[i])
+end
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[3], KEYS[2])
+return #items
+""")
+
+
+dead_letter_batch = cache.register_script("""
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+for i = 1, #items, 1000 do
+    redis.call('RPUSH', KEYS[1], unpack(items, i, math.min(i + 999, #items)))
+end
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[3], KEYS[2])
+return #items
+""")
+
+
+def buffer_write(kind, **payload):
+    """Append rendered data to the write buffer, return the length of the buffer.
+
+    Positional arguments:
+    kind -- 'users', 'connections' or 'tweets'
+    """
+    payload['kind'] = kind
+    return cache.rpush(buffer_key, json.dumps(payload))
+
+
+def request_flush():
+    """True if nobody else has asked for a flush in the last second."""
+    return bool(cache.set(flush_requested_key, 'true', nx=True, ex=1))
+
+
+def merge_tweet_dumps(dumps):
+    """Merge tweet dumps from "decomposeTweets" into one. The author of each tweet is kept in the dump itself."""
+    labels = ['tweet', 'retweet', 'quotetweet']
+    merged = {label: [] for label in labels}
+    merged['users'] = {}
+    merged['replies'] = {label: [] for label in labels}
+    merged['entities'] = {label: entityStore() for label in labels}
+
+    for dump in dumps:
+        for label in labels:
+            merged[label].extend(dump[label])
+            merged['replies'][label].extend(dump['replies'][label])
+            for entity_type, entities in dump['entities'][label].items():
+                merged['entities'][label][entity_type].extend(entities)
+        merged['users'].update(dump['users'])
+
+    return merged
+
+
+def buffered_statements(payloads, known=None):
+    """Merge buffered payloads into as few statements as possible."""
+    users = [twit for p in payloads if p['kind'] == 'users' for twit in p['twits']]
+    connections = [(p['user'], p['twits'], p['friends']) for p in payloads if p['kind'] == 'connections']
+    dumps = [p['dump'] for p in payloads if p['kind'] == 'tweets']
+
+    statements = []
+    if users:
+        statements.append(users_statement(users, known=known))
+    if connections:
+        statements.extend(multi_user_connections_statements(connections, known=known))
+    if dumps:
+        statements.extend(tweet_dump_statements(merge_tweet_dumps(dumps), known=known))
+
+    return statements
+
+
+def buffered_users(payloads):
+    """Every rendered user with a full profile in the buffered payloads."""
+    for p in payloads:
+        if p['kind'] in ('users', 'connections'):
+            for twit in p['twits']:
+                yield twit
+        elif p['kind'] == 'tweets':
+            for twit in p['dump']['users'].values():
+                yield twit
+
+
+def requeue_stale_batches():
+    """Put batches abandoned by dead flushers back on the front of the buffer."""
+    for batch_key in cache.zrangebyscore(in_flight_key, '-inf', time.time() - lock_ttl):
+        count = requeue_batch(keys=[buffer_key, batch_key.decode('utf-8'), in_flight_key])
+        logging.warning('*** REQUEUED %d ABANDONED WRITES ***' % count)
+
+
+def flush_batch(db, flush_size):
+    """Write up to <flush_size> buffered payloads in one transaction. Returns the number written."""
+    batch_key = batch_prefix + uuid4().hex
+    items = take_batch(keys=[buffer_key, batch_key, in_flight_key], args=[flush_size, time.time()])
+    if not items:
+        return 0
+
+    known = new_known_filter()
+    try:
+        payloads = [json.loads(item) for item in items]
+        statements = buffered_statements(payloads, known=known)
+        commit_time = neo_batch_tx(db, statements)
+    except Exception as e:
+        if isinstance(e, NeoUnavailable) or classify(e) != 'fatal':
+            requeue_batch(keys=[buffer_key, batch_key, in_flight_key])
+            raise
+        count = dead_letter_batch(keys=[dead_letter_key, batch_key, in_flight_key])
+        logging.error('*** MOVED %d BUFFERED WRITES TO %s AFTER A FATAL ERROR ***' % (count, dead_letter_key),
+            exc_info=True)
+        return 0
+    if known is not None:
+        known.commit()
+    add_to_frontier(buffered_users(payloads))
+    if any(p['kind'] == 'connections' for p in payloads):
+        follows_changed()
+    for p in payloads:
+        if p['kind'] == 'tweets' and p.get('fetch'):
+            page_written(p['user'], p['fetch'], p.get('highWater', 0))
+
+    pipe = cache.pipeline()
+    pipe.delete(batch_key)
+    pipe.zrem(in_flight_key, batch_key)
+    pipe.execute()
+
+    logging.info('*** FLUSHED %d BUFFERED WRITES TO NEO: %d STATEMENTS, COMMITTED IN %.3fs ***' %
+        (len(items), len(statements), commit_time))
+    return len(items)
+
+
+def flush_write_buffer(db, flush_size=write_behind_flush_size, max_batches=10):
+    """Drain the write buffer in batches of <flush_size>, unless another flush is already running.
+
+    Returns the number of payloads written.
+    """
+    token = uuid4().hex
+    if not cache.set(lock_key, token, nx=True, ex=lock_ttl):
+        return 0
+
+    flushed = 0
+    try:
+        requeue_stale_batches()
+        for batch in range(max_batches):
+            written = flush_batch(db, flush_size)
+            flushed += written
+            if written < flush_size:
+                break
+    finally:
+        if cache.get(lock_key) == token.encode('utf-8'):
+            cache.delete(lock_key)
+
+    return flushed